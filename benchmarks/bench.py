@@ -0,0 +1,344 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+"""SALaD benchmarks on synthetic scenes
+
+Generates synthetic scenes of the given sizes (synthetic.py) and runs:
+
+- scaling: the full pipeline (scripts/driver.py) on every scene in a
+  separate process, recording the wall time and peak RSS of the run, the
+  wall time of every stage from the run report, the segment count and the
+  throughput in pixels per second;
+- cores: the GLCM, zonal statistics and random forest steps of the largest
+  scene with every core count;
+- checks: the pipeline on the smallest scene with the reference options
+  and with the faster paths (native GLCM, streaming preprocessing, label
+  zonal statistics, raster weights, training labels and dissolve),
+  comparing their feature rasters, selected hr, training sets and
+  landslide maps, and the GLCM rasters of both runs with a brute-force
+  GLCM at sample pixels.
+
+Without the OTB Python bindings the stand-in otbApplication of this
+directory is used, with --otb standin it is used in any case. Results go
+to scaling.csv, cores.csv and checks.csv and, all together, to
+benchmark.json in the output directory.
+
+Example:
+  python benchmarks/bench.py -s 512 1024 2048 -c 1 2 4 8 -op /tmp/salad_bench
+"""
+
+import sys
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+from synthetic import make_scene
+
+STAGES = ['preprocessing', 'radius', 'segmentation', 'training', 'detection']
+
+# options of the faster paths, compared with the reference options
+FAST_OPTIONS = ['-g', 'native', '-st', '-z', 'label', '-w', 'raster',
+                '-tl', 'raster', '-ds', 'raster']
+
+# a feature raster check passes above this correlation with the reference
+RASTER_CORRELATION = 0.999
+# pixels of the brute-force GLCM check
+GLCM_SAMPLES = 256
+# a landslide map check passes above this intersection over union; the
+# random forests of the two runs are not seeded alike
+MAP_IOU = 0.8
+
+def otb_path(mode):
+    """Module path of the OTB bindings the runs use"""
+    if mode == 'installed':
+        return []
+    if mode == 'auto':
+        try:
+            import otbApplication
+            return []
+        except ImportError:
+            pass
+    return [BENCH_DIR]
+
+def run_driver(scene, scenePath, runPath, options, otb):
+    """Run the pipeline on a scene in a child process
+
+    Returns the wall time, the peak RSS of the run in MB and its report.
+    """
+    if os.path.exists(runPath):
+        shutil.rmtree(runPath)
+    os.makedirs(runPath)
+    reportFile = os.path.join(runPath, 'report.json')
+    cmd = [sys.executable, os.path.join(SCRIPTS_DIR, 'driver.py'),
+           '-p', scenePath, '-op', runPath + os.sep, '-i', scene['image'], '-d', scene['dem'],
+           '-l', scene['landslides'], '-lx', str(scene['ulx']), '-ly', str(scene['uly']),
+           '-rx', str(scene['lrx']), '-ry', str(scene['lry']),
+           '-rmi', str(scene['hr_min']), '-rma', str(scene['hr_max']), '-s', str(scene['step']),
+           '-hs', str(scene['spatialr']), '-m', str(scene['objectsize']),
+           '-t', str(scene['trees']), '-r', 'result.shp', '-rp', reportFile] + options
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(otb_path(otb) + [SCRIPTS_DIR] +
+                                        [p for p in [env.get('PYTHONPATH')] if p])
+    with open(os.path.join(runPath, 'log.txt'), 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=runPath, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # resource usage of this run only, peak RSS of the run and its children in KB
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise RuntimeError('Run failed, see '+os.path.join(runPath, 'log.txt'))
+    with open(reportFile) as fd:
+        doc = json.load(fd)
+    return wall, usage.ru_maxrss / 1024.0, doc
+
+def step_values(doc, name, key):
+    return [s[key] for s in doc['steps'] if s['step'].split('/')[-1] == name and key in s]
+
+def scaling(scenes, args):
+    """Full pipeline run per scene size"""
+    rows = []
+    for scene in scenes:
+        path = scene['path']
+        print("scaling: "+str(scene['size'])+" x "+str(scene['size'])+" pixels")
+        wall, rss, doc = run_driver(scene, path, os.path.join(path, 'run'), [], args.otb)
+        segments = step_values(doc, 'classifier predict', 'segments')
+        row = {'size': scene['size'], 'pixels': scene['size'] ** 2,
+               'segments': segments[0] if segments else None,
+               'wall_s': round(wall, 3), 'peak_rss_mb': round(rss, 1),
+               'mpixels_per_s': round(scene['size'] ** 2 / wall / 1e6, 4)}
+        for stage in STAGES:
+            times = [s['wall_s'] for s in doc['steps'] if s['step'] == stage]
+            row[stage+'_s'] = times[0] if times else None
+        rows.append(row)
+        print("scaling: "+json.dumps(row))
+    return rows
+
+def cores(scene, args):
+    """GLCM, zonal statistics and random forest of a scene per core count
+
+    Uses the feature rasters and segmentation of the scaling run.
+    """
+    import geopandas as gpd
+    from osgeo import gdal
+    from glcm import glcm_features
+    from zonal import zonal_stats_table
+    from classifier import Classifier
+    from detection import PREDICTORS
+
+    run = os.path.join(scene['path'], 'run')
+    tag = scene['image'].split('.')[0]
+    rasters = {k: (os.path.join(run, f+tag+'.tif'), ['mean'])
+               for k, f in (('bright', 'bright_'), ('ndvi', 'ndvi_'), ('slope', 'slope_'),
+                            ('glcmhomog', 'homog_'), ('glcmmean', 'mean_'))}
+    geoms = list(gpd.read_file(os.path.join(run, tag+'.gpkg')).geometry)
+    training = gpd.read_file(os.path.join(run, 'training_'+tag+'.gpkg'))
+    x = training[PREDICTORS].values
+    y = training['landslide'].values
+
+    image = os.path.join(scene['path'], scene['image'])
+    vmax = int(gdal.Open(image).GetRasterBand(3).ComputeRasterMinMax(False)[1])
+    tmp = os.path.join(scene['path'], 'cores')
+    os.makedirs(tmp, exist_ok=True)
+    rows = []
+    for c in args.cores:
+        row = {'size': scene['size'], 'cores': c, 'segments': len(geoms)}
+        start = time.perf_counter()
+        glcm_features(image, 3, os.path.join(tmp, 'mean.tif'), os.path.join(tmp, 'homog.tif'),
+                      0, vmax, cores=c)
+        row['glcm_s'] = round(time.perf_counter() - start, 3)
+        start = time.perf_counter()
+        zonal_stats_table(geoms, rasters, cores=c)
+        row['zonal_s'] = round(time.perf_counter() - start, 3)
+        clf = Classifier('rf', scene['trees'], jobs=c).fit(x, y)
+        clf.predict(np.repeat(x, max(1, len(geoms) // max(1, len(x))), axis=0))
+        row['fit_s'] = round(clf.timings['fit'], 3)
+        row['predict_s'] = round(clf.timings['predict'], 3)
+        rows.append(row)
+        print("cores: "+json.dumps(row))
+    shutil.rmtree(tmp)
+    return rows
+
+def brute_glcm(band, ys, xs, vmin, vmax, nbins=32, rad=3):
+    """GLCM mean and homogeneity at pixels (ys, xs) from explicit matrices
+
+    For every pixel and direction, the symmetric co-occurrence matrix of
+    the pairs whose origin lies in the (2*rad+1) window is built entry by
+    entry, normalized, and reduced to sum(i * p(i,j)) and
+    sum(p(i,j) / (1 + (i-j)^2)); the results are averaged over the four
+    directions. Independent of the window sums of glcm.py, which the
+    OTB stand-in also uses.
+    """
+    from glcm import GLCM_DIRECTIONS
+    arr = band.astype(np.float64)
+    q = np.clip(np.floor((arr - vmin) * nbins / float(max(vmax - vmin, 1))), 0, nbins - 1)
+    q = q.astype(np.int64)
+    q[(arr < vmin) | (arr > vmax)] = -1
+    rows, cols = q.shape
+    i, j = np.mgrid[0:nbins, 0:nbins]
+    mean = np.zeros(len(ys))
+    homog = np.zeros(len(ys))
+    for n, (y, x) in enumerate(zip(ys, xs)):
+        for xoff, yoff, _ in GLCM_DIRECTIONS:
+            P = np.zeros((nbins, nbins))
+            for cy in range(max(0, y - rad), min(rows, y + rad + 1)):
+                for cx in range(max(0, x - rad), min(cols, x + rad + 1)):
+                    py, px = cy + yoff, cx + xoff
+                    if 0 <= py < rows and 0 <= px < cols and q[cy, cx] >= 0 and q[py, px] >= 0:
+                        P[q[cy, cx], q[py, px]] += 1
+                        P[q[py, px], q[cy, cx]] += 1
+            if P.sum() > 0:
+                P /= P.sum()
+                mean[n] += (i * P).sum() / len(GLCM_DIRECTIONS)
+                homog[n] += (P / (1.0 + (i - j) ** 2)).sum() / len(GLCM_DIRECTIONS)
+    return mean, homog
+
+def glcm_checks(scene, runs):
+    """Texture rasters of the runs against brute-force GLCM at sample pixels"""
+    from osgeo import gdal
+    img = gdal.Open(os.path.join(scene['path'], scene['image']))
+    band = img.GetRasterBand(3).ReadAsArray()
+    img = None
+    rng = np.random.default_rng(scene['seed'])
+    ys = rng.integers(0, band.shape[0], GLCM_SAMPLES)
+    xs = rng.integers(0, band.shape[1], GLCM_SAMPLES)
+    # the range PreProcessing quantizes the band to
+    expected = dict(zip(('mean_', 'homog_'), brute_glcm(band, ys, xs, 0, int(band.max()))))
+    tag = scene['image'].split('.')[0]
+    rows = []
+    for name, run in runs:
+        for f, ref in expected.items():
+            ds = gdal.Open(os.path.join(run, f+tag+'.tif'))
+            got = ds.GetRasterBand(1).ReadAsArray()[ys, xs].astype(np.float64)
+            ds = None
+            corr = float(np.corrcoef(ref, got)[0, 1])
+            rows.append({'check': f+tag+'.tif brute force, '+name, 'value': round(corr, 6),
+                         'detail': 'max abs diff {:.4g} at {} pixels'.format(
+                             float(np.abs(ref - got).max()), GLCM_SAMPLES),
+                         'pass': corr >= RASTER_CORRELATION})
+    return rows
+
+def map_iou(file1, file2):
+    import geopandas as gpd
+    a = gpd.read_file(file1).geometry.unary_union
+    b = gpd.read_file(file2).geometry.unary_union
+    union = a.union(b).area
+    return a.intersection(b).area / union if union > 0 else 1.0
+
+def checks(scene, args):
+    """Compare the outputs of the reference and of the faster paths"""
+    from glcm import compare_rasters
+    import geopandas as gpd
+
+    ref = os.path.join(scene['path'], 'run')
+    fast = os.path.join(scene['path'], 'fast')
+    print("checks: "+' '.join(FAST_OPTIONS))
+    run_driver(scene, scene['path'], fast, FAST_OPTIONS, args.otb)
+    tag = scene['image'].split('.')[0]
+    rows = []
+    for f in ('homog_', 'mean_', 'slope_', 'bright_', 'ndvi_'):
+        res = compare_rasters(os.path.join(ref, f+tag+'.tif'), os.path.join(fast, f+tag+'.tif'))
+        detail = 'max abs diff {:.4g}'.format(res['max_abs_diff'])
+        if f in ('homog_', 'mean_') and otb_path(args.otb):
+            detail += ', the OTB stand-in and -g native share the GLCM engine'
+        rows.append({'check': f+tag+'.tif', 'value': round(res['correlation'], 6),
+                     'detail': detail, 'pass': res['correlation'] >= RASTER_CORRELATION})
+    # both GLCM engines against the definition
+    rows.extend(glcm_checks(scene, [('reference', ref), ('fast', fast)]))
+
+    hr = []
+    for run in (ref, fast):
+        with open(os.path.join(run, 'salad_run.json')) as fd:
+            hr.append(json.load(fd)['radius']['meta']['hr'])
+    rows.append({'check': 'hr', 'value': hr[1], 'detail': 'reference '+str(hr[0]),
+                 'pass': hr[0] == hr[1]})
+
+    labels = [gpd.read_file(os.path.join(run, 'training_'+tag+'.gpkg'))['landslide'] for run in (ref, fast)]
+    rows.append({'check': 'training landslides', 'value': int(labels[1].sum()),
+                 'detail': 'reference '+str(int(labels[0].sum()))+' of '+str(len(labels[0]))+
+                           ' segments, '+str(len(labels[1]))+' segments',
+                 'pass': len(labels[0]) == len(labels[1]) and
+                         abs(int(labels[0].sum()) - int(labels[1].sum())) <= 0.05 * max(1, labels[0].sum())})
+
+    iou = map_iou(os.path.join(ref, 'result.shp'), os.path.join(fast, 'result.shp'))
+    rows.append({'check': 'landslide map IoU', 'value': round(iou, 4), 'detail': '',
+                 'pass': iou >= MAP_IOU})
+    for row in rows:
+        print("checks: "+json.dumps(row))
+    return rows
+
+def write_csv(filename, rows):
+    if not rows:
+        return
+    with open(filename, 'w', newline='') as fd:
+        writer = csv.DictWriter(fd, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='SALaD benchmarks on synthetic scenes')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[512, 1024],
+        help='scene sizes in pixels, the scenes are square')
+    parser.add_argument('-c', '--cores', type=int, nargs='+', default=[1, 2, 4],
+        help='core counts of the GLCM, zonal statistics and random forest benchmark')
+    parser.add_argument('-op', '--outpath', default='salad_bench',
+        help='location of the scenes, runs and results')
+    parser.add_argument('-sd', '--seed', type=int, default=0,
+        help='seed of the synthetic scenes')
+    parser.add_argument('-ls', '--landslides', type=int,
+        help='number of landslides per scene, by default one per 40000 pixels')
+    parser.add_argument('-rmi', '--hr_min', type=int, default=20,
+        help='minimum range radius for POF')
+    parser.add_argument('-rma', '--hr_max', type=int, default=60,
+        help='maximum range radius for POF')
+    parser.add_argument('-st', '--step', type=int, default=20,
+        help='step size for POF')
+    parser.add_argument('-t', '--tree', type=int, default=100,
+        help='number of trees of the random forest')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=['cores', 'checks'],
+        default=['cores', 'checks'], help='benchmarks to run after the scaling runs, which they use')
+    parser.add_argument('-otb', '--otb', choices=['auto', 'standin', 'installed'], default='auto',
+        help='OTB bindings: installed if importable, else the stand-in ("auto"), or either one')
+    args = parser.parse_args()
+
+    os.makedirs(args.outpath, exist_ok=True)
+    scenes = []
+    for size in sorted(args.sizes):
+        path = os.path.abspath(os.path.join(args.outpath, 'scene_'+str(size)))
+        scene = make_scene(path, size, seed=args.seed, landslides=args.landslides)
+        scene.update({'path': path, 'hr_min': args.hr_min, 'hr_max': args.hr_max,
+                      'step': args.step, 'spatialr': 5, 'objectsize': 10, 'trees': args.tree})
+        scenes.append(scene)
+        print("Scene "+str(size)+": "+str(scene['blobs'])+" landslides, "+
+              str(scene['manual'])+" in the training area")
+
+    results = {'otb': 'installed' if not otb_path(args.otb) else 'standin',
+               'cpus': os.cpu_count(), 'scenes': scenes}
+    results['scaling'] = scaling(scenes, args)
+    write_csv(os.path.join(args.outpath, 'scaling.csv'), results['scaling'])
+    if 'cores' in args.benchmarks:
+        results['cores'] = cores(scenes[-1], args)
+        write_csv(os.path.join(args.outpath, 'cores.csv'), results['cores'])
+    if 'checks' in args.benchmarks:
+        results['checks'] = checks(scenes[0], args)
+        write_csv(os.path.join(args.outpath, 'checks.csv'), results['checks'])
+
+    with open(os.path.join(args.outpath, 'benchmark.json'), 'w') as fd:
+        json.dump(results, fd, indent=2, default=str)
+    print("Benchmark results written to "+str(args.outpath))
+    if not all(r['pass'] for r in results.get('checks', [])):
+        print("Some output-equivalence checks failed")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
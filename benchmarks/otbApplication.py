@@ -0,0 +1,163 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+"""Stand-in for the otbApplication module of the Orfeo Toolbox
+
+Implements the applications otbApp.py calls, with the same parameter
+names, so that the SALaD stages run on a plain Linux host with GDAL but
+without OTB. The results are representative in size and structure, not
+identical to OTB:
+
+- HaralickTextureExtraction computes the GLCM mean (band 1 of 'advanced')
+  and homogeneity (band 4 of 'simple') with the NumPy engine of glcm.py;
+  the other texture bands are zero.
+- MeanShiftSmoothing is a box filter of 2*spatialr+1 pixels on every band.
+- LSMSSegmentation labels the 4-connected regions of equal smoothed
+  values quantized by ranger.
+- LSMSSmallRegionsMerging gives the pixels of regions smaller than minsize
+  the label of the nearest larger region and renumbers labels from 1.
+- ExtractROI selects channels and a window of a connected image.
+
+Put the benchmarks directory first on PYTHONPATH to use it.
+"""
+
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage, sparse
+from scipy.sparse.csgraph import connected_components
+from glcm import quantize, glcm_mean_homog
+
+# number of output bands of the Haralick texture sets
+TEXTURE_BANDS = {'simple': 8, 'advanced': 10, 'higher': 11}
+
+class _Application(object):
+    """Parameters, connected inputs and in-memory outputs of an application"""
+
+    def __init__(self, name):
+        self.name = name
+        self.params = {}
+        self.inputs = {}
+        self.outputs = {}
+
+    def SetParameterString(self, key, value):
+        self.params[key] = value
+
+    def SetParameterInt(self, key, value):
+        self.params[key] = int(value)
+
+    def SetParameterFloat(self, key, value):
+        self.params[key] = float(value)
+
+    def SetParameterStringList(self, key, value):
+        self.params[key] = list(value)
+
+    def ConnectImage(self, key, app, output):
+        self.inputs[key] = (app, output)
+
+    def UpdateParameters(self):
+        pass
+
+    def _image(self, key):
+        """Input image as a (rows, cols, bands) float array and its georeferencing"""
+        if key in self.inputs:
+            app, output = self.inputs[key]
+            return app.outputs[output]
+        ds = gdal.Open(self.params[key])
+        if ds is None:
+            raise RuntimeError('Unable to open '+str(self.params[key]))
+        arr = np.dstack([ds.GetRasterBand(b + 1).ReadAsArray().astype(np.float32)
+                         for b in range(ds.RasterCount)])
+        return arr, ds.GetGeoTransform(), ds.GetProjection()
+
+    def Execute(self):
+        getattr(self, '_'+self.name)()
+
+    def ExecuteAndWriteOutput(self):
+        self.Execute()
+        arr, geo, proj = self.outputs['out']
+        gdaltype = gdal.GDT_UInt32 if arr.dtype == np.uint32 else gdal.GDT_Float32
+        out = gdal.GetDriverByName("GTiff").Create(self.params['out'], arr.shape[1],
+                                                   arr.shape[0], arr.shape[2], gdaltype)
+        out.SetGeoTransform(geo)
+        out.SetProjection(proj)
+        for b in range(arr.shape[2]):
+            out.GetRasterBand(b + 1).WriteArray(arr[:, :, b])
+        out = None
+
+    def GetVectorImageAsNumpyArray(self, key, dtype='float'):
+        return self.outputs[key][0].astype(np.float32)
+
+    def _HaralickTextureExtraction(self):
+        img, geo, proj = self._image('in')
+        q = quantize(img[:, :, self.params.get('channel', 1) - 1],
+                     self.params['parameters.min'], self.params['parameters.max'],
+                     self.params['parameters.nbbin'])
+        mean, homog = glcm_mean_homog(q, self.params['parameters.xoff'],
+                                      self.params['parameters.yoff'],
+                                      self.params['parameters.xrad'])
+        texture = self.params.get('texture', 'simple')
+        out = np.zeros(q.shape + (TEXTURE_BANDS[texture],), dtype=np.float32)
+        if texture == 'advanced':
+            out[:, :, 0] = mean
+        elif texture == 'simple':
+            out[:, :, 3] = homog
+        self.outputs['out'] = (out, geo, proj)
+
+    def _ExtractROI(self):
+        img, geo, proj = self._image('in')
+        channels = [int(c.replace('Channel', '')) - 1
+                    for c in self.params.get('cl', [])] or list(range(img.shape[2]))
+        x = self.params.get('startx', 0)
+        y = self.params.get('starty', 0)
+        w = self.params.get('sizex', img.shape[1] - x)
+        h = self.params.get('sizey', img.shape[0] - y)
+        geo = (geo[0] + x * geo[1], geo[1], geo[2], geo[3] + y * geo[5], geo[4], geo[5])
+        self.outputs['out'] = (img[y:y+h, x:x+w][:, :, channels], geo, proj)
+
+    def _MeanShiftSmoothing(self):
+        img, geo, proj = self._image('in')
+        size = 2 * self.params.get('spatialr', 5) + 1
+        out = np.empty_like(img)
+        for b in range(img.shape[2]):
+            out[:, :, b] = ndimage.uniform_filter(img[:, :, b], size=size)
+        self.outputs['fout'] = (out, geo, proj)
+
+    def _LSMSSegmentation(self):
+        img, geo, proj = self._image('in')
+        ranger = max(self.params.get('ranger', 15.0), 1e-6)
+        q = np.floor(img / ranger).astype(np.int64)
+        rows, cols, bands = q.shape
+        same_x = np.all(q[:, 1:] == q[:, :-1], axis=2)
+        same_y = np.all(q[1:, :] == q[:-1, :], axis=2)
+        idx = np.arange(rows * cols).reshape(rows, cols)
+        src = np.concatenate([idx[:, 1:][same_x], idx[1:, :][same_y]])
+        dst = np.concatenate([idx[:, :-1][same_x], idx[:-1, :][same_y]])
+        graph = sparse.coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)),
+                                  shape=(rows * cols, rows * cols))
+        _, labels = connected_components(graph, directed=False)
+        labels = (labels + 1).reshape(rows, cols).astype(np.uint32)
+        self.outputs['out'] = (labels[:, :, None], geo, proj)
+
+    def _LSMSSmallRegionsMerging(self):
+        seg, geo, proj = self.inputs['inseg'][0].outputs[self.inputs['inseg'][1]]
+        labels = seg[:, :, 0].astype(np.int64)
+        counts = np.bincount(labels.ravel())
+        small = counts[labels] < self.params.get('minsize', 10)
+        if small.all():
+            labels[:] = 1
+        elif small.any():
+            # nearest pixel of a region that is large enough
+            _, (iy, ix) = ndimage.distance_transform_edt(small, return_indices=True)
+            labels = labels[iy, ix]
+        _, labels = np.unique(labels, return_inverse=True)
+        labels = (labels.reshape(seg.shape[:2]) + 1).astype(np.uint32)
+        self.outputs['out'] = (labels[:, :, None], geo, proj)
+
+class Registry(object):
+
+    @staticmethod
+    def CreateApplication(name):
+        if not hasattr(_Application, '_'+name):
+            return None
+        return _Application(name)
@@ -0,0 +1,116 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import numpy as np
+import geopandas as gpd
+from osgeo import gdal, osr
+from scipy import ndimage
+from shapely.geometry import Point
+from shapely import affinity
+
+# UTM 45N, 3 m pixels
+EPSG = 32645
+PIXEL = 3.0
+ORIGIN = (300000.0, 3110000.0)
+
+def _field(rng, shape, sigma):
+    """Smooth random field scaled to [0, 1]"""
+    f = ndimage.gaussian_filter(rng.standard_normal(shape).astype(np.float32), sigma)
+    return (f - f.min()) / max(float(np.ptp(f)), 1e-6)
+
+def _write(filename, arrays, gdaltype, geo, srs):
+    out = gdal.GetDriverByName("GTiff").Create(filename, arrays[0].shape[1], arrays[0].shape[0],
+                                               len(arrays), gdaltype)
+    out.SetGeoTransform(geo)
+    out.SetProjection(srs.ExportToWkt())
+    for b, arr in enumerate(arrays):
+        out.GetRasterBand(b + 1).WriteArray(arr)
+    out = None
+
+def landslide_blobs(rng, size, count):
+    """Random elongated ellipses in pixel coordinates, (x, y, a, b, angle)"""
+    x = rng.uniform(0.05, 0.95, count) * size
+    y = rng.uniform(0.05, 0.95, count) * size
+    a = rng.uniform(0.008, 0.03, count) * size + 4
+    b = a * rng.uniform(0.3, 0.7, count)
+    angle = rng.uniform(0, 180, count)
+    return list(zip(x, y, a, b, angle))
+
+def make_scene(outPath, size, seed=0, landslides=None, tag=None):
+    """Write a synthetic scene: 5-band image, DEM and manual landslides
+
+    The image is size x size uint16 pixels with bands blue, green, red,
+    red edge and NIR over smooth vegetated terrain; landslides are bright
+    bare soil ellipses with low NIR cut into the DEM. The manual landslide
+    shapefile holds the landslides inside the training area, the upper
+    left quarter of the scene. Returns the file names, relative to outPath,
+    and the training area.
+    """
+    rng = np.random.default_rng(seed)
+    tag = tag or 'synth'+str(size)
+    count = landslides or max(4, size * size // 40000)
+    os.makedirs(outPath, exist_ok=True)
+
+    geo = (ORIGIN[0], PIXEL, 0.0, ORIGIN[1], 0.0, -PIXEL)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    shape = (size, size)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    dem = (1500 + 800 * yy + 300 * np.sin(6 * xx) * np.cos(4 * yy) +
+           200 * _field(rng, shape, size / 16.0)).astype(np.float32)
+
+    blobs = landslide_blobs(rng, size, count)
+    mask = np.zeros(shape, dtype=bool)
+    polygons = []
+    for x, y, a, b, angle in blobs:
+        # window around the blob
+        y0, y1 = max(0, int(y - a) - 1), min(size, int(y + a) + 2)
+        x0, x1 = max(0, int(x - a) - 1), min(size, int(x + a) + 2)
+        dy, dx = np.mgrid[y0:y1, x0:x1].astype(np.float32)
+        dx, dy = dx - x, dy - y
+        t = np.deg2rad(angle)
+        u = (dx * np.cos(t) + dy * np.sin(t)) / a
+        v = (-dx * np.sin(t) + dy * np.cos(t)) / b
+        mask[y0:y1, x0:x1] |= u * u + v * v <= 1.0
+        ellipse = affinity.scale(Point(x + 0.5, y + 0.5).buffer(1.0, 32), a, b)
+        ellipse = affinity.rotate(ellipse, angle, origin=(x + 0.5, y + 0.5))
+        polygons.append(affinity.affine_transform(ellipse, [PIXEL, 0, 0, -PIXEL,
+                                                            ORIGIN[0], ORIGIN[1]]))
+    # landslide scars cut into the slope
+    dem -= 15 * ndimage.gaussian_filter(mask.astype(np.float32), 3)
+
+    veg = _field(rng, shape, 8.0)
+    noise = lambda s: rng.normal(0, s, shape).astype(np.float32)
+    blue = 300 + 150 * veg + noise(20)
+    green = 450 + 200 * veg + noise(20)
+    red = 350 + 150 * (1 - veg) + noise(20)
+    edge = 1200 + 400 * veg + noise(30)
+    nir = 2000 + 1200 * veg + noise(40)
+    soil = _field(rng, shape, 2.0)
+    blue[mask] = 900 + 200 * soil[mask]
+    green[mask] = 1000 + 200 * soil[mask]
+    red[mask] = 1100 + 250 * soil[mask]
+    edge[mask] = 1300 + 200 * soil[mask]
+    nir[mask] = 1500 + 250 * soil[mask]
+    bands = [np.clip(b, 1, 65535).astype(np.uint16) for b in (blue, green, red, edge, nir)]
+
+    image = tag+'.tif'
+    dem_file = 'dem_'+tag+'.tif'
+    _write(os.path.join(outPath, image), bands, gdal.GDT_UInt16, geo, srs)
+    _write(os.path.join(outPath, dem_file), [dem], gdal.GDT_Float32, geo, srs)
+
+    half = size // 2 * PIXEL
+    area = {'ulx': ORIGIN[0], 'uly': ORIGIN[1], 'lrx': ORIGIN[0] + half, 'lry': ORIGIN[1] - half}
+    inside = [p for p in polygons if p.bounds[0] >= area['ulx'] and p.bounds[2] <= area['lrx']
+              and p.bounds[1] >= area['lry'] and p.bounds[3] <= area['uly']]
+    manual = 'manual_'+tag+'.shp'
+    gpd.GeoDataFrame({'id': np.arange(len(inside))}, geometry=inside,
+                     crs='EPSG:'+str(EPSG)).to_file(os.path.join(outPath, manual))
+
+    scene = {'image': image, 'dem': dem_file, 'landslides': manual, 'size': size,
+             'seed': seed, 'blobs': count, 'manual': len(inside)}
+    scene.update(area)
+    return scene
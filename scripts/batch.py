@@ -0,0 +1,153 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import sys
+import os
+import csv
+import copy
+from functools import partial
+from otbApp import otbApp, budget
+from driver import STAGES, buildParser, run_scene
+from scheduler import Scheduler, Task
+import report
+
+# relative duration of the stages, to start long paths of the batch first
+STAGE_COST = {'preprocessing': 2.0, 'radius': 4.0, 'segmentation': 4.0,
+              'training': 1.0, 'detection': 2.0}
+
+def run_stage(args, stage, upstream=None, tokens=None):
+    """Run one stage of one scene in a scheduler worker"""
+    res = run_scene(args, only=[stage], upstream=list((upstream or {}).values()),
+                    zonalCores=(tokens or {}).get('zonal'))[stage]
+    res['report'] = report.collect()
+    return res
+
+def set_budget(ram, threads, tokens):
+    """Give a stage running OTB its share of the OTB memory and threads"""
+    if tokens.get('otb'):
+        otbApp.setBudget(ram, threads)
+
+def read_manifest(manifest):
+    """Scenes of a batch from a CSV file
+
+    The columns are image and dem, and optionally landslides, ulx, uly,
+    lrx, lry and result. Scenes with landslides and a training area train
+    their own model, the others share the training set of a scene that
+    does.
+    """
+    scenes = []
+    with open(manifest, newline='') as fd:
+        for row in csv.DictReader(fd):
+            row = {k.strip(): (v or '').strip() for k, v in row.items()}
+            if not row.get('image') or not row.get('dem'):
+                raise RuntimeError('Every scene of '+str(manifest)+' needs an image and a DEM')
+            scene = {'image': row['image'], 'dem': row['dem'],
+                     'landslides': row.get('landslides') or None,
+                     'result': row.get('result') or None}
+            for c in ('ulx', 'uly', 'lrx', 'lry'):
+                scene[c] = float(row[c]) if row.get(c) else None
+            scenes.append(scene)
+    return scenes
+
+def scene_args(args, scene, outpath):
+    """Driver arguments of one scene of the batch"""
+    sargs = copy.copy(args)
+    for k, v in scene.items():
+        if v is not None or k in ('landslides', 'result'):
+            setattr(sargs, k, v)
+    sargs.outpath = outpath
+    return sargs
+
+def main():
+    parser = buildParser()
+    parser.description = 'SALaD batch mode'
+    parser.add_argument('-mf', '--manifest', required=True,
+        help='CSV file of the scenes with columns image, dem and optionally landslides, ulx, uly, lrx, lry, result')
+    parser.add_argument('-ts', '--trainscene',
+        help='image of the scene whose training set the scenes without landslides share, by default the first scene with landslides')
+    parser.add_argument('-oj', '--otbjobs', type=int, default=2,
+        help='number of OTB stages (GLCM, LSMS) running concurrently across the batch')
+    parser.add_argument('-zw', '--zonalworkers', type=int,
+        help='number of zonal_stats workers across the batch, by default one per CPU')
+    parser.add_argument('-bw', '--batchworkers', type=int,
+        help='number of stages running concurrently across the batch, by default one per CPU')
+    args = parser.parse_args()
+
+    output_path = args.outpath or os.getcwd()
+    scenes = read_manifest(args.manifest)
+    tags = [s['image'].split('.')[0] for s in scenes]
+    if len(set(tags)) != len(tags):
+        raise RuntimeError('Scene images of a batch must have distinct names')
+
+    trainers = [t for t, s in zip(tags, scenes) if s['landslides']]
+    shared = None
+    if args.model:
+        # predict-only, every scene is mapped with the saved model
+        trainers = []
+    elif args.trainscene:
+        shared = args.trainscene.split('.')[0]
+        if shared not in trainers:
+            raise RuntimeError(str(args.trainscene)+' is not a scene with landslides')
+    elif trainers:
+        shared = trainers[0]
+    else:
+        raise RuntimeError('At least one scene needs manual landslides')
+
+    zonal_workers = args.zonalworkers or os.cpu_count()
+    # zonal_stats workers of one stage, so that OTB jobs can overlap zonal passes
+    zonal_share = max(1, zonal_workers // max(1, args.otbjobs))
+    resources = {'preprocessing': {'otb': 1},
+                 'radius': {'otb': 1, 'zonal': zonal_share},
+                 'segmentation': {'otb': 1, 'zonal': zonal_share},
+                 'training': {'zonal': zonal_share},
+                 'detection': {'zonal': zonal_share}}
+
+    # shares of the memory available now, before the stages allocate any
+    ram, threads = budget(args.otbjobs)
+    print("OTB budget: "+str(args.otbjobs)+" jobs of "+str(ram)+" MB and "+
+          str(threads)+" threads")
+    scheduler = Scheduler({'otb': args.otbjobs, 'zonal': zonal_workers},
+                          workers=args.batchworkers,
+                          initializer=partial(set_budget, ram, threads))
+    for tag, scene in zip(tags, scenes):
+        outpath = os.path.join(output_path, tag)
+        os.makedirs(outpath, exist_ok=True)
+        sargs = scene_args(args, scene, outpath)
+        # the radius and training set come from the scene itself or the shared scene
+        trainer = tag if scene['landslides'] or args.model else shared
+        deps = {'preprocessing': [],
+                'radius': [tag+':preprocessing'],
+                'segmentation': [tag+':preprocessing', trainer+':radius'],
+                'training': [tag+':preprocessing', tag+':radius'],
+                # the radius records the hr with the saved model
+                'detection': [tag+':preprocessing', tag+':segmentation',
+                              trainer+':radius', trainer+':training']}
+        if args.model:
+            deps['segmentation'] = [tag+':preprocessing']
+            deps['detection'] = [tag+':preprocessing', tag+':segmentation']
+        for stage in STAGES:
+            if (args.model or trainer != tag) and stage in ('radius', 'training'):
+                continue
+            scheduler.add(Task(tag+':'+stage, run_stage, args=(sargs, stage),
+                               deps=deps[stage], resources=resources[stage],
+                               cost=STAGE_COST[stage]))
+
+    print("Running "+str(len(scenes))+" scenes, "+str(len(trainers))+" with their own training set")
+    try:
+        scheduler.run()
+    finally:
+        if args.report:
+            # results of the tasks that completed, also when others failed
+            for name in sorted(scheduler.results):
+                report.merge(scheduler.results[name].get('report', []),
+                             prefix=name.split(':')[0])
+            report.write(args.report, scenes=tags, args=vars(args),
+                         scheduler=scheduler.report, otb_jobs=args.otbjobs,
+                         otb_ram_mb=ram, otb_threads=threads,
+                         zonal_workers=zonal_workers)
+    print("SALaD batch Completed")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
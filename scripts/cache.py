@@ -0,0 +1,232 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import json
+import shutil
+import fcntl
+import hashlib
+import report
+
+# files of a shapefile, hashed and stored together
+SHAPEFILE_SIDECARS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+# digests by (path, size, mtime), files are hashed once per process
+_digests = {}
+
+def shapefile_files(path):
+    """The files of a shapefile that exist, or [path] for other files"""
+    if not path.lower().endswith('.shp'):
+        return [path]
+    stem = os.path.splitext(path)[0]
+    return [stem+ext for ext in SHAPEFILE_SIDECARS if os.path.isfile(stem+ext)]
+
+def file_digest(path):
+    """sha256 of a file, or of a shapefile and its sidecar files"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime)
+    if memo_key not in _digests:
+        files = shapefile_files(path)
+        h = hashlib.sha256()
+        for f in files:
+            h.update(os.path.basename(f).encode())
+            with open(f, 'rb') as fd:
+                for block in iter(lambda: fd.read(1 << 20), b''):
+                    h.update(block)
+        _digests[memo_key] = h.hexdigest()
+    return _digests[memo_key]
+
+def stage_key(stage, inputs=(), deps=(), params=None):
+    """Key of a stage from its input files, upstream keys and parameters"""
+    h = hashlib.sha256()
+    h.update(stage.encode())
+    for f in inputs:
+        h.update(file_digest(f).encode())
+    for k in deps:
+        h.update(k.encode())
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:24]
+
+def expand(paths):
+    """Output paths with shapefile sidecar files"""
+    files = []
+    for p in paths:
+        files.extend(shapefile_files(p))
+    return files
+
+def output_names(paths):
+    """Output paths by file name, with the sidecar files a shapefile may have"""
+    names = {}
+    for p in paths:
+        p = os.path.abspath(p)
+        if p.lower().endswith('.shp'):
+            stem = os.path.splitext(p)[0]
+            for ext in SHAPEFILE_SIDECARS:
+                names[os.path.basename(stem+ext)] = stem+ext
+        else:
+            names[os.path.basename(p)] = p
+    return names
+
+class ArtifactCache(object):
+    """Content-addressed store of stage outputs
+
+    Outputs of a stage are copied to <root>/<stage>/<key>/ together with a
+    manifest of their original paths and the stage metadata, e.g. the
+    selected hr. Copies, not links, so that later rewrites of an output
+    in place cannot alter the cache. The key does not cover where the
+    outputs are written, so they are restored by file name to the output
+    paths of the run restoring them.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def restore(self, stage, key, paths):
+        """Copy cached outputs to the output paths of this run, None on a miss
+
+        paths are the outputs of the stage, or a function of the stage
+        metadata returning them; cached files are matched to them by name.
+        Metadata naming a cached output is updated to its restored path.
+        """
+        manifest = os.path.join(self._dir(stage, key), 'manifest.json')
+        if not os.path.isfile(manifest):
+            return None
+        with open(manifest) as fd:
+            entry = json.load(fd)
+        if callable(paths):
+            paths = paths(entry['meta'])
+        targets = output_names(paths)
+        if not all(name in targets for name in entry['files']):
+            return None
+        for name in entry['files']:
+            shutil.copy2(os.path.join(self._dir(stage, key), name), targets[name])
+        moved = {path: targets[name] for name, path in entry['files'].items()}
+        entry['meta'] = {k: moved.get(v, v) if isinstance(v, str) else v
+                         for k, v in entry['meta'].items()}
+        entry['files'] = {name: targets[name] for name in entry['files']}
+        return entry
+
+    def store(self, stage, key, paths, meta):
+        """Copy the outputs of a stage into the cache"""
+        d = self._dir(stage, key)
+        tmp = d+'.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        files = {}
+        for path in expand(paths):
+            name = os.path.basename(path)
+            shutil.copy2(path, os.path.join(tmp, name))
+            files[name] = os.path.abspath(path)
+        entry = {'stage': stage, 'key': key, 'files': files, 'meta': meta}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as fd:
+            json.dump(entry, fd, indent=2)
+        # publish the entry only once it is complete
+        shutil.rmtree(d, ignore_errors=True)
+        os.rename(tmp, d)
+        return entry
+
+class RunJournal(object):
+    """Stages completed by the last run in an output directory"""
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if os.path.isfile(path):
+            with open(path) as fd:
+                self.stages = json.load(fd)
+
+    def completed(self, stage, key):
+        """Entry of a completed stage whose key and outputs are unchanged"""
+        entry = self.stages.get(stage)
+        if entry is None or entry['key'] != key:
+            return None
+        if not all(os.path.exists(p) for p in entry['files'].values()):
+            return None
+        return entry
+
+    def record(self, stage, key, paths, meta):
+        """Mark a stage completed with the given outputs
+
+        Stages of a scene may run in separate processes, so the journal is
+        re-read and updated under a lock.
+        """
+        files = {os.path.basename(p): os.path.abspath(p) for p in expand(paths)}
+        with open(self.path+'.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(self.path):
+                with open(self.path) as fd:
+                    self.stages = json.load(fd)
+            self.stages[stage] = {'key': key, 'files': files, 'meta': meta}
+            tmp = self.path+'.tmp'
+            with open(tmp, 'w') as fd:
+                json.dump(self.stages, fd, indent=2)
+            os.replace(tmp, self.path)
+
+class StageCache(object):
+    """Cache lookup and store around the stages of a scene
+
+    Every stage has a key hashing its input files, the keys of the stages
+    it depends on and its parameters. With an ArtifactCache the outputs of
+    a stage are stored under that key and restored instead of recomputed;
+    with resume a stage whose key and outputs are recorded in the run
+    journal is skipped. Stages may run in separate processes, add passes
+    the keys and metadata of those a stage depends on.
+    """
+
+    def __init__(self, scene, journal, cache=None, resume=False):
+        self.scene = scene
+        self.journal = journal
+        self.cache = cache
+        self.resume = resume
+        self.keys = {}
+        self.meta = {}
+        self.results = {}
+
+    def add(self, results):
+        """Keys and metadata of stages run before, e.g. in another process"""
+        for res in results:
+            self.keys[res['stage']] = res['key']
+            self.meta[res['stage']] = res['meta']
+
+    def run(self, name, func, outputs, inputs=(), deps=(), params=None):
+        """Run a stage unless its outputs for the same key are available
+
+        func runs the stage and returns its metadata, a dict; outputs is the
+        list of output files, or a function of the metadata returning it.
+        Returns the stage name, key and metadata.
+        """
+        with report.step(name, scene=self.scene):
+            key = stage_key(name, inputs, [self.keys[d] for d in deps], params)
+            # known while the stage runs, e.g. to the tasks it starts
+            self.keys[name] = key
+            source = 'run'
+
+            entry = self.journal.completed(name, key) if self.resume else None
+            if entry is not None:
+                source = 'journal'
+                print(name+": resumed from the run journal, key "+key)
+            elif self.cache is not None:
+                entry = self.cache.restore(name, key, outputs)
+                if entry is not None:
+                    source = 'cache'
+                    print(name+": restored from the cache, key "+key)
+
+            if entry is None:
+                meta = func() or {}
+                files = outputs(meta) if callable(outputs) else outputs
+                if self.cache is not None:
+                    self.cache.store(name, key, files, meta)
+            else:
+                meta = entry['meta']
+                files = list(entry['files'].values())
+            self.journal.record(name, key, files, meta)
+            report.note(key=key, source=source)
+
+        self.meta[name] = meta
+        self.results[name] = {'stage': name, 'key': key, 'meta': meta}
+        return self.results[name]
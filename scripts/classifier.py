@@ -0,0 +1,134 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import time
+import warnings
+import numpy as np
+import report
+from sklearn.ensemble import RandomForestClassifier
+try:
+    from sklearn.ensemble import HistGradientBoostingClassifier
+except ImportError:
+    # scikit-learn < 1.0
+    from sklearn.experimental import enable_hist_gradient_boosting
+    from sklearn.ensemble import HistGradientBoostingClassifier
+
+# classifier engines: random forest, histogram-based gradient boosting
+ENGINES = ('rf', 'hgb')
+
+class Classifier(object):
+    """Landslide classifier with timed fit and chunked float32 prediction
+
+    'rf' is a random forest of trees trees fitted and applied with jobs
+    threads, 'hgb' a histogram-based gradient boosting of at most trees
+    iterations, which bins the predictors and scales to large training
+    sets; it uses the OpenMP threads of scikit-learn. Prediction runs over
+    chunks of chunkRows segments converted to float32 one at a time.
+    """
+
+    def __init__(self, engine='rf', trees=500, jobs=None, chunkRows=262144, model=None):
+        if engine not in ENGINES:
+            raise RuntimeError('Unknown classifier engine: '+str(engine))
+        self.engine = engine
+        self.jobs = jobs or os.cpu_count()
+        self.chunk_rows = chunkRows
+        self.timings = {}
+        # (trees, out-of-bag error) of an automatic forest size search
+        self.oob_curve = []
+        if model is None:
+            if engine == 'rf':
+                model = RandomForestClassifier(trees, n_jobs=self.jobs)
+            else:
+                model = HistGradientBoostingClassifier(max_iter=trees)
+        elif engine == 'rf':
+            model.n_jobs = self.jobs
+        self.model = model
+
+    @report.timed('classifier fit')
+    def fit(self, x, y):
+        x = np.asarray(x, dtype=np.float32)
+        start = time.perf_counter()
+        self.model.fit(x, np.asarray(y))
+        self.timings['fit'] = time.perf_counter() - start
+        report.note(engine=self.engine, samples=len(x), jobs=self.jobs)
+        print("Fitted "+self.engine+" classifier on "+str(len(x))+" samples in "+
+              "{:.2f}s".format(self.timings['fit']))
+        return self
+
+    @report.timed('classifier fit')
+    def fitTrees(self, x, y, maxTrees, step=25, tol=0.002, patience=2):
+        """Grow a random forest until its out-of-bag error plateaus
+
+        Trees are added step at a time with warm_start, recording the OOB
+        error after each step. Growth stops once the last patience steps
+        lowered the error by less than tol, or at maxTrees trees. The
+        forest is then cut to the smallest size whose OOB error is within
+        tol of the lowest one.
+        """
+        if self.engine != 'rf':
+            raise RuntimeError('Automatic forest size needs the random forest engine')
+        x = np.asarray(x, dtype=np.float32)
+        y = np.asarray(y)
+        self.model.set_params(warm_start=True, oob_score=True)
+        self.oob_curve = []
+        start = time.perf_counter()
+        trees = 0
+        while trees < maxTrees:
+            trees = min(trees + step, maxTrees)
+            self.model.set_params(n_estimators=trees)
+            with warnings.catch_warnings():
+                # small forests leave some samples without OOB votes
+                warnings.filterwarnings('ignore', category=UserWarning,
+                                        message='Some inputs do not have OOB')
+                self.model.fit(x, y)
+            self.oob_curve.append((trees, 1.0 - self.model.oob_score_))
+            errors = [e for _, e in self.oob_curve]
+            if len(errors) > patience and min(errors[:-patience]) - min(errors[-patience:]) < tol:
+                break
+        self.timings['fit'] = time.perf_counter() - start
+
+        best = min(e for _, e in self.oob_curve)
+        trees = min(n for n, e in self.oob_curve if e <= best + tol)
+        self.model.estimators_ = self.model.estimators_[:trees]
+        self.model.set_params(n_estimators=trees, warm_start=False)
+        # the OOB score of the kept trees was recorded when they were grown;
+        # the per-sample OOB votes describe the whole forest
+        self.model.oob_score_ = 1.0 - dict(self.oob_curve)[trees]
+        del self.model.oob_decision_function_
+        report.note(engine=self.engine, samples=len(x), jobs=self.jobs, trees=trees,
+                    trees_grown=self.oob_curve[-1][0])
+        print("Selected "+str(trees)+" trees of "+str(self.oob_curve[-1][0])+" grown, "+
+              "OOB error {:.4f}, fitted in {:.2f}s".format(
+                  dict(self.oob_curve)[trees], self.timings['fit']))
+        return self
+
+    @report.timed('classifier predict')
+    def predict(self, x, columns=None):
+        """Predict the rows of x, an array, or a DataFrame with columns
+
+        The columns of a DataFrame are sliced and converted to float32
+        per chunk, without a float64 matrix of the whole frame.
+        """
+        if columns is None:
+            x = np.asarray(x)
+        out = None
+        start = time.perf_counter()
+        for i in range(0, len(x), self.chunk_rows):
+            if columns is None:
+                chunk = x[i:i+self.chunk_rows].astype(np.float32)
+            else:
+                chunk = x.iloc[i:i+self.chunk_rows][columns].to_numpy(np.float32)
+            pred = self.model.predict(chunk)
+            if out is None:
+                out = np.empty(len(x), dtype=pred.dtype)
+            out[i:i+len(pred)] = pred
+        if out is None:
+            out = np.zeros(0, dtype=self.model.classes_.dtype)
+        self.timings['predict'] = time.perf_counter() - start
+        report.note(engine=self.engine, segments=len(x), chunks=-(-len(x) // self.chunk_rows))
+        print("Predicted "+str(len(x))+" segments in "+
+              str(-(-len(x) // self.chunk_rows))+" chunks in "+
+              "{:.2f}s".format(self.timings['predict']))
+        return out
@@ -2,38 +2,154 @@
 #Administrator of the National Aeronautics and Space Administration.
 #All Rights Reserved.
 
-import itertools
-import multiprocessing
-from rasterstats import zonal_stats
-from sklearn.ensemble import RandomForestClassifier
+import sklearn
+import joblib
 import numpy as np
 import os
-import fiona
+import pandas as pd
 import geopandas as gpd
-from functools import partial
+from osgeo import gdal, ogr, osr
+from rasterutil import block_windows, stack_bands
+from zonal import label_zonal_stats, label_values, zonal_stats_table
+from classifier import Classifier
+import report
 
-def chunks(data, n):
-    """Break down polygons into chunks"""
-    for i in range(0, len(data), n):
-        yield data[i:i+n]
+# predictors of the landslide model, computed per segment by Detection.features
+PREDICTORS = ["Meanbright","Meanndvi","Meanslope","glcmhomog","glcmmean"]
 
-def zonal_stats_wrapper(feats, tif, stats):
-    return zonal_stats(feats, tif, stats=stats, nodata=-999)
+# version of the predictor definitions, bumped when their computation changes
+FEATURE_VERSION = 1
 
-def zonal_stats_parallel(features, cores, raster, opr):
-    """Compute zonal_stats in parallel"""
-    p = multiprocessing.Pool(cores)
-    func = partial(zonal_stats_wrapper, tif=raster, stats=opr)
-    stats_lists = p.map(func, chunks(features, cores))
-    stat = list(itertools.chain(*stats_lists))
-    p.close()
-    return stat
+# fields of the per-segment feature table, see write_feature_table
+TABLE_FIELDS = ([('label', np.int64), ('area', np.float64), ('minx', np.float64),
+                 ('miny', np.float64), ('maxx', np.float64), ('maxy', np.float64)] +
+                [(p, np.float32) for p in PREDICTORS])
+
+def segment_features(df, rasters, labelRaster=None, pool=None):
+    """Mean of each feature raster over each segment of df, as PREDICTORS columns
+
+    rasters maps 'brightness', 'ndvi', 'slope', 'glcmhomog' and 'glcmmean'
+    to files or (file, band) references. The means are reduced over the
+    label raster when given, df then has a "label" column, otherwise over
+    the polygons in the zonal_stats pool. Infinite and missing means are 0.
+    """
+    if labelRaster:
+        print("Running zonal_stats on label raster")
+        table = label_zonal_stats(labelRaster, rasters, ['mean'])
+        out_stat = {k: label_values(table, df['label'], k+'_mean') for k in rasters}
+    else:
+        cores = os.cpu_count()
+        print("Running zonal_stats with "+str(cores)+" CPUs")
+        table = zonal_stats_table(list(df.geometry), {k: (tif, ['mean']) for k, tif in rasters.items()},
+                                  pool=pool, cores=cores)
+        out_stat = {k: table[k+'_mean'].values for k in rasters}
+    out = pd.DataFrame({'Meanbright': out_stat['brightness'],
+                        'Meanndvi': out_stat['ndvi'],
+                        'Meanslope': out_stat['slope'],
+                        'glcmhomog': out_stat['glcmhomog'],
+                        'glcmmean': out_stat['glcmmean']}, index=df.index)
+    out = out.replace([np.inf, -np.inf], np.nan)
+    return out.fillna(0)
+
+@report.timed('feature table')
+def write_feature_table(df, features, tableFile):
+    """Save the per-segment feature table of a segmentation
+
+    One record per polygon of df, in order: the segment label (the "label"
+    column, or the row number), its area and bounding box, and the
+    PREDICTORS columns of features. The table is a NumPy structured array
+    in a .npy file, which load_feature_table memory-maps.
+    """
+    table = np.zeros(len(df), dtype=TABLE_FIELDS)
+    table['label'] = df['label'].values if 'label' in df else np.arange(len(df))
+    table['area'] = df.geometry.area.values
+    bounds = df.geometry.bounds
+    for c in ('minx', 'miny', 'maxx', 'maxy'):
+        table[c] = bounds[c].values
+    for p in PREDICTORS:
+        table[p] = features[p].values
+    np.save(tableFile, table)
+    report.note(segments=len(table), bytes=table.nbytes)
+    print("Wrote the features of "+str(len(table))+" segments to "+str(tableFile))
+
+def load_feature_table(tableFile):
+    """Memory-mapped per-segment feature table saved by write_feature_table"""
+    table = np.load(tableFile, mmap_mode='r')
+    if table.dtype.names is None or list(table.dtype.names) != [n for n, _ in TABLE_FIELDS]:
+        raise RuntimeError(str(tableFile)+' is not a segment feature table')
+    return table
+
+def save_model(model, modelFile, info=None, engine='rf'):
+    """Save a fitted model with its predictors and versions"""
+    bundle = {'model': model,
+              'engine': engine,
+              'predictors': list(PREDICTORS),
+              'feature_version': FEATURE_VERSION,
+              'sklearn_version': sklearn.__version__,
+              'info': dict(info or {})}
+    joblib.dump(bundle, modelFile)
+    return bundle
+
+def load_model(modelFile):
+    """Load a model saved by save_model, checking that it fits Detection"""
+    bundle = joblib.load(modelFile)
+    if not isinstance(bundle, dict) or 'model' not in bundle:
+        raise RuntimeError(str(modelFile)+' is not a SALaD model')
+    if bundle['feature_version'] != FEATURE_VERSION or bundle['predictors'] != PREDICTORS:
+        raise RuntimeError(str(modelFile)+' was trained on features version '+
+                           str(bundle['feature_version'])+', expected version '+str(FEATURE_VERSION))
+    if bundle['sklearn_version'] != sklearn.__version__:
+        print("Warning: "+str(modelFile)+" was saved with scikit-learn "+
+              bundle['sklearn_version']+", running "+sklearn.__version__)
+    return bundle
+
+def dissolve_labels(labelRaster, labels, outFile):
+    """Polygonize the union of the segments with the given labels
+
+    The segments are mapped to a binary mask through a label lookup array,
+    block strip by block strip, and the mask is polygonized once. Regions
+    are 4-connected, like the parts of the unary_union of the segment
+    polygons, so the result holds the same dissolved polygons.
+    """
+    ds = gdal.Open(labelRaster)
+    if ds is None:
+        raise RuntimeError('Unable to open '+str(labelRaster))
+    band = ds.GetRasterBand(1)
+    labels = np.asarray(labels, dtype=np.int64)
+    lookup = np.zeros(max(int(labels.max()) + 1 if len(labels) else 1,
+                          int(band.ComputeRasterMinMax(False)[1]) + 1), dtype=np.uint8)
+    lookup[labels] = 1
+
+    mask_ds = gdal.GetDriverByName("MEM").Create('', ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(ds.GetGeoTransform())
+    mask_ds.SetProjection(ds.GetProjection())
+    mask = mask_ds.GetRasterBand(1)
+    for xoff, yoff, xsize, ysize in block_windows(band):
+        lab = band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.int64)
+        mask.WriteArray(lookup[lab], xoff, yoff)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(ds.GetProjection())
+    drv = ogr.GetDriverByName("ESRI Shapefile")
+    if os.path.exists(outFile):
+        drv.DeleteDataSource(outFile)
+    out_ds = drv.CreateDataSource(outFile)
+    out_layer = out_ds.CreateLayer(os.path.splitext(os.path.basename(outFile))[0], srs=srs)
+    # the mask is its own mask band, only landslide pixels are polygonized
+    gdal.Polygonize(mask, mask, out_layer, -1, [], callback=None)
+    out_ds = None
+    mask_ds = None
+    ds = None
 
 class Detection(object):
     def __init__(self, pathToFile,
                  segFile, brightFile, ndviFile, 
                  slopeFile, homogFile, meanFile,
-                 outPath, outFile, Tree): 
+                 outPath, outFile, Tree, labelFile=None, Pool=None,
+                 trainFile=None, modelFile=None, loadModel=None, modelInfo=None,
+                 Engine='rf', Jobs=None, Auto_Trees=False, OOB_Tol=0.002,
+                 oobFile=None, Dissolve='vector', Feature_Stack=None,
+                 Feature_Table=None): 
                
         if not pathToFile:
             raise RuntimeError('A path to a file must be specified')
@@ -45,78 +161,160 @@ class Detection(object):
         if not os.path.isfile(self.segfile):
             raise RuntimeError('A segmented shape file must be specified')
  
-        self.brightfile = os.path.join(pathToFile, brightFile)      
-        if not os.path.isfile(self.brightfile):
-            raise RuntimeError('A brightness file must be specified')
+        # features are (file, band) references into a feature stack, or files
+        if Feature_Stack:
+            stack = os.path.join(pathToFile, Feature_Stack)
+            if not os.path.isfile(stack):
+                raise RuntimeError('A feature stack must be specified')
+            (self.brightfile, self.ndvifile, self.slopefile, self.homogfile,
+             self.meanfile) = stack_bands(stack, ('bright', 'ndvi', 'slope', 'glcmhomog', 'glcmmean'))
+        else:
+            self.brightfile = os.path.join(pathToFile, brightFile)      
+            if not os.path.isfile(self.brightfile):
+                raise RuntimeError('A brightness file must be specified')
 
-        self.ndvifile = os.path.join(pathToFile, ndviFile) 
-        if not os.path.isfile(self.ndvifile):
-            raise RuntimeError('A NDVI file must be specified')
+            self.ndvifile = os.path.join(pathToFile, ndviFile) 
+            if not os.path.isfile(self.ndvifile):
+                raise RuntimeError('A NDVI file must be specified')
       
-        self.slopefile = os.path.join(pathToFile, slopeFile) 
-        if not os.path.isfile(self.slopefile):
-            raise RuntimeError('A slope file must be specified')
+            self.slopefile = os.path.join(pathToFile, slopeFile) 
+            if not os.path.isfile(self.slopefile):
+                raise RuntimeError('A slope file must be specified')
  
-        self.homogfile = os.path.join(pathToFile, homogFile)
-        if not os.path.isfile(self.homogfile):
-            raise RuntimeError('A GLCM Homogeneity file must be specified')
+            self.homogfile = os.path.join(pathToFile, homogFile)
+            if not os.path.isfile(self.homogfile):
+                raise RuntimeError('A GLCM Homogeneity file must be specified')
 
-        self.meanfile = os.path.join(pathToFile, meanFile)        
-        if not os.path.isfile(self.meanfile):
-            raise RuntimeError('A GLCM Mean file must be specified')
+            self.meanfile = os.path.join(pathToFile, meanFile)        
+            if not os.path.isfile(self.meanfile):
+                raise RuntimeError('A GLCM Mean file must be specified')
 
-        self.trainfile=pathToFile+"training.shp"
+        # optional LSMS label raster of segFile for the label zonal engine
+        self.labelfile = None
+        if labelFile:
+            self.labelfile = os.path.join(pathToFile, labelFile)
+            if not os.path.isfile(self.labelfile):
+                raise RuntimeError('A segmentation label raster must be specified')
+
+        # predict-only with a saved model, no training file is needed
+        self.loadmodel = loadModel
+        if loadModel and not os.path.isfile(loadModel):
+            raise RuntimeError('A saved model must be specified')
+        # where to save the fitted model, and what to record with it
+        self.modelfile = modelFile
+        self.modelinfo = modelInfo
+
+        # training file of this scene, or shared with another scene
+        self.trainfile=os.path.join(pathToFile, "training_"+os.path.splitext(segFile)[0]+".gpkg")
+        if trainFile and not loadModel:
+            self.trainfile = trainFile
+            if not os.path.isfile(self.trainfile):
+                raise RuntimeError('A training shape file must be specified')
         self.tree = Tree      
+        # classifier engine and threads used to fit and predict
+        self.engine = Engine
+        self.jobs = Jobs
+        self.timings = {}
+        # grow the forest up to Tree trees until the OOB error plateaus,
+        # writing the OOB curve to oobFile
+        self.auto_trees = Auto_Trees
+        self.oob_tol = OOB_Tol
+        self.oobfile = oobFile
+        # 'vector': unary_union of the landslide polygons,
+        # 'raster': polygonize a landslide mask of the label raster
+        if Dissolve not in ('vector', 'raster'):
+            raise RuntimeError('Unknown dissolve mode: '+str(Dissolve))
+        if Dissolve == 'raster' and not self.labelfile:
+            raise RuntimeError('The raster dissolve needs a segmentation label raster')
+        self.dissolve = Dissolve
+        self.pool = Pool
         self.outfile = os.path.join(outPath, outFile)
+        # per-segment features computed by Segmentation, replacing the zonal pass
+        self.featuretable = None
+        if Feature_Table:
+            self.featuretable = os.path.join(pathToFile, Feature_Table)
+            if not os.path.isfile(self.featuretable):
+                raise RuntimeError('A segment feature table must be specified')
     
-    def run(self):
-        
-        shp_file = self.segfile
-        
+    @report.timed('features')
+    def features(self):
+        """Segments of the scene with their predictors
+
+        From the feature table when there is one, without geometries,
+        otherwise from the segmentation and a zonal pass.
+        """
+        if self.featuretable:
+            table = load_feature_table(self.featuretable)
+            report.note(source='table', segments=len(table))
+            return pd.DataFrame({n: np.asarray(table[n]) for n in table.dtype.names})
+
         rasters = {'brightness' : self.brightfile,
                    'ndvi'       : self.ndvifile,
                    'slope'      : self.slopefile,
                    'glcmhomog'  : self.homogfile,
                    'glcmmean'   : self.meanfile}
-        
-        # dictionary to host output zonal stats
-        out_stat = dict.fromkeys(rasters)
 
-        # open shapefile and read features once
-        with fiona.open(shp_file) as src:
-            features = list(src)
-    
-        cores = os.cpu_count()
-        
-        print("Running zonal_stats with "+str(cores)+" CPUs")
-        for k in rasters.keys():
-            stat = zonal_stats_parallel(features, cores, rasters[k], 'mean')
-            out_stat[k] = list(d["mean"] for d in stat)
-        
-        df = gpd.read_file(shp_file)
-        df["Meanbright"] = out_stat['brightness']
-        df["Meanndvi"] = out_stat['ndvi']
-        df["Meanslope"] = out_stat['slope']
-        df["glcmhomog"] = out_stat['glcmhomog']
-        df["glcmmean"] = out_stat['glcmmean']
-        df_final = df.replace([np.inf, -np.inf], np.nan)
-        df_final = df_final.fillna(0)
-
-        print("Training RF model")
+        # read the segmentation once
+        df = gpd.read_file(self.segfile)
+        features = segment_features(df, rasters, labelRaster=self.labelfile, pool=self.pool)
+        for p in PREDICTORS:
+            df[p] = features[p]
+        report.note(source='zonal', segments=len(df))
+        return df
+
+    def train(self):
+        """Fit the classifier on the training file and save it if requested"""
+        print("Training "+self.engine+" model")
         df_train = gpd.read_file(self.trainfile)
-        predictor_vars = ["Meanbright","Meanndvi","Meanslope","glcmhomog","glcmmean"]
-        x, y = df_train[predictor_vars], df_train.landslide
+        x, y = df_train[PREDICTORS].values, df_train.landslide.values
+        
+        print("Fitting "+self.engine+" model")
+        model = Classifier(self.engine, self.tree, self.jobs)
+        if self.auto_trees:
+            model.fitTrees(x, y, self.tree, tol=self.oob_tol)
+            if self.oobfile:
+                pd.DataFrame(model.oob_curve, columns=['trees', 'oob_error']).to_csv(
+                    self.oobfile, index=False)
+        else:
+            model.fit(x, y)
+
+        if self.modelfile:
+            print("Saving model to "+str(self.modelfile))
+            info = dict(self.modelinfo or {}, fit_seconds=model.timings['fit'],
+                        trees=len(getattr(model.model, 'estimators_', [])) or self.tree,
+                        oob_curve=model.oob_curve)
+            save_model(model.model, self.modelfile, info, engine=self.engine)
+        return model
+
+    def run(self):
         
-        print("Fitting RF model")
-        modelRandom = RandomForestClassifier(self.tree)
-        modelRandom.fit(x, y)
+        df_final = self.features()
+
+        if self.loadmodel:
+            print("Loading model "+str(self.loadmodel))
+            bundle = load_model(self.loadmodel)
+            model = Classifier(bundle.get('engine', 'rf'), jobs=self.jobs, model=bundle['model'])
+        else:
+            model = self.train()
         
-        predictions = modelRandom.predict(df_final[predictor_vars])
+        predictions = model.predict(df_final, PREDICTORS)
+        self.timings = model.timings
         df_final["outcomes"] = predictions
         
         print("Writing outcomes")
-        crs = df.crs
-        df_land = df_final[df_final['outcomes']>0]
-        df_land_dissolve = gpd.geoseries.GeoSeries([geom for geom in df_land.unary_union.geoms])
-        df_land_dissolve.crs = crs
-        df_land_dissolve.to_file(self.outfile)
+        with report.step('dissolve', mode=self.dissolve, segments=len(df_final),
+                         landslide_segments=int((df_final['outcomes']>0).sum())):
+            if self.dissolve == 'raster':
+                dissolve_labels(self.labelfile, df_final.loc[df_final['outcomes']>0, 'label'].values,
+                                self.outfile)
+                return
+
+            if 'geometry' in df_final:
+                df_land = df_final[df_final['outcomes']>0]
+            else:
+                # geometries of the feature table rows, only to write the result
+                df_land = gpd.read_file(self.segfile)[df_final['outcomes'].values>0]
+            crs = df_land.crs
+            df_land_dissolve = gpd.geoseries.GeoSeries([geom for geom in df_land.unary_union.geoms])
+            df_land_dissolve.crs = crs
+            df_land_dissolve.to_file(self.outfile)
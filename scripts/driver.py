@@ -4,15 +4,26 @@
 
 import sys
 import os
-import glob
+import copy
+import time
+import shutil
 import argparse
+from osgeo import gdal
+import report
+from otbApp import otbApp, budget
+from glcm import GLCM_DIRECTIONS
 from preprocessing import PreProcessing
 from segmentation import Segmentation
-from detection import Detection
+from detection import Detection, load_model
+from zonal import zonal_pool
+from cache import ArtifactCache, RunJournal, StageCache, stage_key
+from scratch import scratch_dir
+from scheduler import Scheduler, Task
 
+# stages of a scene, in order
+STAGES = ['preprocessing', 'radius', 'segmentation', 'training', 'detection']
 
-
-def main():
+def buildParser():
     parser = argparse.ArgumentParser(description='SALaD')
     parser.add_argument('-i','--image', help='name of image file')
     parser.add_argument('-d','--dem', help='name of DEM file')
@@ -44,9 +55,186 @@ def main():
         help='overlap required between manual landslide and segmented polygons to generate a training file')
     parser.add_argument('-t', '--tree', type=int, default=500,
         help='The number of trees in the random forest')
+    parser.add_argument('-z', '--zonal', choices=['vector', 'label'], default='vector',
+        help='zonal statistics engine: polygonize + rasterstats ("vector") or reductions over the segmentation label raster ("label")')
+
+    parser.add_argument('-g', '--glcm', choices=['file', 'memory', 'native'], default='file',
+        help='GLCM texture pipeline: OTB through temporary GeoTIFFs ("file"), OTB in-memory NumPy export ("memory") or the NumPy engine without OTB ("native")')
+    parser.add_argument('-gc', '--glcmcheck', action='store_true',
+        help='compare the native GLCM rasters with OTB when OTB is available')
+    parser.add_argument('-st', '--streaming', action='store_true',
+        help='read and write preprocessing rasters block by block to bound memory by block size')
+    parser.add_argument('-pw', '--pofworkers', type=int, default=1,
+        help='number of hr candidates of the POF sweep to run concurrently')
+    parser.add_argument('-w', '--weights', choices=['polygon', 'raster', 'check'], default='polygon',
+        help="spatial weights for Moran's I: queen contiguity of the polygons (\"polygon\"), adjacency of the label raster (\"raster\", differs from \"polygon\" for segments split into several polygons, which share the neighbours of their label) or both, reporting the difference (\"check\")")
+    parser.add_argument('-lt', '--lsmstile', type=int,
+        help='tile size in pixels of a tile-parallel full-scene LSMS segmentation, by default a single LSMS run')
+    parser.add_argument('-lo', '--lsmsoverlap', type=int, default=64,
+        help='overlap in pixels between the tiles of the tile-parallel LSMS')
+    parser.add_argument('-lw', '--lsmsworkers', type=int,
+        help='number of tiles segmented concurrently, by default one per CPU')
+    parser.add_argument('-b', '--batchsize', type=int,
+        help='number of segments per zonal_stats task, by default about 4 tasks per CPU')
+    parser.add_argument('-c', '--cache', action='store_true',
+        help='store the outputs of every stage under a key of its inputs and parameters and reuse them when the key is unchanged')
+    parser.add_argument('-cd', '--cachedir',
+        help='location of the stage cache, by default ".salad_cache" in the output path')
+    parser.add_argument('-re', '--resume', action='store_true',
+        help='skip the stages the previous run in the output path completed with the same inputs and parameters')
+    parser.add_argument('-ce', '--classifier', choices=['rf', 'hgb'], default='rf',
+        help='classifier engine: random forest ("rf") or histogram-based gradient boosting for large training sets ("hgb")')
+    parser.add_argument('-j', '--jobs', type=int,
+        help='number of threads of the random forest fit and prediction, by default one per CPU')
+    parser.add_argument('-at', '--autotrees', action='store_true',
+        help='grow the random forest until its out-of-bag error plateaus, up to -t trees, and record the OOB curve')
+    parser.add_argument('-ot', '--oobtol', type=float, default=0.002,
+        help='OOB error tolerance of the automatic forest size')
+    parser.add_argument('-ds', '--dissolve', choices=['vector', 'raster'], default='vector',
+        help='merge the landslide segments with a vector union ("vector") or by polygonizing a landslide mask of the label raster ("raster", needs -z label)')
+    parser.add_argument('-tl', '--traininglabels', choices=['vector', 'raster'], default='vector',
+        help='label training segments by vector overlay with the manual landslides ("vector") or by counting pixels of the rasterized landslides ("raster", needs -z label)')
+    parser.add_argument('-fs', '--featurestack', action='store_true',
+        help='write the features as one tiled, compressed multi-band GeoTIFF "features_<image>.tif" read by segmentation and detection, instead of five GeoTIFFs')
+    parser.add_argument('-ov', '--overviews', action='store_true',
+        help='build internal overviews of the feature stack')
+    parser.add_argument('-dg', '--dag', action='store_true',
+        help='run the GLCM directions, slope, indices and hr selection as a graph of concurrent tasks and record its critical path in the report')
+    parser.add_argument('-dc', '--dagcpus', type=int,
+        help='CPUs of the preprocessing graph, by default all CPUs')
+    parser.add_argument('-dm', '--dagram', type=int,
+        help='RAM (MB) of the preprocessing graph, by default the OTB memory budget')
+    parser.add_argument('-rp', '--report',
+        help='write a JSON run report with wall and CPU time, peak memory and counts per stage and step to this file')
+    parser.add_argument('-md', '--model',
+        help='model saved by a previous run, e.g. "model_image.joblib", to map the scene without training (predict-only)')
+    return parser
+
+def graph_budget(tokens):
+    """Give a task of the preprocessing graph its CPUs and RAM (MB) for OTB"""
+    otbApp.setBudget(tokens.get('ram', 128), tokens.get('cpu', 1))
+
+def run_feature_task(features, step, method, params=(), upstream=None, tokens=None):
+    """Run one PreProcessing method of the preprocessing graph in a scheduler worker"""
+    pre = PreProcessing(glcmCores=(tokens or {}).get('cpu'), **features)
+    with report.step(step):
+        getattr(pre, method)(*params)
+    return {'report': report.collect()}
+
+def run_radius_task(args, preprocessing, upstream=None, tokens=None):
+    """Run the radius stage in a scheduler worker, once the brightness is written"""
+    res = run_scene(args, only=['radius'], upstream=[preprocessing],
+                    zonalCores=(tokens or {}).get('cpu'))['radius']
+    res['report'] = report.collect()
+    return res
+
+def use_model(args, model, stages):
+    """Stand in for the radius and training stages with a saved model
+
+    Returns the arguments of the scene with the spatial radius and minimum
+    object size the model was trained with.
+    """
+    key = stage_key('model', [model])
+    info = load_model(model)['info']
+    if info.get('hr') is None:
+        raise RuntimeError(str(model)+' does not record the hr it was trained with')
+    # segment with the parameters of the training scene
+    args = copy.copy(args)
+    args.spatialr = info.get('spatialr', args.spatialr)
+    args.objectsize = info.get('objectsize', args.objectsize)
+    print("Predicting with "+str(model)+", hr "+str(info['hr'])+", spatial radius "+
+          str(args.spatialr)+", minimum object size "+str(args.objectsize))
+    stages.add([{'stage': 'radius', 'key': key, 'meta': {'hr': info['hr']}},
+                {'stage': 'training', 'key': key, 'meta': {}}])
+    return args
+
+def run_graph(args, tag, image, features, stages, radius=True):
+    """Run the preprocessing, and the radius stage, as one graph of tasks
+
+    The four GLCM directions, the slope, the indices and, once the
+    brightness is written, the radius stage do not depend on each other;
+    they run side by side under the CPU and RAM budget of --dagcpus and
+    --dagram. Returns the metadata of the preprocessing stage.
+    """
+    img = gdal.Open(image)
+    # MB of one float32 band of the scene
+    band = img.RasterXSize * img.RasterYSize * 4 // 1048576 + 1
+    img = None
+    cpus = args.dagcpus or os.cpu_count()
+    ram = args.dagram or budget()[0]
 
-    args = parser.parse_args()
+    features = dict(features)
+    if features['featureStack']:
+        # single-band features are scratch files, stacked at the end
+        features['featurePath'] = scratch_dir("features_"+tag+"_", features['scratchDir'])
+    glcmdir = scratch_dir("glcm_"+tag+"_", features['scratchDir'])
 
+    scheduler = Scheduler({'cpu': cpus, 'ram': ram}, initializer=graph_budget)
+    means, homogs, glcm = [], [], []
+    for direction in GLCM_DIRECTIONS:
+        name = 'glcm_'+str(direction[2])
+        means.append(os.path.join(glcmdir, "mean_"+str(direction[2])+".tif"))
+        homogs.append(os.path.join(glcmdir, "homog_"+str(direction[2])+".tif"))
+        scheduler.add(Task(name, run_feature_task,
+                           args=(features, name, 'glcmDirection',
+                                 (direction, means[-1], homogs[-1])),
+                           resources={'cpu': max(1, cpus // len(GLCM_DIRECTIONS)),
+                                      'ram': 3 * band + 256}, cost=2.0))
+        glcm.append(name)
+    scheduler.add(Task('glcm', run_feature_task,
+                       args=(features, 'glcm', 'combineGLCM', (means, homogs)),
+                       deps=glcm, resources={'cpu': 1, 'ram': 3 * band}, cost=0.5))
+    scheduler.add(Task('slope', run_feature_task, args=(features, 'slope', 'generateSlope'),
+                       resources={'cpu': 1, 'ram': 3 * band}, cost=0.5))
+    scheduler.add(Task('index', run_feature_task, args=(features, 'index', 'generateIndex'),
+                       resources={'cpu': 1, 'ram': 64 if args.streaming else 8 * band},
+                       cost=0.5))
+    bright = 'index'
+    if features['featureStack']:
+        scheduler.add(Task('stack', run_feature_task,
+                           args=(features, 'stack', 'stackFeatures'),
+                           deps=['glcm', 'slope', 'index'],
+                           resources={'cpu': 1, 'ram': 256}, cost=0.5))
+        bright = 'stack'
+    if radius:
+        # the hr selection reads the image and the brightness only
+        preprocessing = {'stage': 'preprocessing', 'key': stages.keys['preprocessing'],
+                         'meta': {}}
+        scheduler.add(Task('radius', run_radius_task, args=(args, preprocessing), deps=[bright],
+                           resources={'cpu': max(1, cpus // 2), 'ram': ram // 2},
+                           cost=4.0))
+
+    print("Running the preprocessing graph on "+str(cpus)+" CPUs and "+str(ram)+" MB")
+    try:
+        scheduler.run()
+    finally:
+        for name in sorted(scheduler.results):
+            report.merge(scheduler.results[name].get('report', []))
+        report.note(graph=scheduler.report, graph_cpus=cpus, graph_ram_mb=ram)
+        shutil.rmtree(glcmdir, ignore_errors=True)
+        if features['featureStack']:
+            shutil.rmtree(features['featurePath'], ignore_errors=True)
+
+    if 'radius' in scheduler.results:
+        stages.add([scheduler.results['radius']])
+    return {}
+
+def run_scene(args, only=None, upstream=(), zonalCores=None):
+    """Run the stages of one scene, or only the stages listed in only
+
+    upstream holds the results of stages run before, e.g. by other
+    processes of a batch; their keys and metadata are used as if they had
+    run here. Every stage call is wrapped with the cache lookup and store
+    of a StageCache. Returns the results of the stages run, by name.
+
+    With a saved model (--model) the scene is mapped in predict-only mode:
+    the radius and training stages are replaced by the hr, spatial radius
+    and minimum object size recorded with the model.
+
+    Temporary files go to a private scratch directory of the run, under
+    SALAD_SCRATCH or the system temporary directory, so that several
+    scenes can run side by side.
+    """
     if args.path:
         input_path = args.path
     else: 
@@ -60,20 +248,8 @@ def main():
     else: 
         output_path = os.getcwd()
 
-    ulx = args.ulx
-    uly = args.uly
-    lrx = args.lrx
-    lry = args.lry
-
-    hr_min = args.hr_min
-    hr_max = args.hr_max
-    step_size = args.step
-    spatial_radius = args.spatialr
-    object_size = args.objectsize
-
     landslides=args.landslides
-    overlap=args.overlap
-    tree=args.tree
+    model=args.model
 
     if args.result:
         output_file = args.result
@@ -91,46 +267,202 @@ def main():
            
     if not os.path.isfile(os.path.join(input_path, dem_file)):
         raise RuntimeError('A DEM must be specified')
+
+    if model and not os.path.isfile(model):
+        raise RuntimeError('A saved model must be specified')
         
     #file id derived from raw data 
     tag = image_file.split('.')[0]
-    
-    # generate 5 geotiff
-    step1 = PreProcessing(pathToFile=input_path, imageFile=image_file, demFile=dem_file, outPath=output_path)
-    step1.run()
-    print("Preprocessing Completed")
+
+    image = os.path.join(input_path, image_file)
+    dem = os.path.join(input_path, dem_file)
+    manual = None
+    if landslides:
+        manual = os.path.join(input_path, landslides)
 
     homogfile = "homog_"+tag+".tif"
     meanfile = "mean_"+tag+".tif"
     slopefile = "slope_"+tag+".tif"
     brightfile = "bright_"+tag+".tif"
     ndvifile = "ndvi_"+tag+".tif" 
-    
-    #segmentation to generate a shape file
-    step2 = Segmentation(pathToFile=input_path, imageFile=image_file, 
-                        Manual=landslides, brightFile=brightfile, 
-                        ndviFile=ndvifile, slopeFile=slopefile, 
-                        homogFile=homogfile, meanFile=meanfile, 
-                        outPath=output_path, overLap=overlap, 
-                        ulX=ulx, ulY=uly, lrX=lrx, lrY=lry, 
-                        hr_Min=hr_min, hr_Max=hr_max, Step_Size=step_size,
-                        Spatial_Radius=spatial_radius, Object_Size=object_size)
-    step2.run()
-    print("Segmentation Completed")
-
-    segfile = tag+".shp"
-
-    # Delete temporary files produced during segmentation
-    for f in glob.glob("*_FINAL.tif"):
-    	os.remove(f) 
-
-    # random forest model to detect landslides
-    step3 = Detection(pathToFile=output_path,
-                      segFile=segfile, brightFile=brightfile, 
-                      ndviFile=ndvifile, slopeFile=slopefile, 
-                      homogFile=homogfile, meanFile=meanfile, 
-                      outPath=output_path, outFile=output_file, Tree=tree)
-    step3.run()
+    # one tiled multi-band raster of the five features
+    stackfile = None
+    if args.featurestack:
+        stackfile = "features_"+tag+".tif"
+    segfile = tag+".gpkg"
+    # per-segment features of the segmentation, read by detection
+    tablefile = "segfeatures_"+tag+".npy"
+    labelfile = None
+    if args.zonal == 'label':
+        labelfile = "merg_"+tag+".tif"
+    modelfile = None
+    if not model:
+        modelfile = os.path.join(output_path, "model_"+tag+".joblib")
+
+    cache = None
+    if args.cache:
+        cache = ArtifactCache(args.cachedir or os.path.join(output_path, '.salad_cache'))
+    stages = StageCache(tag, RunJournal(os.path.join(output_path, 'salad_run.json')),
+                        cache=cache, resume=args.resume)
+    stages.add(upstream)
+    # keep the training area segmentation of the selected hr between runs
+    keep = cache is not None or args.resume
+
+    wanted = only or STAGES
+    if model:
+        wanted = [s for s in wanted if s not in ('radius', 'training')]
+        if 'radius' not in stages.meta and ('segmentation' in wanted or 'detection' in wanted):
+            args = use_model(args, model, stages)
+
+    zonal_cores = zonalCores or os.cpu_count()
+    # one zonal_stats worker pool for every vector zonal pass of the run,
+    # created before the OTB stages allocate memory
+    pool = None
+    if args.zonal == 'vector' and any(s != 'preprocessing' for s in wanted):
+        pool = zonal_pool(zonal_cores, args.batchsize)
+    scratch = scratch_dir("salad_"+tag+"_")
+    try:
+        if 'preprocessing' in wanted:
+            img = gdal.Open(image)
+            report.add('scene', scene=tag, cols=img.RasterXSize, rows=img.RasterYSize,
+                       bands=img.RasterCount)
+            img = None
+
+            # generate 5 geotiff
+            features = dict(pathToFile=input_path, imageFile=image_file, demFile=dem_file,
+                            outPath=output_path, glcmMode=args.glcm, glcmCheck=args.glcmcheck,
+                            streaming=args.streaming, scratchDir=scratch,
+                            featureStack=stackfile, stackOverviews=args.overviews)
+            if args.dag and only is None:
+                # the radius stage joins the graph of the preprocessing steps
+                preprocess = lambda: run_graph(args, tag, image, features, stages,
+                                               radius='radius' in wanted)
+            else:
+                step1 = PreProcessing(**features)
+                preprocess = step1.run
+            if stackfile:
+                outputs = [os.path.join(output_path, stackfile)]
+            else:
+                outputs = [os.path.join(output_path, f) for f in (homogfile, meanfile, slopefile,
+                                                                  brightfile, ndvifile)]
+            stages.run('preprocessing', preprocess, outputs, inputs=[image, dem],
+                       params={'glcm': args.glcm, 'featurestack': args.featurestack,
+                               'overviews': args.overviews})
+            print("Preprocessing Completed")
+
+        if any(s in wanted for s in ('radius', 'segmentation', 'training')):
+            #segmentation to generate a shape file
+            step2 = Segmentation(pathToFile=input_path, imageFile=image_file, 
+                                Manual=landslides, brightFile=brightfile, 
+                                ndviFile=ndvifile, slopeFile=slopefile, 
+                                homogFile=homogfile, meanFile=meanfile, 
+                                outPath=output_path, overLap=args.overlap, 
+                                ulX=args.ulx, ulY=args.uly, lrX=args.lrx, lrY=args.lry, 
+                                hr_Min=args.hr_min, hr_Max=args.hr_max, Step_Size=args.step,
+                                Spatial_Radius=args.spatialr, Object_Size=args.objectsize,
+                                Zonal_Engine=args.zonal, Pool=pool,
+                                POF_Workers=args.pofworkers, Weights=args.weights,
+                                LSMS_Tile=args.lsmstile, LSMS_Overlap=args.lsmsoverlap,
+                                LSMS_Workers=args.lsmsworkers,
+                                Training_Labels=args.traininglabels,
+                                Scratch_Dir=scratch, Feature_Stack=stackfile,
+                                Feature_Table=tablefile)
+
+        # the preprocessing graph may have selected the hr already
+        if 'radius' in wanted and 'radius' not in stages.meta:
+            def radius():
+                print("Computing Radius")
+                hr = step2.getRadius()
+                step2.cleanRadius(keep=hr)
+                return {'hr': hr}
+
+            def radius_outputs(meta):
+                return ([os.path.join(output_path, 'POF_'+tag+'.csv')] +
+                        [f for f in step2.trainingFiles(meta['hr']) if f])
+
+            stages.run('radius', radius, radius_outputs, inputs=[image], deps=['preprocessing'],
+                       params={'hr_min': args.hr_min, 'hr_max': args.hr_max,
+                               'step': args.step, 'spatialr': args.spatialr,
+                               'objectsize': args.objectsize, 'ulx': args.ulx,
+                               'uly': args.uly, 'lrx': args.lrx, 'lry': args.lry,
+                               'zonal': args.zonal, 'weights': args.weights})
+
+        if 'segmentation' in wanted:
+            hr = stages.meta['radius']['hr']
+            outputs = [os.path.join(output_path, segfile), os.path.join(output_path, tablefile)]
+            if labelfile:
+                outputs.append(os.path.join(output_path, labelfile))
+            # the features of the segments are computed with the segmentation
+            stages.run('segmentation', lambda: step2.segment(hr), outputs,
+                       inputs=[image], deps=['preprocessing', 'radius'],
+                       params={'spatialr': args.spatialr, 'objectsize': args.objectsize,
+                               'lsmstile': args.lsmstile, 'lsmsoverlap': args.lsmsoverlap,
+                               'zonal': args.zonal, 'hr': hr})
+
+        if 'training' in wanted:
+            hr = stages.meta['radius']['hr']
+
+            def training():
+                print("Creating Training file")
+                step2.training(*step2.trainingFiles(hr))
+                return {'trainfile': os.path.abspath(step2.outfile)}
+
+            stages.run('training', training, [step2.outfile], inputs=[manual],
+                       deps=['preprocessing', 'radius'],
+                       params={'overlap': args.overlap, 'zonal': args.zonal,
+                               'traininglabels': args.traininglabels})
+            if not keep:
+                step2.cleanRadius()
+            print("Segmentation Completed")
+
+        if 'detection' in wanted:
+            # random forest model to detect landslides
+            step3 = Detection(pathToFile=output_path,
+                              segFile=segfile, brightFile=brightfile, 
+                              ndviFile=ndvifile, slopeFile=slopefile, 
+                              homogFile=homogfile, meanFile=meanfile, 
+                              outPath=output_path, outFile=output_file,
+                              Tree=args.tree, labelFile=labelfile, Pool=pool,
+                              trainFile=stages.meta['training'].get('trainfile'),
+                              modelFile=modelfile, loadModel=model,
+                              modelInfo={'hr': stages.meta.get('radius', {}).get('hr'),
+                                         'spatialr': args.spatialr,
+                                         'objectsize': args.objectsize,
+                                         'zonal': args.zonal, 'tree': args.tree},
+                              Engine=args.classifier, Jobs=args.jobs or zonal_cores,
+                              Auto_Trees=args.autotrees, OOB_Tol=args.oobtol,
+                              oobFile=os.path.join(output_path, "oob_"+tag+".csv") if args.autotrees else None,
+                              Dissolve=args.dissolve, Feature_Stack=stackfile,
+                              Feature_Table=tablefile)
+            outputs = [step3.outfile]
+            if modelfile:
+                outputs.append(modelfile)
+            if step3.oobfile and not model:
+                outputs.append(step3.oobfile)
+            stages.run('detection', step3.run, outputs,
+                       deps=['preprocessing', 'segmentation', 'training'],
+                       params={'tree': args.tree, 'zonal': args.zonal,
+                               'classifier': args.classifier,
+                               'autotrees': args.autotrees, 'oobtol': args.oobtol,
+                               'dissolve': args.dissolve})
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return stages.results
+
+def main():
+    args = buildParser().parse_args()
+    start = time.perf_counter()
+    try:
+        run_scene(args)
+    finally:
+        if args.report:
+            report.write(args.report, scene=str(args.image).split('.')[0], args=vars(args),
+                         wall_s=round(time.perf_counter() - start, 4),
+                         zonal_workers=os.cpu_count())
     print("SALaD Completed")
     
 
@@ -2,27 +2,120 @@
 #Administrator of the National Aeronautics and Space Administration.
 #All Rights Reserved.
 
-import otbApplication
 import os
+import time
+import shutil
+from osgeo import gdal
+from scratch import scratch_dir
+import report
+
+try:
+    import otbApplication
+except ImportError:
+    # OTB is only required by the stages that call it, e.g. the native GLCM
+    # engine runs without it
+    otbApplication = None
+
+def createApplication(name):
+    """Create an OTB application, failing clearly when OTB is missing"""
+    if otbApplication is None:
+        raise RuntimeError('Orfeo Toolbox (otbApplication) is not available')
+    app = otbApplication.Registry.CreateApplication(name)
+    if app is None:
+        raise RuntimeError('Unable to create OTB application '+name)
+    return app
 
 # -----------------------------------------------------------------------------
 # class OTBApp
 # -----------------------------------------------------------------------------
 
-#Default maximum memory that OTB should use for processing, in MB. If not set, default value is 128 MB.
-os.environ["OTB_MAX_RAM_HINT"] = "50000"
+# share of the available memory given to OTB, the rest is left to the zonal
+# statistics workers and the arrays of the Python side
+RAM_SHARE = 0.5
+
+# LSMS tiles hold the smoothed bands, the spatial output and the labels,
+# about 4 bytes per band and pixel plus 12; a tile may use this share of
+# the RAM budget, several are in flight
+LSMS_TILE_SHARE = 0.25
+LSMS_TILE_MIN = 500
+LSMS_TILE_MAX = 8192
+
+def available_ram():
+    """Memory available to this process in MB
+
+    MemAvailable of /proc/meminfo, capped by the cgroup (v2) memory limit
+    of a container, or the free physical pages elsewhere.
+    """
+    ram = None
+    try:
+        with open('/proc/meminfo') as fd:
+            for line in fd:
+                if line.startswith('MemAvailable:'):
+                    ram = int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    if ram is None:
+        ram = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 1048576
+    try:
+        with open('/sys/fs/cgroup/memory.max') as fd:
+            limit = fd.read().strip()
+        with open('/sys/fs/cgroup/memory.current') as fd:
+            used = int(fd.read())
+        if limit != 'max':
+            ram = min(ram, (int(limit) - used) // 1048576)
+    except (OSError, ValueError):
+        pass
+    return max(ram, 128)
+
+def budget(jobs=1):
+    """RAM (MB) and threads of each of jobs concurrent OTB jobs
+
+    The totals are OTB_MAX_RAM_HINT and ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS
+    when set, e.g. by setBudget in a worker or by the user, otherwise
+    RAM_SHARE of the available memory and the CPUs of the host.
+    """
+    jobs = max(1, jobs)
+    ram = os.environ.get("OTB_MAX_RAM_HINT")
+    ram = int(ram) if ram else int(available_ram() * RAM_SHARE)
+    threads = os.environ.get("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+    threads = int(threads) if threads else os.cpu_count()
+    return max(128, ram // jobs), max(1, threads // jobs)
+
+def lsms_tile_size(cols, rows, bands, ram):
+    """Square LSMS tile size fitting a share of ram MB, at most the image"""
+    pixel = 4 * bands + 12
+    tile = int((ram * LSMS_TILE_SHARE * 1048576 / pixel) ** 0.5)
+    tile = max(LSMS_TILE_MIN, min(tile, LSMS_TILE_MAX))
+    return min(tile, max(cols, rows))
 
 class otbApp(object):
     
+    # True when the OTB Python bindings can be imported
+    @staticmethod
+    def available():
+        return otbApplication is not None
+
+    # Limit the RAM (MB) and threads OTB uses in this process, e.g. as the
+    # initializer of a pool running several OTB jobs side by side. ITK reads
+    # the thread count when OTB starts, so it applies to spawned workers;
+    # the RAM becomes the default of every later call.
+    @staticmethod
+    def setBudget(ram, threads):
+        os.environ["OTB_MAX_RAM_HINT"] = str(ram)
+        os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
+
     # OTB application computes Haralick features
     # ref: 
     # https://www.orfeo-toolbox.org/CookBook/Applications/app_HaralickTextureExtraction.html
     @staticmethod
+    @report.timed('otb HaralickTextureExtraction')
     def runTextureExtraction(image, channel,outfile, 
                              xoff, yoff, xrad, yrad, 
-                             vmin,vmax,bin, texture):
+                             vmin,vmax,bin, texture, ram=None):
+        ram = ram or budget()[0]
+
         # The following lines set all the application parameters:
-        app = otbApplication.Registry.CreateApplication("HaralickTextureExtraction")
+        app = createApplication("HaralickTextureExtraction")
 
         app.SetParameterString("in", image)
         
@@ -45,22 +138,128 @@ class otbApp(object):
         app.SetParameterInt("parameters.nbbin", bin)
 
         app.SetParameterString("texture", texture)
+
+        app.SetParameterInt("ram", ram)
+
+        report.note(image=image, channel=channel, xoff=xoff, yoff=yoff, texture=texture,
+                    ram_mb=ram)
         
         app.ExecuteAndWriteOutput()
 
+    # Same as runTextureExtraction, but the output stays in memory: a single
+    # texture band is exported to NumPy in strips of rows through an
+    # in-memory ExtractROI, so neither the full multi-band texture image nor
+    # a temporary GeoTIFF is ever materialized
+    # ref:
+    # https://www.orfeo-toolbox.org/CookBook/PythonAPI.html
+    # https://www.orfeo-toolbox.org/CookBook/Applications/app_ExtractROI.html
+    @staticmethod
+    def textureStrips(image, channel, band, cols, rows,
+                      xoff, yoff, xrad, yrad,
+                      vmin, vmax, bin, texture, stripRows=None, ram=None):
+        ram = ram or budget()[0]
+
+        app = createApplication("HaralickTextureExtraction")
+
+        app.SetParameterString("in", image)
+
+        app.SetParameterInt("channel", channel)
+
+        app.SetParameterInt("parameters.xoff", xoff)
+
+        app.SetParameterInt("parameters.yoff", yoff)
+
+        app.SetParameterInt("parameters.xrad", xrad)
+
+        app.SetParameterInt("parameters.yrad", yrad)
+
+        app.SetParameterInt("parameters.min", vmin)
+
+        app.SetParameterInt("parameters.max", vmax)
+
+        app.SetParameterInt("parameters.nbbin", bin)
+
+        app.SetParameterString("texture", texture)
+
+        app.SetParameterInt("ram", ram)
+
+        app.Execute()
+
+        # The following lines select one texture band of the in-memory output
+        roi = createApplication("ExtractROI")
+
+        roi.ConnectImage("in", app, "out")
+
+        roi.UpdateParameters()
+
+        roi.SetParameterStringList("cl", ["Channel"+str(band)])
+
+        roi.SetParameterString("mode", "standard")
+
+        roi.SetParameterInt("startx", 0)
+
+        roi.SetParameterInt("sizex", cols)
+
+        roi.SetParameterInt("ram", ram)
+
+        # about 16 Mpixels per strip by default, fewer when a float32 strip
+        # would take more than a quarter of the RAM budget
+        if not stripRows:
+            stripRows = max(1, min(16777216, ram * 1048576 // 16) // cols)
+
+        # strips are computed while the caller consumes them, the time spent
+        # in OTB is summed and recorded once all strips are exported
+        wall = 0.0
+        for ystart in range(0, rows, stripRows):
+            ysize = min(stripRows, rows - ystart)
+
+            roi.SetParameterInt("starty", ystart)
+
+            roi.SetParameterInt("sizey", ysize)
+
+            start = time.perf_counter()
+
+            roi.Execute()
+
+            arr = roi.GetVectorImageAsNumpyArray("out", "float")
+
+            wall += time.perf_counter() - start
+
+            yield ystart, arr[:, :, 0]
+
+        report.add('otb HaralickTextureExtraction strips', wall_s=round(wall, 4),
+                   xoff=xoff, yoff=yoff, band=band, cols=cols, rows=rows,
+                   strips=-(-rows // stripRows), ram_mb=ram)
+
     # Perform Large-Scale Mean-Shift segmentation workflow (LSMS)
     # ref:
     # https://www.orfeo-toolbox.org/CookBook/Applications/app_MeanShiftSmoothing.html
     # https://www.orfeo-toolbox.org/CookBook/Applications/app_MeanShiftSmoothing.html
     # https://www.orfeo-toolbox.org/CookBook/Applications/app_LSMSSmallRegionsMerging.html
     @staticmethod
+    @report.timed('otb LSMS')
     def runLSMS(image,segOut,
                 spatialr=10, ranger=16,
-                tilesizex=500, tilesizey=500, 
+                tilesizex=None, tilesizey=None, 
                 sm_thres=0.1, sm_maxiter=100,
-                seg_minsize=0, merg_minsize=10):
+                seg_minsize=0, merg_minsize=10, tmpdir=None,
+                ram=None):
+        # RAM of this call, tiles sized to the RAM by default; the threads
+        # are those ITK started with, see setBudget
+        ram = ram or budget()[0]
+        if not tilesizex or not tilesizey:
+            img = gdal.Open(image)
+            if img is None:
+                raise RuntimeError('Unable to open '+str(image))
+            tile = lsms_tile_size(img.RasterXSize, img.RasterYSize, img.RasterCount, ram)
+            tilesizex = tilesizex or tile
+            tilesizey = tilesizey or tile
+            img = None
+        print("LSMS budget: "+str(ram)+" MB, tiles of "+
+              str(tilesizex)+" x "+str(tilesizey)+" pixels")
+
         # The following line creates an instance of the MeanShiftSmoothing application
-        app1 = otbApplication.Registry.CreateApplication("MeanShiftSmoothing")
+        app1 = createApplication("MeanShiftSmoothing")
 
         # The following lines set all the application parameters:
         app1.SetParameterString("in", image)
@@ -73,14 +272,20 @@ class otbApp(object):
 
         app1.SetParameterInt("maxiter", sm_maxiter)
 
+        app1.SetParameterInt("ram", ram)
+
+
+        report.note(image=image, spatialr=spatialr, ranger=ranger, merg_minsize=merg_minsize,
+                    ram_mb=ram, tilesizex=tilesizex, tilesizey=tilesizey)
 
         # The following line execute the application
-        app1.Execute()
+        with report.step('MeanShiftSmoothing'):
+            app1.Execute()
 
 
 
         # The following line creates an instance of the LSMSSegmentation application
-        app2 = otbApplication.Registry.CreateApplication("LSMSSegmentation")
+        app2 = createApplication("LSMSSegmentation")
 
         # The following lines set all the application parameters:
         app2.ConnectImage("in", app1, "fout")
@@ -97,25 +302,40 @@ class otbApp(object):
 
         app2.SetParameterInt("tilesizey", tilesizey)
 
-        # The following line execute the application
-        app2.Execute()
+        # Temporary tiles go to a private scratch directory unless tmpdir is given
+        own = not tmpdir
+        if own:
+            tmpdir = scratch_dir("lsms_")
+        app2.SetParameterString("tmpdir", tmpdir)
+
+        try:
+            # The following line execute the application
+            with report.step('LSMSSegmentation'):
+                app2.Execute()
         
 
-        # The following line creates an instance of the LSMSSmallRegionsMerging application
-        app3 = otbApplication.Registry.CreateApplication("LSMSSmallRegionsMerging")
+            # The following line creates an instance of the LSMSSmallRegionsMerging application
+            app3 = createApplication("LSMSSmallRegionsMerging")
 
-        # The following lines set all the application parameters:
-        app3.SetParameterString("in", image)
+            # The following lines set all the application parameters:
+            app3.SetParameterString("in", image)
 
-        app3.ConnectImage("inseg", app2, "out")
+            app3.ConnectImage("inseg", app2, "out")
 
-        app3.SetParameterString("out", segOut)
+            app3.SetParameterString("out", segOut)
 
-        app3.SetParameterInt("minsize", merg_minsize)
+            app3.SetParameterInt("minsize", merg_minsize)
 
-        app3.SetParameterInt("tilesizex", tilesizex)
+            app3.SetParameterInt("tilesizex", tilesizex)
 
-        app3.SetParameterInt("tilesizey", tilesizey)
+            app3.SetParameterInt("tilesizey", tilesizey)
 
-        # The following line execute the application
-        app3.ExecuteAndWriteOutput()
+            app3.SetParameterInt("ram", ram)
+
+            # The following line execute the application
+            with report.step('LSMSSmallRegionsMerging'):
+                app3.ExecuteAndWriteOutput()
+        finally:
+            # the tiles are read until the merged segmentation is written
+            if own:
+                shutil.rmtree(tmpdir, ignore_errors=True)
@@ -3,9 +3,14 @@
 #All Rights Reserved.
 
 import os
+import shutil
 from osgeo import gdal
 import numpy as np
 from otbApp import otbApp
+from glcm import GLCM_DIRECTIONS, glcm_features, compare_rasters
+from rasterutil import block_windows, write_feature_stack
+from scratch import scratch_dir, vsimem_path
+import report
 
 class PreProcessing(object):
     
@@ -13,7 +18,15 @@ class PreProcessing(object):
                  pathToFile,
                  imageFile,
                  demFile, 
-                 outPath):
+                 outPath,
+                 glcmMode='file',
+                 glcmCheck=False,
+                 streaming=False,
+                 scratchDir=None,
+                 featureStack=None,
+                 stackOverviews=False,
+                 featurePath=None,
+                 glcmCores=None):
         
         if not pathToFile:
             raise RuntimeError('A path to a file must be specified')
@@ -35,25 +48,63 @@ class PreProcessing(object):
             raise RuntimeError('A DEM must be specified')
         
         self._outPath = outPath
+        # directory the feature rasters are written to, outPath by default;
+        # run sets a scratch directory while stacking
+        self._featurePath = featurePath or outPath
+
+        # 'file': OTB writes temporary GeoTIFFs, 'memory': OTB in-memory export,
+        # 'native': NumPy engine of glcm.py, no OTB needed
+        if glcmMode not in ('file', 'memory', 'native'):
+            raise RuntimeError('Unknown GLCM mode: '+str(glcmMode))
+        self._glcmMode = glcmMode
+        # compare the native GLCM rasters with OTB when OTB is present
+        self._glcmCheck = glcmCheck
+        # workers of the native engine, all CPUs by default
+        self._glcmCores = glcmCores
+
+        # block-windowed reads and writes, memory bounded by block size
+        self._streaming = streaming
+        self._maxCache = {}
+
+        # temporary GeoTIFFs go to private directories in scratchDir, by
+        # default in the scratch root, see scratch.py
+        self._scratchDir = scratchDir
+
+        # write the features as one tiled multi-band GeoTIFF of this name in
+        # outPath instead of five rasters, see write_feature_stack
+        self._featureStack = featureStack
+        self._stackOverviews = stackOverviews
    
-    def getImgInfo(self, image, band=1):
-        """ Extract metadata from geotiff """
+    def getImgInfo(self, image, band=None):
+        """ Extract metadata from geotiff, and the maximum of band if given """
         img = gdal.Open(image)
         if img is None:
-            raise RuntimeError('Unable to open '+str(self.imagFile))
+            raise RuntimeError('Unable to open '+str(image))
         
         self._rows = img.RasterYSize
         self._cols = img.RasterXSize
         
-        bd = img.GetRasterBand(band)
-        arr = bd.ReadAsArray()
-        self._maxvalue = arr.max()
+        if band is not None:
+            bd = img.GetRasterBand(band)
+            if self._streaming:
+                self._maxvalue = self._bandMax(image, band, bd)
+            else:
+                arr = bd.ReadAsArray()
+                self._maxvalue = arr.max()
         
         self._geo=img.GetGeoTransform()
         self._proj=img.GetProjection()
                        
         img = None
  
+    def _bandMax(self, image, band, bd):
+        """ Exact maximum of a band, scanned block by block once per image """
+        key = (image, band)
+        if key not in self._maxCache:
+            # STATISTICS_MAXIMUM may be approximate, it would shift the GLCM bins
+            self._maxCache[key] = bd.ComputeRasterMinMax(False)[1]
+        return self._maxCache[key]
+
     def _writeTiff (self, filename, xsize, ysize, band, gdaltype, 
                     geo, proj,data):
         """ Write geotiff """
@@ -69,66 +120,157 @@ class PreProcessing(object):
         """ Compute textural features using OTB application """               
         self.getImgInfo(self.imgFile, 3)
         
-        mean_stack=np.zeros((4,self._rows,self._cols))
-        homog_stack=np.zeros((4,self._rows,self._cols))
+        if self._glcmMode == 'native':
+            self.generateNativeGLCM()
+            return
         
-        for x in range(4):
-            
-            if x==0:
-                cx=0
-                cy=1
-                dir=0
-            elif x==1:
-                cx=1
-                cy=1
-                dir=45
-            elif x==2:
-                cx=1
-                cy=0
-                dir=90
-            else:
-                cx=1
-                cy=-1
-                dir=135
-            
-            tmpfile = "mean_"+str(dir)+".tif"    
-            otbApp.runTextureExtraction(self.imgFile, 3, tmpfile, 
-                             cx, cy, 3, 3, 0, int(self._maxvalue), 32, 'advanced')
-            fd = gdal.Open( tmpfile )
-            band = fd.GetRasterBand(1)
-            arr = band.ReadAsArray()
-            mean_stack[x,:] = arr
-            os.remove(tmpfile)
-            
-            tmpfile = "homog_"+str(dir)+".tif"
+        # running float32 sums of the four directions
+        glcm_mean = np.zeros((self._rows,self._cols), dtype=np.float32)
+        glcm_homog = np.zeros((self._rows,self._cols), dtype=np.float32)
+
+        tmpdir = None
+        if self._glcmMode == 'file':
+            tmpdir = scratch_dir("glcm_"+self._fileName+"_", self._scratchDir)
+        try:
+            for cx, cy, dir in GLCM_DIRECTIONS:
+                self._glcmDirection(cx, cy, dir, glcm_mean, glcm_homog, tmpdir)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        glcm_mean /= len(GLCM_DIRECTIONS)
+        glcm_homog /= len(GLCM_DIRECTIONS)
+        self._writeGLCM(glcm_mean, glcm_homog)
+
+    def _glcmDirection(self, cx, cy, dir, glcm_mean, glcm_homog, tmpdir=None):
+        """ Add the GLCM mean and homogeneity of one direction with OTB """
+        if self._glcmMode == 'memory':
+            # band 1 of 'advanced' is the mean, band 4 of 'simple' the homogeneity
+            for y, arr in otbApp.textureStrips(self.imgFile, 3, 1, self._cols, self._rows,
+                             cx, cy, 3, 3, 0, int(self._maxvalue), 32, 'advanced'):
+                glcm_mean[y:y+arr.shape[0]] += arr
+
+            for y, arr in otbApp.textureStrips(self.imgFile, 3, 4, self._cols, self._rows,
+                             cx, cy, 3, 3, 0, int(self._maxvalue), 32, 'simple'):
+                glcm_homog[y:y+arr.shape[0]] += arr
+            return
+
+        for acc, texture, b, prefix in ((glcm_mean, 'advanced', 1, "mean_"),
+                                        (glcm_homog, 'simple', 4, "homog_")):
+            tmpfile = os.path.join(tmpdir, prefix+str(dir)+".tif")
             otbApp.runTextureExtraction(self.imgFile, 3, tmpfile, 
-                             cx, cy, 3, 3, 0, int(self._maxvalue), 32, 'simple')
+                             cx, cy, 3, 3, 0, int(self._maxvalue), 32, texture)
             fd = gdal.Open( tmpfile )
-            band = fd.GetRasterBand(4)
-            arr = band.ReadAsArray()
-            homog_stack[x,:] = arr
+            band = fd.GetRasterBand(b)
+            # strip by strip into the running sum
+            for xoff, yoff, xsize, ysize in block_windows(band):
+                acc[yoff:yoff+ysize] += band.ReadAsArray(xoff, yoff, xsize, ysize)
+            fd = None
             os.remove(tmpfile)
 
-                               
-        glcm_mean = np.mean(mean_stack, axis=0)
-        glcm_homog = np.mean(homog_stack, axis=0)
-        
+    def _writeGLCM(self, glcm_mean, glcm_homog):
+        """ Write the direction-averaged GLCM features """
         name = "mean_"+self._fileName+".tif"
-        mean_outfile = os.path.join(self._outPath, name)
+        mean_outfile = os.path.join(self._featurePath, name)
         self._writeTiff(mean_outfile, self._cols, self._rows, 1, gdal.GDT_Float32,
                         self._geo, self._proj, glcm_mean)
 
         name = "homog_"+self._fileName+".tif"
-        homog_outfile = os.path.join(self._outPath, name)
+        homog_outfile = os.path.join(self._featurePath, name)
         self._writeTiff(homog_outfile, self._cols, self._rows, 1, gdal.GDT_Float32,
                         self._geo, self._proj, glcm_homog)
 
+    def glcmDirection(self, direction, meanFile, homogFile):
+        """ GLCM mean and homogeneity of one of GLCM_DIRECTIONS to two GeoTIFFs
+
+        The four directions are independent, combineGLCM averages them.
+        """
+        self.getImgInfo(self.imgFile, 3)
+        cx, cy, dir = direction
+
+        if self._glcmMode == 'native':
+            glcm_features(self.imgFile, 3, meanFile, homogFile,
+                          0, int(self._maxvalue), nbins=32, rad=3,
+                          directions=[direction], cores=self._glcmCores)
+            return
+
+        glcm_mean = np.zeros((self._rows,self._cols), dtype=np.float32)
+        glcm_homog = np.zeros((self._rows,self._cols), dtype=np.float32)
+        tmpdir = None
+        if self._glcmMode == 'file':
+            tmpdir = scratch_dir("glcm_"+self._fileName+"_"+str(dir)+"_", self._scratchDir)
+        try:
+            self._glcmDirection(cx, cy, dir, glcm_mean, glcm_homog, tmpdir)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        self._writeTiff(meanFile, self._cols, self._rows, 1, gdal.GDT_Float32,
+                        self._geo, self._proj, glcm_mean)
+        self._writeTiff(homogFile, self._cols, self._rows, 1, gdal.GDT_Float32,
+                        self._geo, self._proj, glcm_homog)
+
+    def combineGLCM(self, meanFiles, homogFiles):
+        """ Average the GLCM features of glcmDirection over the directions """
+        self.getImgInfo(self.imgFile, 3)
+        glcm = []
+        for files in (meanFiles, homogFiles):
+            total = np.zeros((self._rows,self._cols), dtype=np.float32)
+            for f in files:
+                fd = gdal.Open(f)
+                band = fd.GetRasterBand(1)
+                for xoff, yoff, xsize, ysize in block_windows(band):
+                    total[yoff:yoff+ysize] += band.ReadAsArray(xoff, yoff, xsize, ysize)
+                fd = None
+            total /= len(files)
+            glcm.append(total)
+        self._writeGLCM(*glcm)
+
+        if self._glcmMode == 'native':
+            self._checkGLCM()
+
+    def generateNativeGLCM(self):
+        """ Compute textural features with the NumPy GLCM engine """
+        mean_outfile = os.path.join(self._featurePath, "mean_"+self._fileName+".tif")
+        homog_outfile = os.path.join(self._featurePath, "homog_"+self._fileName+".tif")
+        glcm_features(self.imgFile, 3, mean_outfile, homog_outfile,
+                      0, int(self._maxvalue), nbins=32, rad=3, cores=self._glcmCores)
+        self._checkGLCM()
+
+    def _checkGLCM(self):
+        """ Compare the native GLCM features with OTB, with glcmCheck """
+        if not self._glcmCheck:
+            return
+        if not otbApp.available():
+            print("OTB not available, skipping GLCM validation")
+            return
+
+        # run the OTB in-memory pipeline on the side and compare
+        tmpdir = scratch_dir("glcm_check_"+self._fileName+"_", self._scratchDir)
+        try:
+            name = self._fileName+".tif"
+            otb_mean = os.path.join(tmpdir, "mean_"+name)
+            otb_homog = os.path.join(tmpdir, "homog_"+name)
+            check = PreProcessing(os.path.dirname(self.imgFile), os.path.basename(self.imgFile),
+                                  os.path.basename(self.demFile), tmpdir,
+                                  glcmMode='memory')
+            check.generateGLCM()
+            native = self.featureFiles()
+            for feature, native, otb in (('mean', native['glcmmean'], otb_mean),
+                                         ('homog', native['glcmhomog'], otb_homog)):
+                res = compare_rasters(native, otb)
+                print("GLCM "+feature+" native vs OTB: max abs diff {max_abs_diff:.4g}, "
+                      "mean abs diff {mean_abs_diff:.4g}, correlation {correlation:.4f}".format(**res))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
     def generateSlope(self):
         """ Generate slope and clip """ 
-        gdal.DEMProcessing('slope.tif',self.demFile,'slope')
-        slope="slope.tif"
+        # the full-DEM slope stays in GDAL memory until it is clipped
+        slope = vsimem_path("slope_"+self._fileName+".tif")
+        gdal.DEMProcessing(slope,self.demFile,'slope')
 
-        self.getImgInfo(self.imgFile, 1)      
+        # only the grid of the image is needed
+        self.getImgInfo(self.imgFile)
 
         minx = self._geo[0]
         maxy = self._geo[3]
@@ -136,14 +278,20 @@ class PreProcessing(object):
         miny = maxy + self._geo[5] * self._rows
 
         name = "slope_"+self._fileName+".tif"
-        slope_outfile = os.path.join(self._outPath, name)
-        gdal.Translate(slope_outfile,slope,width=self._cols,height=self._rows,
-                       resampleAlg=0,format='GTiff',projWin=[minx,maxy,maxx,miny])
-        os.remove("slope.tif")
+        slope_outfile = os.path.join(self._featurePath, name)
+        try:
+            gdal.Translate(slope_outfile,slope,width=self._cols,height=self._rows,
+                           resampleAlg=0,format='GTiff',projWin=[minx,maxy,maxx,miny])
+        finally:
+            gdal.Unlink(slope)
              
     def generateIndex(self):
         """ Compute Brightness and NDVI """         
-        self.getImgInfo(self.imgFile, 3)
+        self.getImgInfo(self.imgFile)
+
+        if self._streaming:
+            self.generateIndexBlocks()
+            return
         
         img = gdal.Open(self.imgFile)
         
@@ -164,24 +312,78 @@ class PreProcessing(object):
         
         ndvi=(nir_flt-red_flt)/(nir_flt+red_flt)
         name = "ndvi_"+self._fileName+".tif"
-        ndvi_outfile = os.path.join(self._outPath, name)
+        ndvi_outfile = os.path.join(self._featurePath, name)
         self._writeTiff(ndvi_outfile, self._cols, self._rows, 1, gdal.GDT_Float32,
                         self._geo, self._proj, ndvi)        
 
         bright=(blue+green+red+nir)/4
         name = "bright_"+self._fileName+".tif"
-        bright_outfile = os.path.join(self._outPath, name)
+        bright_outfile = os.path.join(self._featurePath, name)
         self._writeTiff(bright_outfile, self._cols, self._rows, 1, gdal.GDT_Float32,
                         self._geo, self._proj, bright)
       
+    def generateIndexBlocks(self):
+        """ Compute Brightness and NDVI block by block as float32 """
+        img = gdal.Open(self.imgFile)
+        bands = [img.GetRasterBand(b) for b in (1, 2, 3, 5)]
+
+        driver = gdal.GetDriverByName("GTiff")
+        outs = []
+        for prefix in ("ndvi_", "bright_"):
+            name = prefix+self._fileName+".tif"
+            out = driver.Create(os.path.join(self._featurePath, name), self._cols, self._rows,
+                                1, gdal.GDT_Float32)
+            out.SetGeoTransform(self._geo)
+            out.SetProjection(self._proj)
+            outs.append(out)
+
+        for xoff, yoff, xsize, ysize in block_windows(bands[0]):
+            blue, green, red, nir = [b.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float32)
+                                     for b in bands]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ndvi = (nir-red)/(nir+red)
+            bright = (blue+green+red+nir)/4
+            outs[0].GetRasterBand(1).WriteArray(ndvi, xoff, yoff)
+            outs[1].GetRasterBand(1).WriteArray(bright, xoff, yoff)
+
+        outs = None
+        img = None
+      
+    def featureFiles(self):
+        """Feature rasters written by the generate methods, by feature name"""
+        names = {'glcmhomog': "homog_", 'glcmmean': "mean_", 'slope': "slope_",
+                 'bright': "bright_", 'ndvi': "ndvi_"}
+        return {k: os.path.join(self._featurePath, v+self._fileName+".tif")
+                for k, v in names.items()}
+
+    def stackFeatures(self):
+        """Write the feature stack from the single-band features"""
+        print("Stacking features")
+        write_feature_stack(self.featureFiles(),
+                            os.path.join(self._outPath, self._featureStack),
+                            overviews=self._stackOverviews)
+
     # run    
     def run(self):
-        print("Computing Textural Features")
-        self.generateGLCM()
-        print("Computing Slope")
-        self.generateSlope()
-        print("Computing NDVI and Brightness")
-        self.generateIndex()
+        if self._featureStack:
+            # single-band features are scratch files, stacked at the end
+            self._featurePath = scratch_dir("features_"+self._fileName+"_", self._scratchDir)
+        try:
+            print("Computing Textural Features")
+            with report.step('glcm', mode=self._glcmMode):
+                self.generateGLCM()
+            print("Computing Slope")
+            with report.step('slope'):
+                self.generateSlope()
+            print("Computing NDVI and Brightness")
+            with report.step('index', streaming=self._streaming):
+                self.generateIndex()
+            if self._featureStack:
+                self.stackFeatures()
+        finally:
+            if self._featureStack:
+                shutil.rmtree(self._featurePath, ignore_errors=True)
+                self._featurePath = self._outPath
         
 
 
@@ -0,0 +1,127 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+from osgeo import gdal, ogr, osr
+import geopandas as gpd
+from shapely import wkb
+import report
+
+def block_windows(band, min_pixels=1048576):
+    """Yield full-width row strips aligned with the native block size of band
+
+    Several block rows are grouped so that each strip holds at least about
+    min_pixels pixels, which keeps reads of striped GeoTIFFs efficient.
+    Windows are (xoff, yoff, xsize, ysize) tuples.
+    """
+    cols = band.XSize
+    rows = band.YSize
+    bh = band.GetBlockSize()[1]
+    nrows = max(bh, (min_pixels // max(cols, 1)) // bh * bh)
+    for yoff in range(0, rows, nrows):
+        yield 0, yoff, cols, min(nrows, rows - yoff)
+
+# OGR drivers of vector files by extension
+VECTOR_DRIVERS = {'.shp': 'ESRI Shapefile', '.gpkg': 'GPKG'}
+
+@report.timed('polygonize')
+def polygonize(raster, field=None, outFile=None):
+    """Polygonize band 1 of a raster
+
+    The polygons are written to outFile, a GeoPackage or a Shapefile, or
+    returned as a GeoDataFrame when outFile is None, without a round trip
+    through a file. field, if given, holds the pixel value of each polygon.
+    """
+    src_ds = gdal.Open(raster)
+    if src_ds is None:
+        raise RuntimeError('Unable to open '+str(raster))
+    srcband = src_ds.GetRasterBand(1)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(src_ds.GetProjection())
+
+    if outFile:
+        ext = os.path.splitext(outFile)[1].lower()
+        if ext not in VECTOR_DRIVERS:
+            raise RuntimeError('Unsupported vector format: '+str(outFile))
+        drv = ogr.GetDriverByName(VECTOR_DRIVERS[ext])
+        if os.path.exists(outFile):
+            drv.DeleteDataSource(outFile)
+        out_ds = drv.CreateDataSource(outFile)
+        name = os.path.splitext(os.path.basename(outFile))[0]
+    else:
+        out_ds = ogr.GetDriverByName("Memory").CreateDataSource('')
+        name = 'polygons'
+    layer = out_ds.CreateLayer(name, srs=srs)
+    idx = -1
+    if field:
+        layer.CreateField(ogr.FieldDefn(field, ogr.OFTInteger))
+        idx = 0
+    gdal.Polygonize(srcband, None, layer, idx, [], callback=None)
+    report.note(cols=src_ds.RasterXSize, rows=src_ds.RasterYSize,
+                segments=layer.GetFeatureCount())
+    src_ds = None
+
+    if outFile:
+        out_ds = None
+        return None
+
+    geoms = []
+    values = []
+    layer.ResetReading()
+    for feat in layer:
+        geoms.append(wkb.loads(bytes(feat.GetGeometryRef().ExportToWkb())))
+        if field:
+            values.append(feat.GetField(field))
+    data = {field: values} if field else {}
+    df = gpd.GeoDataFrame(data, geometry=geoms, crs=srs.ExportToWkt() or None)
+    out_ds = None
+    return df
+
+# bands of the feature stack, in order
+FEATURE_BANDS = ('glcmhomog', 'glcmmean', 'slope', 'bright', 'ndvi')
+
+def raster_ref(ref):
+    """(file, band) of a raster given as a file name or a (file, band) pair"""
+    if isinstance(ref, (tuple, list)):
+        return ref[0], int(ref[1])
+    return ref, 1
+
+def stack_bands(stackFile, names):
+    """(file, band) references of the named features of a feature stack"""
+    return [(stackFile, FEATURE_BANDS.index(n) + 1) for n in names]
+
+@report.timed('feature stack')
+def write_feature_stack(files, stackFile, overviews=False, blockSize=512):
+    """Write co-registered single-band rasters as one multi-band GeoTIFF
+
+    files maps the names of FEATURE_BANDS to single-band rasters. The
+    stack is float32, tiled in blockSize pixel tiles with pixel
+    interleaving, so that one window read returns every feature, and
+    DEFLATE compressed with the floating point predictor. Bands are
+    described by their feature name. With overviews, internal averaged
+    overviews are built down to about one tile.
+    """
+    vrt = gdal.BuildVRT('', [files[n] for n in FEATURE_BANDS], separate=True)
+    if vrt is None:
+        raise RuntimeError('Unable to stack '+', '.join(files[n] for n in FEATURE_BANDS))
+    ds = gdal.Translate(stackFile, vrt, format='GTiff', outputType=gdal.GDT_Float32,
+                        creationOptions=['TILED=YES', 'BLOCKXSIZE='+str(blockSize),
+                                         'BLOCKYSIZE='+str(blockSize), 'COMPRESS=DEFLATE',
+                                         'PREDICTOR=3', 'INTERLEAVE=PIXEL', 'BIGTIFF=IF_SAFER'])
+    vrt = None
+    for b, name in enumerate(FEATURE_BANDS):
+        ds.GetRasterBand(b + 1).SetDescription(name)
+    levels = []
+    if overviews:
+        f = 2
+        while max(ds.RasterXSize, ds.RasterYSize) // f >= blockSize:
+            levels.append(f)
+            f *= 2
+        if levels:
+            ds.BuildOverviews('AVERAGE', levels)
+    report.note(cols=ds.RasterXSize, rows=ds.RasterYSize, bands=ds.RasterCount,
+                overviews=levels)
+    ds = None
+    print("Wrote feature stack "+str(stackFile)+" with "+str(len(FEATURE_BANDS))+" bands"+
+          (", overviews "+str(levels) if levels else ""))
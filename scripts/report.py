@@ -0,0 +1,99 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import functools
+from contextlib import contextmanager
+
+# finished steps of this process, and the steps in progress
+_records = []
+_stack = []
+
+def _usage():
+    """CPU seconds of this process and of its waited-for children, peak RSS in MB"""
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    ch = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux
+    return (me.ru_utime + me.ru_stime, ch.ru_utime + ch.ru_stime,
+            me.ru_maxrss / 1024.0, ch.ru_maxrss / 1024.0)
+
+@contextmanager
+def step(name, **info):
+    """Time a step of the run
+
+    Records wall and CPU time, the CPU time of the child processes it
+    waited for, and the peak RSS of the process and of its children at
+    the end of the step, with how much the step raised them. Steps nest,
+    the record of a step is named after the steps enclosing it. info and
+    the values passed to note while the step runs are kept with it.
+    """
+    entry = {'step': '/'.join([e['name'] for e in _stack] + [name]), 'name': name}
+    entry.update(info)
+    _stack.append(entry)
+    cpu0, child0, rss0, crss0 = _usage()
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        wall = time.perf_counter() - start
+        cpu1, child1, rss1, crss1 = _usage()
+        _stack.pop()
+        entry.update({'wall_s': round(wall, 4),
+                      'cpu_s': round(cpu1 - cpu0, 4),
+                      'children_cpu_s': round(child1 - child0, 4),
+                      'peak_rss_mb': round(rss1, 1),
+                      'peak_rss_increase_mb': round(rss1 - rss0, 1),
+                      'children_peak_rss_mb': round(crss1, 1)})
+        del entry['name']
+        _records.append(entry)
+
+def timed(name):
+    """Decorator running a function as a step"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with step(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def add(name, **info):
+    """Record a step measured by the caller, e.g. summed over a loop"""
+    entry = {'step': '/'.join([e['name'] for e in _stack] + [name])}
+    entry.update(info)
+    _records.append(entry)
+
+def note(**info):
+    """Attach values, e.g. segment or worker counts, to the innermost step"""
+    if _stack:
+        _stack[-1].update(info)
+
+def collect():
+    """Remove and return the records of this process, e.g. in a pool worker"""
+    records = list(_records)
+    del _records[:]
+    return records
+
+def merge(records, prefix=None):
+    """Add records collected in another process under the current step"""
+    prefix = prefix or '/'.join(e['name'] for e in _stack)
+    for r in records:
+        r = dict(r)
+        if prefix:
+            r['step'] = prefix+'/'+r['step']
+        _records.append(r)
+
+def write(path, **run):
+    """Write the run report, run holds its arguments and summary values"""
+    doc = {'run': dict(run, host=socket.gethostname(), cpus=os.cpu_count(),
+                       python=sys.version.split()[0]),
+           'steps': _records}
+    with open(path, 'w') as fd:
+        json.dump(doc, fd, indent=2, default=str)
+    print("Run report written to "+str(path))
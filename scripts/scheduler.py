@@ -0,0 +1,192 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import time
+import queue
+import traceback
+import multiprocessing
+
+class Task(object):
+    """A node of the task graph run by a Scheduler
+
+    func is called as func(*args, upstream=..., tokens=...) in a worker
+    process, with the results of the tasks in deps by name and the
+    resource tokens granted to the task. It must be importable, the
+    workers are spawned. cost is a relative duration estimate used to
+    prioritize tasks on long paths of the graph.
+    """
+
+    def __init__(self, name, func, args=(), deps=(), resources=None, cost=1.0):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.deps = list(deps)
+        self.resources = dict(resources or {})
+        self.cost = cost
+
+def _run_task(results, name, func, args, upstream, tokens, initializer):
+    """Worker process body, reports (name, ok, result or traceback, seconds)"""
+    start = time.perf_counter()
+    try:
+        if initializer is not None:
+            initializer(tokens)
+        res = func(*args, upstream=upstream, tokens=tokens)
+        results.put((name, True, res, time.perf_counter() - start))
+    except BaseException:
+        results.put((name, False, traceback.format_exc(), time.perf_counter() - start))
+
+class Scheduler(object):
+    """Run a graph of tasks in worker processes under resource limits
+
+    resources maps a resource name to the number of tokens available, e.g.
+    {'otb': 2, 'zonal': 16}; a task starts once its dependencies are done
+    and the tokens it asks for, capped at the total, are free. Ready tasks
+    start by decreasing length of the longest path of costs to the end of
+    the graph, and tasks further down the list fill tokens left free by
+    tasks waiting for more. At most workers tasks run at once.
+
+    Every task runs in its own non-daemonic process, so it may create
+    process pools. initializer, if given, is called with the granted
+    tokens in the worker before the task.
+    """
+
+    def __init__(self, resources=None, workers=None, initializer=None):
+        self.capacity = dict(resources or {})
+        self.workers = workers or os.cpu_count()
+        self.initializer = initializer
+        self.tasks = {}
+        self.results = {}
+        self.report = {}
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise RuntimeError('Duplicate task: '+str(task.name))
+        self.tasks[task.name] = task
+        return task
+
+    def _rank(self):
+        """Longest path of costs from every task to the end of the graph"""
+        children = {name: [] for name in self.tasks}
+        for t in self.tasks.values():
+            for d in t.deps:
+                if d not in self.tasks:
+                    raise RuntimeError('Unknown dependency '+str(d)+' of '+str(t.name))
+                children[d].append(t.name)
+        rank = {}
+        def visit(name, path=()):
+            if name in path:
+                raise RuntimeError('Dependency cycle through '+str(name))
+            if name not in rank:
+                rank[name] = self.tasks[name].cost + max(
+                    [visit(c, path + (name,)) for c in children[name]], default=0.0)
+            return rank[name]
+        for name in self.tasks:
+            visit(name)
+        return rank
+
+    def criticalPath(self):
+        """Chain of dependent tasks with the longest measured run time
+
+        Computed from the task durations of the last run, returns the task
+        names from the first to the last and the sum of their seconds. Only
+        shortening these tasks shortens the graph on unlimited resources.
+        """
+        seconds = {n: t['seconds'] for n, t in self.report.get('tasks', {}).items()}
+        finish = {}
+        before = {}
+        def visit(name):
+            if name not in finish:
+                deps = [d for d in self.tasks[name].deps if d in seconds]
+                prev = max(deps, key=visit, default=None)
+                before[name] = prev
+                finish[name] = seconds[name] + (finish[prev] if prev else 0.0)
+            return finish[name]
+        last = max(seconds, key=visit, default=None)
+        path = []
+        while last is not None:
+            path.append(last)
+            last = before[last]
+        return path[::-1], sum(seconds[n] for n in path)
+
+    def _tokens(self, task):
+        return {r: min(n, self.capacity.get(r, n)) for r, n in task.resources.items()}
+
+    def run(self):
+        """Run all tasks, returns their results by name
+
+        A failed task does not stop the tasks that do not depend on it;
+        once the graph is drained a RuntimeError lists the failures.
+        """
+        rank = self._rank()
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        free = dict(self.capacity)
+        pending = dict(self.tasks)
+        running = {}
+        done = self.results = {}
+        failed = {}
+        start = time.perf_counter()
+        self.report = {'tasks': {}}
+
+        while pending or running:
+            for name in sorted(pending, key=lambda n: -rank[n]):
+                task = pending[name]
+                if any(d in failed for d in task.deps):
+                    failed[name] = 'dependency failed'
+                    del pending[name]
+                    continue
+                if len(running) >= self.workers or not all(d in done for d in task.deps):
+                    continue
+                tokens = self._tokens(task)
+                if any(free.get(r, n) < n for r, n in tokens.items()):
+                    continue
+                for r, n in tokens.items():
+                    if r in free:
+                        free[r] -= n
+                upstream = {d: done[d] for d in task.deps}
+                p = ctx.Process(target=_run_task, name=name,
+                                args=(results, name, task.func, task.args, upstream,
+                                      tokens, self.initializer))
+                p.start()
+                running[name] = (p, tokens, time.perf_counter() - start)
+                del pending[name]
+                print("scheduler: started "+name)
+
+            if not running:
+                continue
+            try:
+                name, ok, res, seconds = results.get(timeout=1.0)
+            except queue.Empty:
+                # a worker killed before it could report
+                dead = [n for n, (p, _, _) in running.items()
+                        if p.exitcode is not None and p.exitcode != 0]
+                if not dead:
+                    continue
+                name, ok, res, seconds = dead[0], False, 'exit code '+str(
+                    running[dead[0]][0].exitcode), 0.0
+            p, tokens, began = running.pop(name)
+            p.join()
+            for r, n in tokens.items():
+                if r in free:
+                    free[r] += n
+            self.report['tasks'][name] = {'start': began, 'seconds': seconds, 'ok': ok}
+            if ok:
+                done[name] = res
+                print("scheduler: finished "+name+" in "+"{:.1f}".format(seconds)+"s")
+            else:
+                failed[name] = res
+                print("scheduler: "+name+" failed\n"+str(res))
+
+        wall = time.perf_counter() - start
+        busy = sum(t['seconds'] for t in self.report['tasks'].values())
+        path, length = self.criticalPath()
+        self.report.update({'wall': wall, 'busy': busy, 'failed': sorted(failed),
+                            'critical_path': path, 'critical_seconds': length})
+        print("scheduler: "+str(len(done))+" tasks done, "+str(len(failed))+" failed, "+
+              "{:.1f}s wall, {:.1f}s of task time".format(wall, busy))
+        print("scheduler: critical path "+" > ".join(path)+" {:.1f}s".format(length))
+        if failed:
+            raise RuntimeError('Failed tasks: '+', '.join(sorted(failed)))
+        return done
@@ -0,0 +1,24 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import uuid
+import tempfile
+
+def scratch_root():
+    """Directory of the scratch files, SALAD_SCRATCH or the system temporary directory
+
+    Point SALAD_SCRATCH at fast local storage, e.g. a node-local SSD.
+    """
+    root = os.environ.get('SALAD_SCRATCH') or tempfile.gettempdir()
+    os.makedirs(root, exist_ok=True)
+    return root
+
+def scratch_dir(prefix, dir=None):
+    """New private scratch directory in dir or the scratch root, removed by the caller"""
+    return tempfile.mkdtemp(prefix=prefix, dir=dir or scratch_root())
+
+def vsimem_path(name):
+    """Unique GDAL in-memory file name, gdal.Unlink it once done"""
+    return '/vsimem/'+uuid.uuid4().hex+'_'+name
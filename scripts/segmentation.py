@@ -5,33 +5,47 @@
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-from otbApp import otbApp
-from osgeo import gdal, ogr, osr
-import fiona
+from otbApp import otbApp, budget
+from osgeo import gdal
 import pysal as ps
-import itertools
-import multiprocessing
-from functools import partial
-from rasterstats import zonal_stats
+from zonal import label_zonal_stats, label_values, label_overlap, zonal_stats_table
+from weights import label_adjacency, segment_weights, moran_i
+from tiling import tiled_lsms
+from rasterutil import polygonize, stack_bands, raster_ref
+from scratch import scratch_dir
+from detection import segment_features, write_feature_table
+import report
 import os
 import glob
+import copy
+import shutil
+import multiprocessing
 
-def chunks(data, n):
-    """Break down polygons into chunks"""
-    for i in range(0, len(data), n):
-        yield data[i:i+n]
+def plateau(hr_list):
+    """Plateau Objective Function over (hr, weighted variance, Moran's I)
 
-def zonal_stats_wrapper(feats, tif, stats):
-    return zonal_stats(feats, tif, stats=stats, nodata=-999)
-    
-def zonal_stats_parallel(features, cores, raster, opr):
-    """Compute zonal_stats in parallel"""
-    p = multiprocessing.Pool(cores)
-    func = partial(zonal_stats_wrapper, tif=raster, stats=opr)
-    stats_lists = p.map(func, chunks(features, cores))
-    stat = list(itertools.chain(*stats_lists))
-    p.close()
-    return stat
+    Returns the scored table and the smallest hr whose F_v_I exceeds
+    the plateau threshold.
+    """
+    cols=['hr','v','I']
+    hr_df = pd.DataFrame(hr_list,columns=cols)
+    v_max = hr_df['v'].max()
+    hr_df['F_v'] = (v_max - hr_df['v']) / (v_max - hr_df['v'].min())
+    i_max = hr_df['I'].max()
+    hr_df['F_I'] = (i_max - hr_df['I']) / (i_max - hr_df['I'].min())
+    hr_df['F_v_I'] = hr_df['F_v'] + hr_df['F_I']
+    F_plateau = hr_df['F_v_I'].max() - hr_df['F_v_I'].std()
+    peak = hr_df.loc[hr_df['F_v_I'] > F_plateau]
+    hr = peak['hr'].iloc[0]
+    hr = int(hr)
+    return hr_df, hr
+
+def _score_radius(args):
+    """Score one hr candidate in a worker of the hr sweep"""
+    seg, train_file, size, tmpdir = args
+    # daemonic pool workers run zonal_stats in-process
+    res = seg.scoreRadius(train_file, size, cores=1, tmpdir=tmpdir)
+    return res, report.collect()
 
 class Segmentation(object):
     
@@ -40,40 +54,46 @@ class Segmentation(object):
                  imageFile, brightFile, ndviFile, 
                  slopeFile, homogFile, meanFile, 
                  outPath, overLap, ulX, ulY, lrX, lrY,
-                 hr_Min,hr_Max, Step_Size, Spatial_Radius, Object_Size):        
+                 hr_Min,hr_Max, Step_Size, Spatial_Radius, Object_Size,
+                 Zonal_Engine='vector', Pool=None, POF_Workers=1, Weights='polygon',
+                 LSMS_Tile=None, LSMS_Overlap=64, LSMS_Workers=None,
+                 Training_Labels='vector', Scratch_Dir=None, Feature_Stack=None,
+                 Feature_Table=None):        
         if not pathToFile:
             raise RuntimeError('A path to a file must be specified')
         
         if not os.path.exists(pathToFile):
             raise RuntimeError(str(pathToFile) + 'does not exist.')
 
-        self.manual = os.path.join(pathToFile, Manual)
-        if not os.path.isfile(self.manual):
-            raise RuntimeError('A manual landslide shape file must be specified')
+        # scenes segmented with the hr of another scene have no manual landslides
+        self.manual = None
+        if Manual:
+            self.manual = os.path.join(pathToFile, Manual)
+            if not os.path.isfile(self.manual):
+                raise RuntimeError('A manual landslide shape file must be specified')
         
         self.imgFile = os.path.join(pathToFile,imageFile)
         if not os.path.isfile(self.imgFile):
             raise RuntimeError('An image must be specified')
 
-        self.brightfile = os.path.join(outPath, brightFile)
-        if not os.path.isfile(self.brightfile):
-            raise RuntimeError('A brightness file must be specified')
-
-        self.ndvifile = os.path.join(outPath, ndviFile) 
-        if not os.path.isfile(self.ndvifile):
-            raise RuntimeError('A NDVI file must be specified')
-      
-        self.slopefile = os.path.join(outPath, slopeFile) 
-        if not os.path.isfile(self.slopefile):
-            raise RuntimeError('A slope file must be specified')
- 
-        self.homogfile = os.path.join(outPath, homogFile)
-        if not os.path.isfile(self.homogfile):
-            raise RuntimeError('A GLCM Homogeneity file must be specified')
-
-        self.meanfile = os.path.join(outPath, meanFile)        
-        if not os.path.isfile(self.meanfile):
-            raise RuntimeError('A GLCM Mean file must be specified')
+        # features are (file, band) references into a feature stack, or files
+        if Feature_Stack:
+            stack = os.path.join(outPath, Feature_Stack)
+            if not os.path.isfile(stack):
+                raise RuntimeError('A feature stack must be specified')
+            (self.brightfile, self.ndvifile, self.slopefile, self.homogfile,
+             self.meanfile) = stack_bands(stack, ('bright', 'ndvi', 'slope', 'glcmhomog', 'glcmmean'))
+        else:
+            # the hr selection only needs the brightness, the other
+            # features may still be computed, see requireFeatures
+            self.brightfile = os.path.join(outPath, brightFile)
+            if not os.path.isfile(self.brightfile):
+                raise RuntimeError('A brightness file must be specified')
+
+            self.ndvifile = os.path.join(outPath, ndviFile) 
+            self.slopefile = os.path.join(outPath, slopeFile) 
+            self.homogfile = os.path.join(outPath, homogFile)
+            self.meanfile = os.path.join(outPath, meanFile)        
 
         self.overlap = overLap        
         self.ulx=ulX
@@ -85,26 +105,157 @@ class Segmentation(object):
         self.step_size=Step_Size 
         self.spatial_radius=Spatial_Radius
         self.object_size=Object_Size        
-        self.outfile=outPath+"training.shp"
+        # outputs are named after the scene, scenes may share outPath
+        self.outfile=os.path.join(outPath, "training_"+imageFile.split('.')[0]+".gpkg")
+
+        # 'vector': polygonize + rasterstats, 'label': reduce the LSMS label raster
+        if Zonal_Engine not in ('vector', 'label'):
+            raise RuntimeError('Unknown zonal engine: '+str(Zonal_Engine))
+        self.zonal_engine=Zonal_Engine
+        # worker pool shared by the zonal passes of the run, if any
+        self.pool=Pool
+        # number of hr candidates segmented and scored concurrently
+        self.pof_workers=max(1, POF_Workers or 1)
+        # Moran's I weights: 'polygon' queen contiguity of the polygons,
+        # 'raster' adjacency of the label raster, 'check' both
+        if Weights not in ('polygon', 'raster', 'check'):
+            raise RuntimeError('Unknown spatial weights: '+str(Weights))
+        self.weights=Weights
+        # tile size, overlap and workers of the tile-parallel full-scene LSMS
+        self.lsms_tile=LSMS_Tile
+        self.lsms_overlap=LSMS_Overlap
+        self.lsms_workers=LSMS_Workers
+        self.seam_report=None
+        # 'vector': overlap of the training segments with the manual landslides
+        # by vector overlay, 'raster': by counting pixels of the rasterized landslides
+        if Training_Labels not in ('vector', 'raster'):
+            raise RuntimeError('Unknown training label mode: '+str(Training_Labels))
+        if Training_Labels == 'raster' and Zonal_Engine != 'label':
+            raise RuntimeError('Raster training labels need the label zonal engine')
+        self.training_labels=Training_Labels
 
 
         nm = imageFile.split('.')[0]    
         self._fileName = nm
         self._img = self.imgFile
         self._outPath = outPath
+        # LSMS temporary tiles go to private directories in Scratch_Dir, by
+        # default in the scratch root, see scratch.py
+        self._scratchDir = Scratch_Dir
+        # per-segment feature table of the full-scene segmentation, for Detection
+        self.featuretable = None
+        if Feature_Table:
+            self.featuretable = os.path.join(outPath, Feature_Table)
+
+    @report.timed('hr candidate')
+    def scoreRadius(self, train_file, size, cores=None, tmpdir=None):
+        """Segment the training area with range radius size and score it"""
+        seg_Out = os.path.join(self._outPath, "merg_"+self._fileName+"_"+str(size)+".tif")
+        seg_file = os.path.join(self._outPath, "seg_"+self._fileName+"_"+str(size)+".gpkg")
+        
+        otbApp.runLSMS(train_file, seg_Out, spatialr=self.spatial_radius, ranger=size,
+                       merg_minsize=self.object_size, tmpdir=tmpdir)
+        
+        # raster weights need the label of each polygon
+        field = None
+        if self.zonal_engine == 'label' or self.weights != 'polygon':
+            field = 'label'
+
+        # polygons stay in memory until the scored segmentation is written
+        df = polygonize(seg_Out, field=field)
+
+        if self.zonal_engine == 'label':
+            table = label_zonal_stats(seg_Out, {'bright': self.brightfile}, ['mean', 'std'])
+            brightness_mean_list = label_values(table, df['label'], 'bright_mean')
+            brightness_std_list = label_values(table, df['label'], 'bright_std')
+        else:
+            cores = cores or os.cpu_count()
+        
+            # mean and std in a single pass over the brightness raster
+            table = zonal_stats_table(list(df.geometry), {'bright': (self.brightfile, ['mean', 'std'])},
+                                      pool=self.pool, cores=cores)
+            brightness_mean_list = table['bright_mean'].values
+            brightness_std_list = table['bright_std'].values
+
+        # calculate weighted variance
+        df['Meanbright']=brightness_mean_list
+        df['std']=brightness_std_list
+        df['area']=df['geometry'].area
+        df['var']=df['std']*df['std']
+        df['area_var']=df['var']*df['area']
+        df_final = df.replace([np.inf, -np.inf], np.nan)
+        df_final=df_final.fillna(0)
+        df_final.to_file(seg_file, driver='GPKG')
+        wt_var=df['area_var'].sum()/df['area'].sum()
+
+        # calculate Moran's I
+        if self.weights == 'polygon':
+            W = ps.weights.Queen.from_dataframe(df_final)
+            moran_I = ps.Moran(df['Meanbright'].values, W).I
+        else:
+            # queen adjacency from neighbouring pixel labels
+            W = segment_weights(label_adjacency(seg_Out), df['label'].values)
+            moran_I = moran_i(df['Meanbright'].values, W)
+            if self.weights == 'check':
+                ref_I = ps.Moran(df['Meanbright'].values, ps.weights.Queen.from_dataframe(df_final)).I
+                print("hr "+str(size)+": Moran's I raster weights "+str(moran_I)+
+                      ", polygon weights "+str(ref_I))
+
+        # label rasters are kept for the training step in label mode
+        if self.zonal_engine != 'label':
+            os.remove(seg_Out)
+
+        report.note(hr=size, segments=len(df), v=wt_var, I=moran_I)
+        print("hr "+str(size)+": v="+str(wt_var)+", I="+str(moran_I))
+        return (size, wt_var, moran_I)
+
+    def sweepRadius(self, train_file, sizes):
+        """Score the hr candidates concurrently in a process pool"""
+        workers = min(self.pof_workers, len(sizes))
+        ram, threads = budget(workers)
+        print("Scoring "+str(len(sizes))+" hr candidates with "+str(workers)+
+              " workers, "+str(ram)+" MB and "+str(threads)+" threads each")
+
+        # workers get their own copy, without the zonal pool of this process
+        seg = copy.copy(self)
+        seg.pool = None
+        tmpdirs = [scratch_dir("lsms_"+self._fileName+"_"+str(size)+"_", self._scratchDir)
+                   for size in sizes]
+        # spawn so that each worker starts OTB with its own thread budget
+        p = multiprocessing.get_context('spawn').Pool(workers, initializer=otbApp.setBudget,
+                                                      initargs=(ram, threads))
+        try:
+            results = p.map(_score_radius, [(seg, train_file, size, tmp)
+                                            for size, tmp in zip(sizes, tmpdirs)], chunksize=1)
+        finally:
+            p.close()
+            p.join()
+            for tmp in tmpdirs:
+                shutil.rmtree(tmp, ignore_errors=True)
+        hr_list = []
+        for res, records in results:
+            hr_list.append(res)
+            report.merge(records)
+        return hr_list
+
+    def selectRadius(self, hr_list):
+        """Pick hr with the Plateau Objective Function and write the POF table"""
+        hr_df, hr = plateau(hr_list)
+        self.writePOF(hr_df)
+
+        return hr
+
+    def writePOF(self, hr_df):
+        """Log the scored hr candidates to POF_<image>.csv"""
+        csv_file=os.path.join(self._outPath,'POF_'+self._fileName+'.csv')
+        hr_df.to_csv(csv_file)
+
+    def scoreRadii(self, train_file, sizes):
+        """Score a list of hr candidates, concurrently if configured"""
+        if self.pof_workers > 1 and len(sizes) > 1:
+            return self.sweepRadius(train_file, sizes)
+        return [self.scoreRadius(train_file, size) for size in sizes]
 
-    def rasterToShape(self, raster, shp):
-        """Convert segmentation result from geotiff to shape file"""
-        src_ds = gdal.Open(raster)
-        srcband = src_ds.GetRasterBand(1)
-        srs = osr.SpatialReference()
-        srs.ImportFromWkt(src_ds.GetProjection())
-        drv = ogr.GetDriverByName("ESRI Shapefile")
-        seg_ds = drv.CreateDataSource(shp)
-        seg_layer = seg_ds.CreateLayer(shp, srs = srs)
-        gdal.Polygonize(srcband, None, seg_layer, -1, [], callback=None)
-        seg_ds = None
-    
     def getRadius(self):
         """Compute Range Radius and create training shapefile"""
         
@@ -112,68 +263,24 @@ class Segmentation(object):
         train_file=os.path.join(self._outPath, self._fileName+'_train.tif')
         gdal.Translate(train_file,self._img, format='GTiff', projWin=[self.ulx,self.uly,self.lrx,self.lry])
                 
-        hr_list = []
-       
-        for size in range(self.hr_min, self.hr_max, self.step_size):
-            seg_Out = os.path.join(self._outPath, "merg_"+self._fileName+"_"+str(size)+".tif")
-            shp_file = os.path.join(self._outPath, "seg_"+self._fileName+"_"+str(size)+".shp")
-            
-            otbApp.runLSMS(train_file, seg_Out, spatialr=self.spatial_radius, ranger=size, merg_minsize=self.object_size)
-            
-            self.rasterToShape(seg_Out, shp_file)
-            
-            shp_open=fiona.open(shp_file)
+        sizes = list(range(self.hr_min, self.hr_max, self.step_size))
 
-            with shp_open as src:
-                features = list(src)
-    
-            cores = os.cpu_count()
-        
-            tif = self.brightfile
-
-            brightness_mean = zonal_stats_parallel(features, cores, tif, "mean")
-            brightness_mean_list = list(d["mean"] for d in brightness_mean)
-
-            brightness_std = zonal_stats_parallel(features, cores, tif, "std")
-            brightness_std_list = list(d["std"] for d in brightness_std)
-
-            # calculate weighted variance
-            df = gpd.read_file(shp_file)
-            df['Meanbright']=brightness_mean_list
-            df['std']=brightness_std_list
-            df['area']=df['geometry'].area
-            df['var']=df['std']*df['std']
-            df['area_var']=df['var']*df['area']
-            df_final = df.replace([np.inf, -np.inf], np.nan)
-            df_final=df_final.fillna(0)
-            df_final.to_file(shp_file)
-            wt_var=df['area_var'].sum()/df['area'].sum()
-
-            # calculate Moran's I
-            W = ps.queen_from_shapefile(shp_file)
-            moran = ps.Moran(df['Meanbright'].values, W)
-
-            hr_list.append((size, wt_var, moran.I))
-            os.remove(seg_Out)
+        hr_list = self.scoreRadii(train_file, sizes)
             
-            
-        cols=['hr','v','I']
-        hr_df = pd.DataFrame(hr_list,columns=cols)
-        v_max = hr_df['v'].max()
-        hr_df['F_v'] = (v_max - hr_df['v']) / (v_max - hr_df['v'].min())
-        i_max = hr_df['I'].max()
-        hr_df['F_I'] = (i_max - hr_df['I']) / (i_max - hr_df['I'].min())
-        hr_df['F_v_I'] = hr_df['F_v'] + hr_df['F_I']
-        F_plateau = hr_df['F_v_I'].max() - hr_df['F_v_I'].std()
-        peak = hr_df.loc[hr_df['F_v_I'] > F_plateau]
-        hr = peak['hr'].iloc[0]
-        hr = int(hr)
-        csv_file=os.path.join(self._outPath,'POF.csv')
-        hr_df.to_csv(csv_file)
-
-        return hr
+        return self.selectRadius(hr_list)
     
-    def training(self, shapeIn: str):
+    def requireFeatures(self):
+        """Check the features training and segment read are written"""
+        for name, f in (('A NDVI file', self.ndvifile), ('A slope file', self.slopefile),
+                        ('A GLCM Homogeneity file', self.homogfile),
+                        ('A GLCM Mean file', self.meanfile)):
+            if not os.path.isfile(raster_ref(f)[0]):
+                raise RuntimeError(name+' must be specified')
+
+    def training(self, shapeIn: str, labelRaster=None):
+        if self.manual is None:
+            raise RuntimeError('A manual landslide shape file must be specified')
+        self.requireFeatures()
           
         rasters = {'ndvi'       : self.ndvifile,
                    'slope'      : self.slopefile,
@@ -183,21 +290,24 @@ class Segmentation(object):
         # dictionary to host output zonal stats
         out_stat = dict.fromkeys(rasters)
 
-        # open shapefile and read features once
-        shp_open=fiona.open(shapeIn)
-        with shp_open as src:
-            features = list(src)
-    
-        cores = os.cpu_count()
-        
-        # loop through rasters for zonal stats
-        for k in rasters.keys():
-            tif = rasters[k]
-            stat = zonal_stats_parallel(features, cores, tif, 'mean')
-            out_stat[k] = list(d["mean"] for d in stat)
-                
-        # add feature back to shapefile
+        # read the segmentation once
         df = gpd.read_file(shapeIn)
+
+        if labelRaster:
+            # one pass over the label raster for all rasters
+            table = label_zonal_stats(labelRaster, rasters, ['mean'])
+            for k in rasters.keys():
+                out_stat[k] = label_values(table, df['label'], k+'_mean')
+        else:
+            cores = os.cpu_count()
+            
+            # all rasters in a single pass over the features
+            table = zonal_stats_table(list(df.geometry), {k: (tif, ['mean']) for k, tif in rasters.items()},
+                                      pool=self.pool, cores=cores)
+            for k in rasters.keys():
+                out_stat[k] = table[k+'_mean'].values
+
+        # add feature back to shapefile
         df["Meanndvi"] = out_stat['ndvi']
         df["Meanslope"] = out_stat['slope']
         df["glcmhomog"] = out_stat['glcmhomog']
@@ -205,6 +315,18 @@ class Segmentation(object):
         df_final = df.replace([np.inf, -np.inf], np.nan)
         df_final = df_final.fillna(0)
 
+        if self.training_labels == 'raster':
+            # as in the vector path, the first manual landslide is skipped
+            # (index_right > 0) and the overlap with each landslide counts
+            # separately
+            share = label_overlap(labelRaster, self.manual, exclude=[0])
+            training = df_final.copy()
+            share = share.reindex(df_final['label'].values).fillna(0).values
+            training['landslide'] = (share >= self.overlap).astype(int)
+            training = training.drop(['std','area','var','area_var','FID'], axis=1, errors='ignore')
+            training.to_file(self.outfile, driver='GPKG')
+            return
+
         # Select intersecting polygons
         select_feature = gpd.read_file(self.manual)
         selection = gpd.sjoin(df_final, select_feature, how='inner', op='intersects')
@@ -224,36 +346,89 @@ class Segmentation(object):
         landslide = gpd.sjoin(df_final, final_intersect, how="inner", op='contains')
         landslide['landslide'] = 1
         landslide.drop(['percentage','index_right'], axis=1, inplace=True)
-        non_landslide = df_final.drop(landslide['FID'], errors='ignore')
+        # segments are identified by row index, shapefiles with a label
+        # field carry no FID column
+        non_landslide = df_final.drop(landslide.index, errors='ignore')
         non_landslide['landslide'] = 0
 
         # Join and save the training data
         training = landslide.append(non_landslide)
-        training = training.sort_values(by=['FID'])
-        training = training.drop(['std','area','var','area_var','FID'], axis=1)
-        training.to_file(self.outfile)
+        training = training.sort_index()
+        training = training.drop(['std','area','var','area_var','FID'], axis=1, errors='ignore')
+        training.to_file(self.outfile, driver='GPKG')
             
-    def run(self):
-        
-        print("Computing Radius")
-        hr = self.getRadius()
-        
+    def segment(self, hr):
+        """Segment the full scene with range radius hr"""
+        self.requireFeatures()
         segOut = os.path.join(self._outPath, "merg_"+self._fileName+".tif")
-        shapeOut = os.path.join(self._outPath, self._fileName+".shp")
+        shapeOut = os.path.join(self._outPath, self._fileName+".gpkg")
 
-        print("Running OTB LSMS")
-        otbApp.runLSMS(self._img, segOut, spatialr=self.spatial_radius, ranger=hr, merg_minsize=self.object_size)
+        if self.lsms_tile:
+            print("Running tiled OTB LSMS")
+            self.seam_report = tiled_lsms(self._img, segOut, tile=self.lsms_tile,
+                                          overlap=self.lsms_overlap, workers=self.lsms_workers,
+                                          spatialr=self.spatial_radius, ranger=hr,
+                                          merg_minsize=self.object_size,
+                                          scratch=self._scratchDir)
+        else:
+            print("Running OTB LSMS")
+            # private LSMS tiles, scenes may run side by side
+            tmpdir = scratch_dir("lsms_"+self._fileName+"_", self._scratchDir)
+            try:
+                otbApp.runLSMS(self._img, segOut, spatialr=self.spatial_radius, ranger=hr,
+                               merg_minsize=self.object_size, tmpdir=tmpdir)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
         
         print("Writing Segmentation Result")
-        self.rasterToShape(segOut, shapeOut)
+        # the label raster is kept for Detection in label mode
+        field = 'label' if self.zonal_engine == 'label' else None
+        if self.featuretable:
+            # the polygons stay in memory for the features of every segment
+            df = polygonize(segOut, field=field)
+            df.to_file(shapeOut, driver='GPKG')
+            rasters = {'brightness' : self.brightfile,
+                       'ndvi'       : self.ndvifile,
+                       'slope'      : self.slopefile,
+                       'glcmhomog'  : self.homogfile,
+                       'glcmmean'   : self.meanfile}
+            features = segment_features(df, rasters, labelRaster=segOut if field else None,
+                                        pool=self.pool)
+            write_feature_table(df, features, self.featuretable)
+        else:
+            polygonize(segOut, field=field, outFile=shapeOut)
+        if not field:
+            os.remove(segOut)
+
+    def trainingFiles(self, hr):
+        """Segmentation of the training area for hr, GeoPackage and label raster"""
+        shape_training = os.path.join(self._outPath, 
+                                    "seg_"+self._fileName+"_"+str(hr)+".gpkg")
+        label_training = None
+        if self.zonal_engine == 'label':
+            label_training = os.path.join(self._outPath,
+                                    "merg_"+self._fileName+"_"+str(hr)+".tif")
+        return shape_training, label_training
+
+    def cleanRadius(self, keep=None):
+        """Remove files generated during POF, except those of hr keep"""
+        keep = [os.path.abspath(f) for f in self.trainingFiles(keep) if f] if keep else []
+        keep = [os.path.splitext(f)[0] for f in keep]
+        for f in glob.glob(os.path.join(self._outPath,"seg_"+self._fileName+"_*.*")):
+            if os.path.splitext(os.path.abspath(f))[0] not in keep:
+                os.remove(f)
+        for f in glob.glob(os.path.join(self._outPath,"merg_"+self._fileName+"_*.tif")):
+            if os.path.splitext(os.path.abspath(f))[0] not in keep:
+                os.remove(f)
 
-        os.remove(segOut)
+    def run(self):
+        
+        print("Computing Radius")
+        hr = self.getRadius()
+        
+        self.segment(hr)
         
         print("Creating Training file")
-        shape_training = os.path.join(self._outPath, 
-                                    "seg_"+self._fileName+"_"+str(hr)+".shp")
-        self.training(shape_training)
+        self.training(*self.trainingFiles(hr))
 
-        # Remove files generated during POF
-        for f in glob.glob(os.path.join(self._outPath,"seg_*.*")):
-        	os.remove(f)
+        self.cleanRadius()
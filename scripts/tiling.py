@@ -0,0 +1,186 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import shutil
+import multiprocessing
+from osgeo import gdal
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from otbApp import otbApp, budget
+from scratch import scratch_dir
+import report
+
+def tile_grid(cols, rows, tile, overlap):
+    """Split a scene into tiles
+
+    Returns one dict per tile with its position in the tile grid, its core
+    window, which tiles the scene without overlap, and its read window,
+    the core grown by overlap pixels on every side and clipped to the
+    scene. Windows are (xoff, yoff, xsize, ysize).
+    """
+    tiles = []
+    for j, y in enumerate(range(0, rows, tile)):
+        for i, x in enumerate(range(0, cols, tile)):
+            core = (x, y, min(tile, cols - x), min(tile, rows - y))
+            x0 = max(0, x - overlap)
+            y0 = max(0, y - overlap)
+            x1 = min(cols, x + core[2] + overlap)
+            y1 = min(rows, y + core[3] + overlap)
+            tiles.append({'col': i, 'row': j, 'core': core,
+                          'read': (x0, y0, x1 - x0, y1 - y0)})
+    return tiles
+
+def _segment_tile(args):
+    """Cut one tile out of the scene and run LSMS on it"""
+    image, tile, tmpdir, lsms = args
+    name = "tile_"+str(tile['row'])+"_"+str(tile['col'])
+    tile_img = os.path.join(tmpdir, name+".tif")
+    tile_seg = os.path.join(tmpdir, name+"_seg.tif")
+    gdal.Translate(tile_img, image, format='GTiff', srcWin=list(tile['read']))
+    lsms_tmp = scratch_dir(name+"_", tmpdir)
+    try:
+        with report.step(name, window=list(tile['read'])):
+            otbApp.runLSMS(tile_img, tile_seg, tmpdir=lsms_tmp, **lsms)
+    finally:
+        shutil.rmtree(lsms_tmp, ignore_errors=True)
+        os.remove(tile_img)
+    return tile_seg, report.collect()
+
+def _read(tile, seg, window):
+    """Read a window given in scene coordinates from a tile label raster"""
+    x, y, w, h = window
+    ds = gdal.Open(seg)
+    arr = ds.GetRasterBand(1).ReadAsArray(x - tile['read'][0], y - tile['read'][1], w, h)
+    ds = None
+    return arr.astype(np.int64)
+
+def _seam_pairs(ta, sa, oa, tb, sb, ob, window, axis):
+    """Global labels on both sides of the seam between tiles a and b
+
+    window covers the last core line of a and the first core line of b,
+    axis is 1 for a vertical seam. Returns the labels of the a side and of
+    the b side, and a mask of the pixel pairs straddling the seam that
+    both tiles put in a single segment, which are merged.
+    """
+    la = _read(ta, sa, window)
+    lb = _read(tb, sb, window)
+    if axis == 1:
+        la, lb = la.T, lb.T
+    same = (la[0] == la[1]) & (lb[0] == lb[1])
+    return la[0] + oa, lb[1] + ob, same
+
+@report.timed('stitch_tiles')
+def stitch_tiles(tiles, segs, segOut, cols, rows, geo, proj):
+    """Stitch tile segmentations into one label raster
+
+    Core windows are labelled with tile-unique ids, segments are merged
+    across seams with the connected components of the seam pairs and the
+    result is relabelled with consecutive ids starting at 1. Returns the
+    number of segments, of segments touching a seam and of segments
+    merged from several tiles.
+    """
+    # offset the labels of every tile so that they are unique
+    offsets = []
+    total = 0
+    for seg in segs:
+        ds = gdal.Open(seg)
+        offsets.append(total)
+        total += int(ds.GetRasterBand(1).ComputeRasterMinMax(False)[1]) + 1
+        ds = None
+
+    index = {(t['row'], t['col']): k for k, t in enumerate(tiles)}
+    src = []
+    dst = []
+    seam = []
+    for k, t in enumerate(tiles):
+        x, y, w, h = t['core']
+        for nb, window, axis in (((t['row'], t['col'] + 1), (x + w - 1, y, 2, h), 1),
+                                 ((t['row'] + 1, t['col']), (x, y + h - 1, w, 2), 0)):
+            n = index.get(nb)
+            if n is None:
+                continue
+            a, b, same = _seam_pairs(t, segs[k], offsets[k], tiles[n], segs[n], offsets[n],
+                                     window, axis)
+            src.append(a[same])
+            dst.append(b[same])
+            seam.extend([a, b])
+
+    src = np.concatenate(src) if src else np.zeros(0, dtype=np.int64)
+    dst = np.concatenate(dst) if dst else np.zeros(0, dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(src)), (src, dst)), shape=(total, total))
+    _, component = connected_components(graph, directed=False)
+
+    # consecutive final labels over the tile segments present in the cores
+    used = np.zeros(total, dtype=bool)
+    for k, t in enumerate(tiles):
+        used[np.unique(_read(t, segs[k], t['core'])) + offsets[k]] = True
+    roots, parts = np.unique(component[used], return_counts=True)
+    final = np.zeros(total, dtype=np.int64)
+    final[roots] = np.arange(1, len(roots) + 1)
+    lookup = final[component]
+
+    driver = gdal.GetDriverByName("GTiff")
+    out = driver.Create(segOut, cols, rows, 1, gdal.GDT_UInt32)
+    out.SetGeoTransform(geo)
+    out.SetProjection(proj)
+    for k, t in enumerate(tiles):
+        x, y, w, h = t['core']
+        lab = lookup[_read(t, segs[k], t['core']) + offsets[k]]
+        out.GetRasterBand(1).WriteArray(lab.astype(np.uint32), x, y)
+    out = None
+
+    seam = np.unique(lookup[np.concatenate(seam)]) if seam else []
+    return {'segments': len(roots), 'seam_segments': len(seam),
+            'merged_segments': int(np.sum(parts > 1))}
+
+@report.timed('tiled_lsms')
+def tiled_lsms(image, segOut, tile=2000, overlap=64, workers=None, scratch=None, **lsms):
+    """Run the LSMS workflow per tile in a process pool and stitch the result
+
+    lsms holds the keyword arguments of otbApp.runLSMS. Each tile is
+    segmented with an overlap on every side and the label rasters are
+    reconciled across seams by stitch_tiles. The tiles are written to a
+    private directory in scratch, by default in the scratch root. Returns
+    the stitching report.
+    """
+    img = gdal.Open(image)
+    if img is None:
+        raise RuntimeError('Unable to open '+str(image))
+    cols = img.RasterXSize
+    rows = img.RasterYSize
+    geo = img.GetGeoTransform()
+    proj = img.GetProjection()
+    img = None
+
+    tiles = tile_grid(cols, rows, tile, overlap)
+    workers = min(workers or os.cpu_count(), len(tiles))
+    ram, threads = budget(workers)
+    print("Running LSMS on "+str(len(tiles))+" tiles of "+str(tile)+" pixels with "+
+          str(workers)+" workers, "+str(ram)+" MB and "+str(threads)+" threads each")
+
+    tmpdir = scratch_dir("lsms_tiles_", scratch)
+    try:
+        # spawn so that each worker starts OTB with its own thread budget
+        p = multiprocessing.get_context('spawn').Pool(workers, initializer=otbApp.setBudget,
+                                                      initargs=(ram, threads))
+        try:
+            results = p.map(_segment_tile, [(image, t, tmpdir, lsms) for t in tiles], chunksize=1)
+        finally:
+            p.close()
+            p.join()
+        segs = []
+        for seg, records in results:
+            segs.append(seg)
+            report.merge(records)
+        stitch = stitch_tiles(tiles, segs, segOut, cols, rows, geo, proj)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    stitch['tiles'] = len(tiles)
+    report.note(cols=cols, rows=rows, workers=workers, **stitch)
+    print("Stitched "+str(stitch['segments'])+" segments, "+str(stitch['seam_segments'])+
+          " touching a tile seam")
+    return stitch
@@ -0,0 +1,81 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+from osgeo import gdal
+import numpy as np
+from scipy import sparse
+from rasterutil import block_windows
+import report
+
+def _label_pairs(a, b):
+    """Unique (low, high) pairs of differing labels, encoded as int64"""
+    diff = a != b
+    lo = np.minimum(a[diff], b[diff]).astype(np.int64)
+    hi = np.maximum(a[diff], b[diff]).astype(np.int64)
+    return np.unique(lo << 32 | hi)
+
+def label_adjacency(labelRaster):
+    """Queen contiguity of the segments of a label raster
+
+    Two segments are neighbours when any of their pixels touch by an edge
+    or a corner, which is the queen contiguity of the polygons
+    Polygonize would produce. The raster is read in strips overlapping by
+    one row. Returns a symmetric binary CSR matrix indexed by label id.
+    """
+    ds = gdal.Open(labelRaster)
+    if ds is None:
+        raise RuntimeError('Unable to open '+str(labelRaster))
+    band = ds.GetRasterBand(1)
+    rows = band.YSize
+
+    codes = []
+    nlabels = 0
+    for xoff, yoff, xsize, ysize in block_windows(band):
+        # one extra row links this strip to the next one
+        ysize = min(ysize + 1, rows - yoff)
+        lab = band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.int64)
+        nlabels = max(nlabels, int(lab.max()) + 1)
+        codes.append(_label_pairs(lab[:, :-1], lab[:, 1:]))        # W-E
+        codes.append(_label_pairs(lab[:-1, :], lab[1:, :]))        # N-S
+        codes.append(_label_pairs(lab[:-1, :-1], lab[1:, 1:]))     # NW-SE
+        codes.append(_label_pairs(lab[:-1, 1:], lab[1:, :-1]))     # NE-SW
+    ds = None
+
+    codes = np.unique(np.concatenate(codes)) if codes else np.zeros(0, dtype=np.int64)
+    lo = codes >> 32
+    hi = codes & 0xffffffff
+    data = np.ones(2 * len(codes))
+    W = sparse.coo_matrix((data, (np.concatenate([lo, hi]), np.concatenate([hi, lo]))),
+                          shape=(nlabels, nlabels))
+    return W.tocsr()
+
+def segment_weights(W, labels):
+    """Restrict label adjacency to a sequence of segment labels, in order
+
+    A label split over several polygons, e.g. pixels joined only by a
+    corner, which Polygonize separates, gives each of its polygons the
+    neighbours of the whole label. Queen weights of the polygons differ
+    there: each part only has the neighbours it touches, and parts meeting
+    at a corner are neighbours of each other. The number of such labels
+    is reported.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    _, counts = np.unique(labels, return_counts=True)
+    report.note(multipart_labels=int(np.count_nonzero(counts > 1)))
+    return W[labels][:, labels]
+
+def moran_i(values, W):
+    """Moran's I of values with row-standardized weights W
+
+    Matches the I of pysal.Moran with its default "r" transformation;
+    segments without neighbours keep an all-zero row.
+    """
+    z = np.asarray(values, dtype=np.float64)
+    z = z - z.mean()
+    rowsum = np.asarray(W.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore'):
+        scale = np.where(rowsum > 0, 1.0 / rowsum, 0.0)
+    Wr = sparse.diags(scale) @ W
+    s0 = Wr.sum()
+    return len(z) / s0 * (z @ (Wr @ z)) / (z @ z)
@@ -0,0 +1,436 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+from osgeo import gdal, ogr
+import numpy as np
+import pandas as pd
+import os
+import time
+import multiprocessing
+from functools import partial
+from shapely.geometry import shape
+from rasterstats.io import Raster
+from rasterstats.utils import rasterize_geom
+from rasterutil import block_windows, raster_ref
+import report
+
+# statistics computed by the vector engine on masked pixel arrays
+VECTOR_STATS = ('count', 'sum', 'mean', 'std', 'min', 'max', 'median')
+
+# statistics that can be derived from per-segment count, sum and sum of squares
+LABEL_STATS = ('count', 'sum', 'sumsq', 'mean', 'std', 'var')
+
+def _grow(arr, n):
+    """Extend an accumulator so that it can be indexed up to n-1"""
+    if len(arr) >= n:
+        return arr
+    out = np.zeros(n, dtype=arr.dtype)
+    out[:len(arr)] = arr
+    return out
+
+def _accumulate(acc, labels, vals, nodata, n):
+    """Add the pixels of a block to the count, sum and sum of squares per label"""
+    vals = vals.astype(np.float64, copy=False)
+    valid = np.isfinite(vals) & (vals != nodata)
+    lbl = labels[valid]
+    vals = vals[valid]
+    count, total, sumsq = [_grow(a, n) for a in acc]
+    count += np.bincount(lbl, minlength=len(count))
+    total += np.bincount(lbl, weights=vals, minlength=len(total))
+    sumsq += np.bincount(lbl, weights=vals*vals, minlength=len(sumsq))
+    return [count, total, sumsq]
+
+def grid_offset(ds, lbl_ds, name='raster', labelName='label raster'):
+    """Pixel offset (x, y) of the grid of lbl_ds in the grid of ds
+
+    The label raster may cover a window of the raster, e.g. the training
+    area cropped from the scene, as long as both share the pixel size and
+    alignment and the window lies inside the raster.
+    """
+    gt = ds.GetGeoTransform()
+    lgt = lbl_ds.GetGeoTransform()
+    if any(abs(a - b) > 1e-6 * max(abs(a), 1.0) for a, b in zip(gt[1:3] + gt[4:6],
+                                                                lgt[1:3] + lgt[4:6])):
+        raise RuntimeError(str(name)+' does not match the grid of '+str(labelName))
+    dx = (lgt[0] - gt[0]) / gt[1]
+    dy = (lgt[3] - gt[3]) / gt[5]
+    xoff, yoff = int(round(dx)), int(round(dy))
+    if (abs(dx - xoff) > 1e-3 or abs(dy - yoff) > 1e-3 or xoff < 0 or yoff < 0 or
+            xoff + lbl_ds.RasterXSize > ds.RasterXSize or
+            yoff + lbl_ds.RasterYSize > ds.RasterYSize):
+        raise RuntimeError(str(name)+' does not match the grid of '+str(labelName))
+    return xoff, yoff
+
+@report.timed('label_zonal_stats')
+def label_zonal_stats(labelRaster, rasters, stats=('mean',), nodata=-999):
+    """Compute per-segment statistics from a label raster
+
+    Every pixel of labelRaster holds the id of the segment it belongs to, so
+    the zonal statistics of each raster in rasters ({name: file} or
+    {name: (file, band)}) reduce to np.bincount over the label ids, one
+    block strip at a time. The bands of one file, e.g. a feature stack,
+    are read together. The label raster may cover a window of the rasters,
+    see grid_offset. Pixels equal to nodata or not finite are ignored,
+    as in rasterstats.
+
+    Returns a DataFrame indexed by label id with a "pixels" column and one
+    "<name>_<stat>" column per raster and statistic.
+    """
+    for s in stats:
+        if s not in LABEL_STATS:
+            raise RuntimeError('Unsupported label statistic: '+str(s))
+
+    lbl_ds = gdal.Open(labelRaster)
+    if lbl_ds is None:
+        raise RuntimeError('Unable to open '+str(labelRaster))
+    lbl_band = lbl_ds.GetRasterBand(1)
+
+    # open every file once, with the (name, band) pairs read from it
+    sources = {}
+    for name, ref in rasters.items():
+        tif, b = raster_ref(ref)
+        if tif not in sources:
+            ds = gdal.Open(tif)
+            if ds is None:
+                raise RuntimeError('Unable to open '+str(tif))
+            sources[tif] = (ds, [], grid_offset(ds, lbl_ds, tif, labelRaster))
+        sources[tif][1].append((name, b))
+
+    pixels = np.zeros(0, dtype=np.int64)
+    acc = {name: [np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)]
+           for name in rasters}
+
+    for xoff, yoff, xsize, ysize in block_windows(lbl_band):
+        labels = lbl_band.ReadAsArray(xoff, yoff, xsize, ysize).ravel()
+        labels = labels.astype(np.int64, copy=False)
+        n = int(labels.max()) + 1
+
+        pixels = _grow(pixels, n)
+        pixels += np.bincount(labels, minlength=len(pixels))
+
+        for ds, bands, (dx, dy) in sources.values():
+            if len(bands) == 1:
+                block = ds.GetRasterBand(bands[0][1]).ReadAsArray(xoff + dx, yoff + dy,
+                                                                  xsize, ysize)[None]
+                index = [0]
+            else:
+                # one read of all bands of the window
+                block = ds.ReadAsArray(xoff + dx, yoff + dy, xsize, ysize)
+                block = block.reshape(-1, ysize, xsize)
+                index = [b - 1 for _, b in bands]
+            for (name, _), i in zip(bands, index):
+                acc[name] = _accumulate(acc[name], labels, block[i].ravel(), nodata,
+                                        len(pixels))
+
+    lbl_ds = None
+    sources = None
+
+    present = np.flatnonzero(pixels)
+    report.note(rasters=len(acc), segments=len(present), pixels=int(pixels.sum()))
+    table = pd.DataFrame({'pixels': pixels[present]}, index=present)
+    table.index.name = 'label'
+
+    for name in acc:
+        count, total, sumsq = [_grow(a, len(pixels))[present] for a in acc[name]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            # population variance, matching numpy/rasterstats "std"
+            var = np.maximum(sumsq / count - mean * mean, 0.0)
+        values = {'count': count, 'sum': total, 'sumsq': sumsq,
+                  'mean': mean, 'var': var, 'std': np.sqrt(var)}
+        for s in stats:
+            table[name+'_'+s] = values[s]
+
+    return table
+
+def label_values(table, labels, column):
+    """Look up a per-segment statistic for a sequence of segment labels"""
+    return table[column].reindex(np.asarray(labels)).values
+
+@report.timed('label_overlap')
+def label_overlap(labelRaster, vectorFile, exclude=()):
+    """Largest share of each segment covered by a single polygon, in percent
+
+    The polygons of vectorFile are rasterized once onto the grid of the
+    label raster, burning the 1-based index of each polygon, and the
+    pixels of every (segment, polygon) pair are counted one block strip
+    at a time. Polygons whose 0-based index is in exclude are ignored.
+    Returns a Series indexed by label id.
+    """
+    lbl_ds = gdal.Open(labelRaster)
+    if lbl_ds is None:
+        raise RuntimeError('Unable to open '+str(labelRaster))
+    src = ogr.Open(vectorFile)
+    if src is None:
+        raise RuntimeError('Unable to open '+str(vectorFile))
+    layer = src.GetLayer()
+
+    # copy the polygons with their index, the burn value
+    mem = ogr.GetDriverByName("Memory").CreateDataSource('')
+    ids = mem.CreateLayer('polygons', srs=layer.GetSpatialRef())
+    ids.CreateField(ogr.FieldDefn('pid', ogr.OFTInteger))
+    for i, feat in enumerate(layer):
+        out = ogr.Feature(ids.GetLayerDefn())
+        out.SetField('pid', i + 1)
+        out.SetGeometry(feat.GetGeometryRef())
+        ids.CreateFeature(out)
+
+    burn = gdal.GetDriverByName("MEM").Create('', lbl_ds.RasterXSize, lbl_ds.RasterYSize,
+                                              1, gdal.GDT_Int32)
+    burn.SetGeoTransform(lbl_ds.GetGeoTransform())
+    burn.SetProjection(lbl_ds.GetProjection())
+    gdal.RasterizeLayer(burn, [1], ids, options=['ATTRIBUTE=pid'])
+    src = None
+    mem = None
+
+    lbl_band = lbl_ds.GetRasterBand(1)
+    pid_band = burn.GetRasterBand(1)
+    skip = np.asarray([i + 1 for i in exclude], dtype=np.int64)
+    pixels = np.zeros(0, dtype=np.int64)
+    pairs = []
+    for xoff, yoff, xsize, ysize in block_windows(lbl_band):
+        labels = lbl_band.ReadAsArray(xoff, yoff, xsize, ysize).ravel().astype(np.int64)
+        pid = pid_band.ReadAsArray(xoff, yoff, xsize, ysize).ravel().astype(np.int64)
+        pixels = _grow(pixels, int(labels.max()) + 1)
+        pixels += np.bincount(labels, minlength=len(pixels))
+        inside = (pid > 0) & ~np.isin(pid, skip)
+        codes, counts = np.unique(labels[inside] << 32 | pid[inside], return_counts=True)
+        pairs.append(pd.Series(counts, index=codes))
+    lbl_ds = None
+    burn = None
+
+    present = np.flatnonzero(pixels)
+    share = pd.Series(0.0, index=present)
+    share.index.name = 'label'
+    if pairs:
+        counts = pd.concat(pairs).groupby(level=0).sum()
+        best = pd.Series(counts.values, index=counts.index.values >> 32).groupby(level=0).max()
+        share.loc[best.index] = best.values / pixels[best.index] * 100
+    return share
+
+def _feature_center(feat):
+    """Bounding box center of a shapely geometry or a GeoJSON-like feature"""
+    if hasattr(feat, 'bounds'):
+        minx, miny, maxx, maxy = feat.bounds
+        return (minx + maxx) / 2.0, (miny + maxy) / 2.0
+    geom = feat['geometry']
+    coords = geom['coordinates']
+    # first ring of a Polygon, or of the first part of a MultiPolygon
+    ring = coords[0][0] if geom['type'] == 'MultiPolygon' else coords[0]
+    ring = np.asarray(ring, dtype=np.float64)
+    return ((ring[:, 0].min() + ring[:, 0].max()) / 2.0,
+            (ring[:, 1].min() + ring[:, 1].max()) / 2.0)
+
+def _spread_bits(v):
+    """Insert a zero bit between each of the low 16 bits of v"""
+    v = v & 0x0000ffff
+    v = (v | (v << 8)) & 0x00ff00ff
+    v = (v | (v << 4)) & 0x0f0f0f0f
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+def spatial_order(features):
+    """Order features along a Z-order (Morton) curve of their centers"""
+    if len(features) == 0:
+        return np.zeros(0, dtype=np.int64)
+    xy = np.array([_feature_center(f) for f in features], dtype=np.float64)
+    lo = xy.min(axis=0)
+    span = np.maximum(xy.max(axis=0) - lo, 1e-12)
+    q = ((xy - lo) / span * 65535).astype(np.int64)
+    # y grows northward, invert it so the curve follows raster rows
+    code = _spread_bits(q[:, 0]) | (_spread_bits(65535 - q[:, 1]) << 1)
+    return np.argsort(code, kind='stable')
+
+def partition(features, cores, batch_size=None):
+    """Split features into spatially coherent batches
+
+    Features are sorted along a Z-order curve so that each batch covers a
+    compact part of the raster. Without a batch_size the features are cut
+    into about 4 batches per worker, which leaves room for load balancing.
+    Yields (indices, features) pairs, indices refer to the input order.
+    """
+    order = spatial_order(features)
+    if not batch_size:
+        batch_size = max(64, -(-len(order) // (4 * max(cores, 1))))
+    for i in range(0, len(order), batch_size):
+        idx = order[i:i+batch_size]
+        yield idx, [features[j] for j in idx]
+
+class ZonalPool(object):
+    """Worker pool shared by all zonal passes of a run
+
+    Workers keep the rasters they open for their whole lifetime, so the
+    pool must not outlive changes to the raster files it has read.
+    """
+
+    def __init__(self, cores=None, batch_size=None):
+        self.cores = cores or os.cpu_count()
+        self.batch_size = batch_size
+        self._pool = multiprocessing.Pool(self.cores, initializer=_init_zonal_worker)
+
+    def map(self, func, iterable):
+        return self._pool.map(func, iterable, chunksize=1)
+
+    def close(self):
+        self._pool.close()
+
+    def join(self):
+        self._pool.join()
+
+def zonal_pool(cores=None, batch_size=None):
+    """Create the worker pool shared by all zonal passes of a run"""
+    return ZonalPool(cores, batch_size)
+
+# rasters opened by this zonal worker process, by file name
+_worker_rasters = None
+
+def _init_zonal_worker():
+    """Pool initializer, sets up the per-worker raster cache"""
+    global _worker_rasters
+    _worker_rasters = {}
+
+def _worker_raster(opened, tif, nodata, bands=1):
+    """Return an open raster of opened, opening it on first use
+
+    opened is the cache of a pool worker, kept for its lifetime, or the
+    rasters of an in-process pass, closed with _close_rasters at its end.
+    bands is a band number, or a tuple of band numbers read together.
+    """
+    key = (tif, nodata, bands, os.path.getmtime(tif))
+    src = opened.get(key)
+    if src is None:
+        src = Raster(tif, nodata=nodata, band=list(bands) if isinstance(bands, tuple) else bands)
+        opened[key] = src
+    return src
+
+def _close_rasters(opened):
+    """Close the rasters of an in-process zonal pass"""
+    for src in opened.values():
+        if src.src is not None:
+            src.src.close()
+    opened.clear()
+
+def _raster_groups(rasters):
+    """Group the rasters of a zonal pass by file
+
+    Returns (file, bands, [(name, stats), ...]) triples, bands being the
+    band number of a single raster or the tuple of band numbers of a file
+    holding several, which are read in one window read.
+    """
+    groups = {}
+    for name, (ref, stats) in rasters.items():
+        tif, b = raster_ref(ref)
+        groups.setdefault(tif, []).append((name, b, stats))
+    out = []
+    for tif, members in groups.items():
+        bands = members[0][1] if len(members) == 1 else tuple(b for _, b, _ in members)
+        out.append((tif, bands, [(name, stats) for name, _, stats in members]))
+    return out
+
+def _masked_stat(masked, stat):
+    """Evaluate one statistic on a masked pixel array, None when empty"""
+    count = int(masked.count())
+    if stat == 'count':
+        return count
+    if count == 0:
+        return None
+    if stat == 'median':
+        return float(np.ma.median(masked))
+    return float(getattr(masked, stat)())
+
+def zonal_table_wrapper(batch, rasters, nodata, opened=None):
+    """Compute all statistics of all rasters for a batch of features
+
+    Each polygon is rasterized once on the shared grid and the same window
+    is read from every file, all bands of a file at once, so the rasters
+    must be co-registered. rasters maps a name to a (file, [stats]) or
+    ((file, band), [stats]) pair. Rasters are taken from opened, by
+    default the cache of the pool worker. Returns the batch indices, the
+    rows and the task latency in seconds.
+    """
+    start = time.perf_counter()
+    idx, feats = batch
+    if opened is None:
+        opened = _worker_rasters
+    groups = [(_worker_raster(opened, tif, nodata, bands), members)
+              for tif, bands, members in _raster_groups(rasters)]
+    rows = []
+    for feat in feats:
+        geom = feat if hasattr(feat, 'bounds') else shape(feat['geometry'])
+        row = {}
+        rv_array = None
+        for src, members in groups:
+            fsrc = src.read(bounds=geom.bounds)
+            arrays = fsrc.array.reshape((-1,) + fsrc.array.shape[-2:])
+            if rv_array is None:
+                like = Raster(arrays[0], fsrc.affine, nodata)
+                rv_array = rasterize_geom(geom, like=like, all_touched=False)
+            for (name, stats), arr in zip(members, arrays):
+                isnodata = (arr == nodata)
+                if np.issubdtype(arr.dtype, np.floating):
+                    isnodata = isnodata | np.isnan(arr)
+                masked = np.ma.MaskedArray(arr, mask=(isnodata | ~rv_array))
+                for stat in stats:
+                    row[name+'_'+stat] = _masked_stat(masked, stat)
+        rows.append(row)
+    return idx, rows, time.perf_counter() - start
+
+def task_report(sizes, latencies):
+    """Summarize batch sizes and per-task latencies of a zonal pass"""
+    lat = np.asarray(latencies, dtype=np.float64)
+    return {
+        'tasks': len(sizes),
+        'features': int(np.sum(sizes)),
+        'batch_size': int(np.max(sizes)) if len(sizes) else 0,
+        'latency_mean': float(lat.mean()) if len(lat) else 0.0,
+        'latency_p50': float(np.median(lat)) if len(lat) else 0.0,
+        'latency_max': float(lat.max()) if len(lat) else 0.0,
+    }
+
+@report.timed('zonal_stats')
+def zonal_stats_table(features, rasters, pool=None, cores=None, nodata=-999,
+                      batch_size=None):
+    """Compute a per-feature table of zonal statistics in one traversal
+
+    rasters maps a name to a (file, [stats]) pair; the result has one row
+    per feature, in order, and one "<name>_<stat>" column per statistic.
+    A pool created with zonal_pool is reused when given, otherwise a
+    temporary pool of cores workers is created, or none with cores=1.
+    Features are dispatched in spatially coherent batches, see partition.
+    """
+    for name, (tif, stats) in rasters.items():
+        for stat in stats:
+            if stat not in VECTOR_STATS:
+                raise RuntimeError('Unsupported zonal statistic: '+str(stat))
+
+    func = partial(zonal_table_wrapper, rasters=rasters, nodata=nodata)
+    if pool is None and cores == 1:
+        # in-process, e.g. inside the daemonic workers of another pool; the
+        # rasters are closed at the end of the pass
+        opened = {}
+        try:
+            results = [func(batch, opened=opened) for batch in partition(features, 1, batch_size)]
+        finally:
+            _close_rasters(opened)
+    else:
+        p = pool or zonal_pool(cores)
+        batch_size = batch_size or p.batch_size
+        try:
+            results = p.map(func, partition(features, p.cores, batch_size))
+        finally:
+            if pool is None:
+                p.close()
+
+    rows = [None] * len(features)
+    for idx, batch_rows, _ in results:
+        for i, row in zip(idx, batch_rows):
+            rows[i] = row
+    report.note(rasters=len(rasters), workers=1 if pool is None and cores == 1 else
+                (pool.cores if pool is not None else cores or os.cpu_count()),
+                **task_report([len(r[0]) for r in results], [r[2] for r in results]))
+
+    columns = [name+'_'+stat for name, (tif, stats) in rasters.items()
+               for stat in stats]
+    return pd.DataFrame(rows, columns=columns)
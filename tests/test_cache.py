@@ -0,0 +1,53 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+from cache import ArtifactCache, stage_key
+
+def _write(path, text):
+    with open(path, 'w') as fd:
+        fd.write(text)
+
+def test_restore_into_another_output_dir(tmp_path):
+    """Cached outputs go to the output paths of the run restoring them"""
+    first = tmp_path / 'first'
+    second = tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    key = stage_key('training', params={'overlap': 50.0})
+
+    outputs = [str(first / 'training_scene.gpkg'), str(first / 'scene.shp')]
+    _write(outputs[0], 'training')
+    for ext in ('.shp', '.shx', '.dbf'):
+        _write(str(first / ('scene'+ext)), ext)
+    cache.store('training', key, outputs, {'trainfile': outputs[0], 'hr': 12})
+
+    targets = [str(second / 'training_scene.gpkg'), str(second / 'scene.shp')]
+    entry = cache.restore('training', key, targets)
+    assert entry is not None
+    assert sorted(os.listdir(str(second))) == ['scene.dbf', 'scene.shp', 'scene.shx',
+                                               'training_scene.gpkg']
+    with open(targets[0]) as fd:
+        assert fd.read() == 'training'
+    assert entry['meta'] == {'trainfile': targets[0], 'hr': 12}
+    assert sorted(entry['files'].values()) == sorted(str(second / f) for f in os.listdir(str(second)))
+
+def test_restore_outputs_from_metadata(tmp_path):
+    """Outputs may depend on the metadata, a name that does not match is a miss"""
+    out = tmp_path / 'out'
+    out.mkdir()
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    key = stage_key('radius')
+    _write(str(out / 'seg_scene_12.gpkg'), 'seg')
+    cache.store('radius', key, [str(out / 'seg_scene_12.gpkg')], {'hr': 12})
+    os.remove(str(out / 'seg_scene_12.gpkg'))
+
+    assert cache.restore('radius', key, [str(out / 'seg_other_12.gpkg')]) is None
+    assert not os.listdir(str(out))
+    entry = cache.restore('radius', key,
+                          lambda meta: [str(out / ('seg_scene_'+str(meta['hr'])+'.gpkg'))])
+    assert entry['meta'] == {'hr': 12}
+    assert os.listdir(str(out)) == ['seg_scene_12.gpkg']
+    assert cache.restore('radius', stage_key('radius', params={'hr_min': 2}), []) is None
@@ -0,0 +1,42 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+from glcm import GLCM_DIRECTIONS, quantize, glcm_mean_homog
+
+def brute_glcm(q, y, x, xoff, yoff, rad, nbins):
+    """GLCM mean and homogeneity of one pixel from its co-occurrence matrix"""
+    rows, cols = q.shape
+    P = np.zeros((nbins, nbins))
+    for cy in range(max(0, y - rad), min(rows, y + rad + 1)):
+        for cx in range(max(0, x - rad), min(cols, x + rad + 1)):
+            py, px = cy + yoff, cx + xoff
+            if 0 <= py < rows and 0 <= px < cols and q[cy, cx] >= 0 and q[py, px] >= 0:
+                P[q[cy, cx], q[py, px]] += 1
+                P[q[py, px], q[cy, cx]] += 1
+    if P.sum() == 0:
+        return 0.0, 0.0
+    P /= P.sum()
+    i, j = np.mgrid[0:nbins, 0:nbins]
+    return (i * P).sum(), (P / (1.0 + (i - j) ** 2)).sum()
+
+def test_quantize():
+    q = quantize(np.array([[0, 5, 9, 10, 11, np.nan]]), 0, 10, 4)
+    assert q.tolist() == [[0, 2, 3, 3, -1, -1]]
+
+@pytest.mark.parametrize('direction', GLCM_DIRECTIONS)
+def test_glcm_mean_homog_brute_force(direction):
+    rng = np.random.default_rng(7)
+    nbins = 8
+    q = quantize(rng.integers(0, 200, (13, 17)), 0, 180, nbins)
+    xoff, yoff, _ = direction
+    mean, homog = glcm_mean_homog(q, xoff, yoff, 2)
+    for y in range(q.shape[0]):
+        for x in range(q.shape[1]):
+            m, h = brute_glcm(q, y, x, xoff, yoff, 2, nbins)
+            assert mean[y, x] == pytest.approx(m)
+            assert homog[y, x] == pytest.approx(h)
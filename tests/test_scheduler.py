@@ -0,0 +1,60 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import time
+import pytest
+from scheduler import Scheduler, Task
+
+def add(*values, upstream=None, tokens=None):
+    """Sum of values and of the upstream results"""
+    return sum(values) + sum((upstream or {}).values())
+
+def nap(seconds, upstream=None, tokens=None):
+    time.sleep(seconds)
+    return tokens
+
+def fail(upstream=None, tokens=None):
+    raise ValueError('task failed')
+
+def test_results_follow_dependencies():
+    s = Scheduler({'cpu': 2})
+    s.add(Task('a', add, args=(1,)))
+    s.add(Task('b', add, args=(2,)))
+    s.add(Task('c', add, args=(10,), deps=['a', 'b']))
+    s.add(Task('d', add, deps=['c', 'a']))
+    assert s.run() == {'a': 1, 'b': 2, 'c': 13, 'd': 14}
+
+def test_tokens_capped_at_capacity():
+    s = Scheduler({'cpu': 2, 'ram': 100})
+    s.add(Task('big', nap, args=(0,), resources={'cpu': 8, 'ram': 50}))
+    assert s.run()['big'] == {'cpu': 2, 'ram': 50}
+
+def test_failure_skips_dependents():
+    s = Scheduler({'cpu': 2})
+    s.add(Task('bad', fail))
+    s.add(Task('after', add, deps=['bad']))
+    s.add(Task('other', add, args=(5,)))
+    with pytest.raises(RuntimeError):
+        s.run()
+    assert s.results == {'other': 5}
+    assert s.report['failed'] == ['after', 'bad']
+
+def test_cycle_and_unknown_dependency():
+    s = Scheduler()
+    s.add(Task('a', add, deps=['b']))
+    s.add(Task('b', add, deps=['a']))
+    with pytest.raises(RuntimeError):
+        s.run()
+    s = Scheduler()
+    s.add(Task('a', add, deps=['missing']))
+    with pytest.raises(RuntimeError):
+        s.run()
+
+def test_critical_path():
+    s = Scheduler()
+    for name, deps in (('a', []), ('b', []), ('c', ['a', 'b']), ('d', ['b'])):
+        s.add(Task(name, add, deps=deps))
+    s.report = {'tasks': {'a': {'seconds': 5.0}, 'b': {'seconds': 1.0},
+                          'c': {'seconds': 2.0}, 'd': {'seconds': 9.0}}}
+    assert s.criticalPath() == (['b', 'd'], 10.0)
@@ -0,0 +1,23 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+pytest.importorskip('pysal')
+from segmentation import plateau
+
+def test_plateau():
+    # F_v = [1, 2/3, 1/2, 0], F_I = [0, 3/4, 7/8, 1], threshold about 1.1875
+    hr_df, hr = plateau([(2, 1.0, 0.5), (4, 2.0, 0.2), (6, 2.5, 0.15), (8, 4.0, 0.1)])
+    assert hr == 4
+    assert hr_df['F_v_I'].values == pytest.approx([1.0, 17 / 12, 11 / 8, 1.0])
+
+def test_plateau_selects_before_the_peak():
+    # F_v_I peaks at hr 30, hr 20 is already above the threshold
+    v = [1.0, 1.1, 1.2, 1.4, 2.5, 4.0]
+    I = [0.9, 0.5, 0.3, 0.25, 0.2, 0.1]
+    hr_df, hr = plateau(list(zip(range(10, 70, 10), v, I)))
+    assert hr == 20
+    assert int(hr_df['F_v_I'].idxmax()) == 2
@@ -0,0 +1,57 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+from weights import label_adjacency, segment_weights, moran_i
+
+LABELS = np.array([[1, 1, 2, 2, 3],
+                   [1, 4, 4, 2, 3],
+                   [5, 4, 6, 6, 3],
+                   [5, 5, 6, 7, 7]], dtype=np.uint32)
+
+def _label_raster(tmp_path, labels):
+    filename = str(tmp_path / 'labels.tif')
+    out = gdal.GetDriverByName("GTiff").Create(filename, labels.shape[1], labels.shape[0],
+                                               1, gdal.GDT_UInt32)
+    out.SetGeoTransform((0.0, 1.0, 0.0, 0.0, 0.0, -1.0))
+    out.GetRasterBand(1).WriteArray(labels)
+    out = None
+    return filename
+
+def brute_queen(labels):
+    """Label pairs whose pixels touch by an edge or a corner"""
+    rows, cols = labels.shape
+    pairs = set()
+    for y in range(rows):
+        for x in range(cols):
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    ny, nx = y + dy, x + dx
+                    if 0 <= ny < rows and 0 <= nx < cols and labels[ny, nx] != labels[y, x]:
+                        pairs.add((int(labels[y, x]), int(labels[ny, nx])))
+    return pairs
+
+def test_label_adjacency(tmp_path):
+    W = label_adjacency(_label_raster(tmp_path, LABELS)).tocoo()
+    assert set(zip(W.row.tolist(), W.col.tolist())) == brute_queen(LABELS)
+    assert (W.data == 1).all()
+
+def test_segment_weights_order(tmp_path):
+    W = label_adjacency(_label_raster(tmp_path, LABELS))
+    order = [3, 1, 7]
+    Ws = segment_weights(W, order).toarray()
+    assert Ws.tolist() == [[0, 0, 1], [0, 0, 0], [1, 0, 0]]
+
+def test_moran_i_esda(tmp_path):
+    esda = pytest.importorskip('esda')
+    libpysal = pytest.importorskip('libpysal')
+    W = label_adjacency(_label_raster(tmp_path, LABELS))
+    labels = np.arange(1, 8)
+    Ws = segment_weights(W, labels)
+    values = np.array([3.0, 1.5, 4.0, 2.0, 7.5, 1.0, 6.0])
+    ref = esda.Moran(values, libpysal.weights.WSP(Ws).to_W(), permutations=0).I
+    assert moran_i(values, Ws) == pytest.approx(ref)
@@ -0,0 +1,96 @@
+#Copyright © 2020 United States Government as represented by the
+#Administrator of the National Aeronautics and Space Administration.
+#All Rights Reserved.
+
+import os
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+from zonal import label_zonal_stats
+
+def _write(filename, arr, geo, gdaltype):
+    out = gdal.GetDriverByName("GTiff").Create(filename, arr.shape[1], arr.shape[0], 1, gdaltype)
+    out.SetGeoTransform(geo)
+    out.GetRasterBand(1).WriteArray(arr)
+    out = None
+
+def test_label_window_of_scene(tmp_path):
+    """A label raster of a training window reads the window of the scene rasters"""
+    rng = np.random.default_rng(1)
+    scene = rng.uniform(0, 100, (30, 40)).astype(np.float32)
+    bright = str(tmp_path / 'bright.tif')
+    _write(bright, scene, (1000.0, 3.0, 0.0, 2000.0, 0.0, -3.0), gdal.GDT_Float32)
+
+    # 12 x 10 window at column 7, row 5
+    labels = rng.integers(1, 6, (10, 12)).astype(np.uint32)
+    seg = str(tmp_path / 'seg.tif')
+    _write(seg, labels, (1000.0 + 7 * 3.0, 3.0, 0.0, 2000.0 - 5 * 3.0, 0.0, -3.0),
+           gdal.GDT_UInt32)
+
+    table = label_zonal_stats(seg, {'bright': bright}, ['mean', 'std'])
+    window = scene[5:15, 7:19]
+    for label in range(1, 6):
+        vals = window[labels == label].astype(np.float64)
+        assert table.loc[label, 'bright_mean'] == pytest.approx(vals.mean())
+        assert table.loc[label, 'bright_std'] == pytest.approx(vals.std())
+
+def test_label_grid_mismatch(tmp_path):
+    """Rasters of another pixel size or not covering the labels are refused"""
+    bright = str(tmp_path / 'bright.tif')
+    _write(bright, np.ones((20, 20), np.float32), (0.0, 3.0, 0.0, 60.0, 0.0, -3.0),
+           gdal.GDT_Float32)
+    seg = str(tmp_path / 'seg.tif')
+    _write(seg, np.ones((10, 10), np.uint32), (0.0, 2.0, 0.0, 60.0, 0.0, -2.0), gdal.GDT_UInt32)
+    with pytest.raises(RuntimeError):
+        label_zonal_stats(seg, {'bright': bright})
+    _write(seg, np.ones((10, 10), np.uint32), (45.0, 3.0, 0.0, 60.0, 0.0, -3.0), gdal.GDT_UInt32)
+    with pytest.raises(RuntimeError):
+        label_zonal_stats(seg, {'bright': bright})
+
+def test_label_and_vector_engines_match_rasterstats(tmp_path):
+    """Both zonal engines agree with rasterstats on pixel-aligned segments"""
+    rasterstats = pytest.importorskip('rasterstats')
+    from shapely.geometry import box
+    from zonal import zonal_stats_table
+    rng = np.random.default_rng(3)
+    geo = (500.0, 2.0, 0.0, 800.0, 0.0, -2.0)
+    values = rng.normal(10, 3, (24, 30)).astype(np.float32)
+    bright = str(tmp_path / 'bright.tif')
+    _write(bright, values, geo, gdal.GDT_Float32)
+
+    # 6 x 5 blocks of 4 x 6 pixels, labels 1..30
+    labels = np.zeros((24, 30), np.uint32)
+    geoms = []
+    for by in range(6):
+        for bx in range(5):
+            labels[4*by:4*by+4, 6*bx:6*bx+6] = 1 + by * 5 + bx
+            geoms.append(box(500.0 + 12.0 * bx, 800.0 - 8.0 * (by + 1),
+                             500.0 + 12.0 * (bx + 1), 800.0 - 8.0 * by))
+    seg = str(tmp_path / 'seg.tif')
+    _write(seg, labels, geo, gdal.GDT_UInt32)
+
+    ref = rasterstats.zonal_stats(geoms, bright, stats=['count', 'mean', 'std'])
+    table = label_zonal_stats(seg, {'bright': bright}, ['count', 'mean', 'std'])
+    vector = zonal_stats_table(geoms, {'bright': (bright, ['count', 'mean', 'std'])}, cores=1)
+    for i, r in enumerate(ref):
+        assert table.loc[i + 1, 'bright_count'] == r['count']
+        assert table.loc[i + 1, 'bright_mean'] == pytest.approx(r['mean'], rel=1e-6)
+        assert table.loc[i + 1, 'bright_std'] == pytest.approx(r['std'], rel=1e-5)
+        assert vector.loc[i, 'bright_mean'] == pytest.approx(r['mean'], rel=1e-6)
+        assert vector.loc[i, 'bright_std'] == pytest.approx(r['std'], rel=1e-5)
+
+def test_in_process_pass_closes_rasters(tmp_path):
+    """A zonal pass without a pool leaves no raster open"""
+    pytest.importorskip('rasterstats')
+    from shapely.geometry import box
+    from zonal import zonal_stats_table
+    if not os.path.isdir('/proc/self/fd'):
+        pytest.skip('needs /proc/self/fd')
+    bright = str(tmp_path / 'bright.tif')
+    _write(bright, np.ones((10, 10), np.float32), (0.0, 1.0, 0.0, 10.0, 0.0, -1.0),
+           gdal.GDT_Float32)
+    before = len(os.listdir('/proc/self/fd'))
+    for _ in range(3):
+        zonal_stats_table([box(1.0, 1.0, 4.0, 4.0)], {'bright': (bright, ['mean'])}, cores=1)
+    assert len(os.listdir('/proc/self/fd')) == before